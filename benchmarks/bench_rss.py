@@ -0,0 +1,72 @@
+#########
+# Notes #
+#########
+#
+# Compare pulling the arxiv ids out of an RSS feed with the
+# incremental XML parser in update.py against parsing the whole feed
+# with feedparser.  Also times importing feedparser, which the daily
+# run no longer has to do.
+#
+# Run from the top of the source tree:
+#   python benchmarks/bench_rss.py [n_items]
+#
+
+import sys, os, io, time, subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                '..', 'overheard'))
+
+import update
+
+def synthetic_feed(n_items):
+    "Return an RSS 1.0 feed like arxiv.org's with n_items papers"
+    items = []
+    lis = []
+    for ii in range(n_items):
+        url = 'http://arxiv.org/abs/1404.%04d' % ii
+        lis.append('<rdf:li rdf:resource="%s" />' % url)
+        items.append('<item rdf:about="%s">\n<title>Paper %d (arXiv:1404.%04dv1 '
+                     '[astro-ph.CO])</title>\n<link>%s</link>\n<description>'
+                     '&lt;p&gt;%s&lt;/p&gt;</description>\n<dc:creator>A. Author, '
+                     'B. Author</dc:creator>\n</item>' % 
+                     (url, ii, ii, url, 'We present observations of galaxies. ' * 30))
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#" '
+            'xmlns="http://purl.org/rss/1.0/" xmlns:dc="http://purl.org/dc/elements/1.1/">\n'
+            '<channel rdf:about="http://arxiv.org/rss/astro-ph">\n<title>astro-ph</title>\n'
+            '<items><rdf:Seq>\n' + '\n'.join(lis) + '\n</rdf:Seq></items>\n</channel>\n' + 
+            '\n'.join(items) + '\n</rdf:RDF>\n')
+
+def best_time(func, repeat=5):
+    "Best of repeat calls to func, in seconds"
+    times = []
+    for ii in range(repeat):
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return min(times)
+
+def import_time():
+    "Time to import feedparser in a fresh interpreter, in seconds"
+    code = 'import time; t = time.time(); import feedparser; print(time.time() - t)'
+    return float(subprocess.check_output([sys.executable, '-c', code]))
+
+def main(argv=None):
+    if argv is None: argv = sys.argv
+    n_items = int(argv[1]) if len(argv) > 1 else 300
+
+    data = synthetic_feed(n_items)
+    streaming = lambda: list(update.iter_feed_ids(io.BytesIO(data)))
+    with_feedparser = lambda: update.feedparser_ids(data)
+    assert streaming() == with_feedparser()
+
+    t_stream = best_time(streaming)
+    t_feedparser = best_time(with_feedparser)
+    print "%d items, %.0f kB" % (n_items, len(data) / 1024.0)
+    print "iterparse:          %7.4f s" % t_stream
+    print "feedparser:         %7.4f s" % t_feedparser
+    print "speedup:            %7.1fx" % (t_feedparser / t_stream)
+    print "import feedparser:  %7.4f s" % import_time()
+
+if __name__ == '__main__':
+    sys.exit(main())
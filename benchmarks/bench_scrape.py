@@ -0,0 +1,60 @@
+#########
+# Notes #
+#########
+#
+# Compare the per-line comment regexps in scrape.py with the
+# whole-buffer engine (scrape.comments_from_text) on a synthetic
+# corpus that looks roughly like astro-ph latex: mostly prose and
+# equations, a long comment block every so often, and short comments
+# (including \% in text) on a few percent of the lines.
+#
+# Run from the top of the source tree:
+#   python benchmarks/bench_scrape.py [n_papers]
+#
+
+import sys, os, time, random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                '..', 'overheard'))
+
+import scrape
+from corpus import synthetic_paper
+
+def per_line(text):
+    "What write_output used to do with the text of a paper"
+    lines = text.splitlines(True)
+    return (scrape.long_comments_from_lines(lines), 
+            scrape.short_comments_from_lines(lines))
+
+def whole_buffer(text):
+    return scrape.comments_from_text(text)
+
+def best_time(func, texts, repeat=3):
+    "Best of repeat runs of func over all texts, in seconds"
+    times = []
+    for ii in range(repeat):
+        start = time.time()
+        for text in texts:
+            func(text)
+        times.append(time.time() - start)
+    return min(times)
+
+def main(argv=None):
+    if argv is None: argv = sys.argv
+    n_papers = int(argv[1]) if len(argv) > 1 else 100
+
+    rand = random.Random(1)
+    texts = [synthetic_paper(rand) for ii in range(n_papers)]
+    for text in texts:
+        assert per_line(text) == whole_buffer(text)
+
+    mb = sum(len(text) for text in texts) / 2.0**20
+    t_lines = best_time(per_line, texts)
+    t_buffer = best_time(whole_buffer, texts)
+    print "%d papers, %.1f MB of text" % (n_papers, mb)
+    print "per-line regexps: %6.3f s  %6.1f MB/s" % (t_lines, mb/t_lines)
+    print "whole buffer:     %6.3f s  %6.1f MB/s" % (t_buffer, mb/t_buffer)
+    print "speedup:          %6.1fx" % (t_lines / t_buffer)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,56 @@
+#########
+# Notes #
+#########
+#
+# Compare two sets of results from run.py, e.g. from before and after
+# a commit.  Ratios are new time / old time, so less than one is
+# faster.  Benchmarks that got slower by more than the threshold are
+# marked, and the exit status is 1 if there are any.
+#
+# Usage:
+#   python benchmarks/compare.py old.json new.json [threshold]
+#
+
+import sys, json
+
+def load(fn):
+    with open(fn) as ff:
+        return json.load(ff)
+
+def compare(old, new, threshold=0.1):
+    "Print a table comparing two results, return the names of regressions"
+    print "old: %s  python %s" % (old.get('commit'), old.get('python'))
+    print "new: %s  python %s" % (new.get('commit'), new.get('python'))
+    if old.get('parameters') != new.get('parameters'):
+        print "WARNING: Benchmarks were run with different parameters"
+    print
+    print "%-16s %10s %10s %8s" % ('benchmark', 'old (s)', 'new (s)', 'ratio')
+    regressions = []
+    names = sorted(set(old['benchmarks']) | set(new['benchmarks']))
+    for name in names:
+        if name not in old['benchmarks'] or name not in new['benchmarks']:
+            print "%-16s only in %s" % (name, 'old' if name in old['benchmarks'] else 'new')
+            continue
+        t_old = old['benchmarks'][name]['seconds']
+        t_new = new['benchmarks'][name]['seconds']
+        ratio = t_new / t_old if t_old else float('inf')
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  SLOWER'
+            regressions.append(name)
+        elif ratio < 1 - threshold:
+            flag = '  faster'
+        print "%-16s %10.3f %10.3f %8.2f%s" % (name, t_old, t_new, ratio, flag)
+    return regressions
+
+def main(argv=None):
+    if argv is None: argv = sys.argv
+    if len(argv) < 3:
+        print "Usage: %s old.json new.json [threshold]" % argv[0]
+        return 2
+    threshold = float(argv[3]) if len(argv) > 3 else 0.1
+    regressions = compare(load(argv[1]), load(argv[2]), threshold)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+#########
+# Notes #
+#########
+#
+# Deterministic generator for fake arxiv source trees laid out like
+# the S3 bulk data (data/yymm/aid.gz or aid.pdf), so that fetch and
+# scrape can be timed without the network.  The same seed and sizes
+# always give byte-for-byte identical files (gzip and tar timestamps
+# are fixed), so timings from different commits are comparable.
+#
+# Each paper is one of these kinds, in rotation:
+#   tex     gzipped single latex file
+#   tar     gzipped tar with a couple of latex files and lots of
+#           figures, style files, and a subdirectory
+#   pdf     pdf, not compressed
+#   dvi     gzipped dvi
+#   latin1  gzipped latex in latin-1
+#   utf16   gzipped latex in utf-16 with a BOM
+# plus one pathological gzipped postscript file of ps_mb megabytes,
+# like astro-ph/9505048.
+#
+# Usage:
+#   python benchmarks/corpus.py dir [n_papers [ps_mb]]
+#
+
+import sys, os, io, gzip, tarfile, random
+
+kinds = ('tex', 'tar', 'pdf', 'dvi', 'latin1', 'utf16')
+
+# The pathological paper
+ps_aid = 'astro-ph/9505048'
+
+words = ('the of and to in a is that we for with as by on this are from be '
+         'galaxy galaxies mass star formation redshift halo dark matter '
+         'luminosity function sample model observed $z\\sim 2$ $M_\\odot$ '
+         '\\citep{Springel05} \\ref{fig:mass} \\label{eq:1} \\emph{not}').split()
+
+def synthetic_paper(rand, n_lines=1500):
+    "Return the text of one fake latex paper"
+    lines = ['\\documentclass{aastex}\n', '\\begin{document}\n']
+    while len(lines) < n_lines:
+        roll = rand.random()
+        if roll < 0.02:
+            # block of commented out text
+            lines.extend('%' + ' '.join(rand.sample(words, 8)) + '\n'
+                         for ii in range(rand.randint(1, 10)))
+        elif roll < 0.05:
+            lines.append(' '.join(rand.sample(words, 10)) + ' % ' +
+                         ' '.join(rand.sample(words, 4)) + '\n')
+        elif roll < 0.06:
+            lines.append('a fraction of 10\\% of the ' +
+                         ' '.join(rand.sample(words, 6)) + '\n')
+        elif roll < 0.15:
+            lines.append('\n')
+        else:
+            lines.append(' '.join(rand.sample(words, 12)) + '\n')
+    lines.append('\\end{document}\n')
+    return u''.join(lines)
+
+def random_bytes(rand, n):
+    return bytes(bytearray(rand.getrandbits(8) for ii in range(n)))
+
+def gzip_bytes(data):
+    "Gzip data in memory with a fixed timestamp"
+    bf = io.BytesIO()
+    gf = gzip.GzipFile(filename='', mode='wb', fileobj=bf, mtime=0)
+    gf.write(data)
+    gf.close()
+    return bf.getvalue()
+
+def tar_bytes(members):
+    "Make a tar archive in memory from a list of (name, data)"
+    bf = io.BytesIO()
+    tf = tarfile.open(fileobj=bf, mode='w')
+    for name, data in members:
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = 0
+        tf.addfile(info, io.BytesIO(data))
+    tf.close()
+    return bf.getvalue()
+
+def paper_source(rand, kind):
+    "Return the contents of the source file for one paper, and its extension"
+    if kind == 'pdf':
+        return b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n' + random_bytes(rand, 200*1024), '.pdf'
+    if kind == 'dvi':
+        return gzip_bytes(b'\xf7\x02\x01\x83\x92\xc0\x1c;\x00\x00\x00\x00\x03\xe8' +
+                          b'\x1b TeX output 2014.04.01:1200\x8b' +
+                          random_bytes(rand, 100*1024)), '.gz'
+
+    text = synthetic_paper(rand)
+    if kind == 'tex':
+        return gzip_bytes(text.encode('ascii')), '.gz'
+    if kind == 'latin1':
+        return gzip_bytes((text + u'Caf\xe9 na\xefve \xc5ngstr\xf6m\n').encode('latin-1')), '.gz'
+    if kind == 'utf16':
+        return gzip_bytes((u'\ufeff' + text + u'Caf\xe9 \u03b1\n').encode('utf-16-le')), '.gz'
+    if kind == 'tar':
+        members = [('ms.tex', text.encode('ascii')),
+                   ('appendix.tex', synthetic_paper(rand, 300).encode('ascii')),
+                   ('aastex.cls', b'% class file\n' * 2000),
+                   ('refs.bbl', b'\\bibitem{x} Someone et al.\n' * 500)]
+        for ii in range(40):
+            members.append(('fig%02d.eps' % ii,
+                            b'%!PS-Adobe-3.0 EPSF-3.0\n' + random_bytes(rand, 8*1024)))
+        members.append(('figs/extra.tex', b'% not at the top level\n'))
+        return gzip_bytes(tar_bytes(members)), '.gz'
+    raise ValueError, "Unknown kind %s" % kind
+
+def paper_ids(n_papers):
+    """Return n_papers arxiv ids, split between old and new style ids.
+    There's room for about 3000."""
+    result = []
+    for ii in range(n_papers):
+        number = ii // 3 + 1
+        if ii % 3 == 0:
+            result.append('astro-ph/0701%03d' % number)
+        elif ii % 3 == 1:
+            result.append('hep-th/9912%03d' % number)
+        else:
+            result.append('1301.%04d' % number)
+    return result
+
+def file_name(aid, ext):
+    "Where a paper goes in the source tree, relative to the top"
+    if '/' in aid:
+        archive, number = aid.split('/')
+        return os.path.join(number[:4], archive + number + ext)
+    return os.path.join(aid[:4], aid + ext)
+
+def write(top, name, data):
+    fn = os.path.join(top, name)
+    if not os.path.isdir(os.path.dirname(fn)):
+        os.makedirs(os.path.dirname(fn))
+    with open(fn, 'wb') as ff:
+        ff.write(data)
+    return fn
+
+def write_postscript(top, ps_mb, rand):
+    """Write the pathological paper: ps_mb megabytes of postscript,
+    mostly hex image data, gzipped."""
+    fn = os.path.join(top, file_name(ps_aid, '.gz'))
+    if not os.path.isdir(os.path.dirname(fn)):
+        os.makedirs(os.path.dirname(fn))
+    # Image data that compresses about as well as the real thing.
+    block = b''.join(b''.join(b'%02x' % (rand.getrandbits(4) * 17)
+                              for jj in range(39)) + b'\n'
+                     for ii in range(1024))
+    ff = open(fn, 'wb')
+    gf = gzip.GzipFile(filename='', mode='wb', fileobj=ff, mtime=0)
+    try:
+        gf.write(b'%!PS-Adobe-2.0\n%%Creator: dvips\n%%Pages: 40\n')
+        written = 0
+        while written < ps_mb * 2**20:
+            gf.write(block)
+            written += len(block)
+        gf.write(b'showpage\n%%EOF\n')
+    finally:
+        gf.close()
+        ff.close()
+    return ps_aid
+
+def generate(top, n_papers=60, ps_mb=50, seed=1):
+    """Write a fake source tree under top.
+
+    Return a dict mapping arxiv id to the kind of paper.
+    """
+    rand = random.Random(seed)
+    result = {}
+    for ii, aid in enumerate(paper_ids(n_papers)):
+        kind = kinds[ii % len(kinds)]
+        data, ext = paper_source(rand, kind)
+        write(top, file_name(aid, ext), data)
+        result[aid] = kind
+    if ps_mb:
+        result[write_postscript(top, ps_mb, rand)] = 'ps'
+    return result
+
+def main(argv=None):
+    if argv is None: argv = sys.argv
+    top = argv[1]
+    n_papers = int(argv[2]) if len(argv) > 2 else 60
+    ps_mb = float(argv[3]) if len(argv) > 3 else 50
+    papers = generate(top, n_papers, ps_mb)
+    print "Wrote %d papers to %s" % (len(papers), top)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,202 @@
+#########
+# Notes #
+#########
+#
+# Offline benchmark suite.  Generates a fake source tree with
+# corpus.py (or reuses one given with -d), then times
+#   latex           fetch.latex on every paper but the pathological one
+#   latex_ps        fetch.latex on the 50 MB postscript paper
+#   write_output    scrape.write_output on the extracted latex
+#   arxiv_id_parse  parsing lots of distinct old and new style ids
+#   dir_enumerate   fetch.dir_to_arxiv_ids on a big yymm directory
+#                   and year_to_arxiv_id on the corpus
+# Each benchmark is run --repeat times and the best time is kept.
+# The results are written as JSON, and two result files (say, from
+# before and after a commit) can be compared with compare.py.
+#
+# Run from the top of the source tree:
+#   python benchmarks/run.py -o before.json
+#   (change things)
+#   python benchmarks/run.py -o after.json
+#   python benchmarks/compare.py before.json after.json
+#
+
+from __future__ import with_statement
+
+import sys, os, time, json, shutil, tempfile, subprocess, optparse, platform
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(bench_dir, '..', 'overheard'))
+
+import fetch, scrape, arxiv_id, path
+import corpus
+
+def run_times(func, repeat, setup=None):
+    "Run func repeat times, return the list of times in seconds"
+    times = []
+    for ii in range(repeat):
+        if setup: setup()
+        start = time.time()
+        func()
+        times.append(time.time() - start)
+    return times
+
+def result(times, items=None, nbytes=None):
+    "Summarize one benchmark"
+    best = min(times)
+    summary = dict(seconds=best, times=times)
+    if items is not None:
+        summary['items'] = items
+        summary['items_per_second'] = items / best if best else None
+    if nbytes is not None:
+        summary['bytes'] = nbytes
+        summary['mb_per_second'] = nbytes / 2.0**20 / best if best else None
+    return summary
+
+def source_bytes(aids):
+    return sum(os.path.getsize(fetch.source_file_path(aid)) for aid in aids)
+
+def bench_latex(aids, repeat):
+    def setup():
+        for aid in aids:
+            if os.path.exists(fetch.latex_file_path(aid)):
+                os.remove(fetch.latex_file_path(aid))
+    times = run_times(lambda: fetch.all_latex(aids), repeat, setup)
+    return result(times, len(aids), source_bytes(aids))
+
+def bench_write_output(aids, work_dir, repeat):
+    long_fn = os.path.join(work_dir, 'long.txt')
+    short_fn = os.path.join(work_dir, 'short.txt')
+    nbytes = sum(os.path.getsize(fetch.latex_file_path(aid)) for aid in aids)
+    times = run_times(lambda: scrape.write_output(aids, long_fn, short_fn), repeat)
+    return result(times, len(aids), nbytes)
+
+# Archives that old-style ids are made up for
+old_archives = ['astro-ph', 'hep-th', 'hep-ph', 'gr-qc', 'cond-mat', 'quant-ph']
+
+def add_months(yymm, n):
+    "The month n months after yymm"
+    months = (1900 + int(yymm[:2]) if yymm >= '91' else 2000 + int(yymm[:2]))*12 + \
+             int(yymm[2:]) - 1 + n
+    return '%02d%02d' % (months // 12 % 100, months % 12 + 1)
+
+def id_strings(n):
+    """n distinct arxiv ids, a mix of old and new style
+
+    Each id comes from its index without wrapping around, so there
+    are no repeats for the parse cache to hit.
+    """
+    result = []
+    for ii in range(n):
+        kk = ii // 2
+        if ii % 2:
+            month, number = divmod(kk, 9999)
+            result.append('%s.%04dv%d' % (add_months('0704', month), number + 1, 1 + kk % 3))
+        else:
+            kk, archive = divmod(kk, len(old_archives))
+            month, number = divmod(kk, 999)
+            result.append('%s/%s%03d' % (old_archives[archive], add_months('9108', month),
+                                         number + 1))
+    return result
+
+def bench_arxiv_id(n, repeat):
+    ids = id_strings(n)
+    def parse_all():
+        for aid in ids:
+            arxiv_id.yymm(aid)
+            fetch.file_name_base(aid)
+    times = run_times(parse_all, repeat, setup=arxiv_id.cache.clear)
+    return result(times, n)
+
+def make_big_dir(top, n):
+    "Make a yymm directory with n empty source files, return its name"
+    dir = os.path.join(top, '1302')
+    if not os.path.isdir(dir):
+        os.makedirs(dir)
+        for ii in range(n):
+            open(os.path.join(dir, '1302.%04d.gz' % ii), 'w').close()
+    return dir
+
+def bench_dir_enumerate(big_dir, n, repeat):
+    def enumerate_all():
+        fetch.dir_to_arxiv_ids(big_dir)
+        for year in ('99', '07', '13'):
+            fetch.year_to_arxiv_id(year, prefix=path.source)
+    times = run_times(enumerate_all, repeat)
+    return result(times, n)
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=bench_dir,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(options):
+    top = options.dir or tempfile.mkdtemp(prefix='overheard-bench')
+    source_dir = os.path.join(top, 'data')
+    if not os.path.isdir(source_dir):
+        print "Generating corpus in", source_dir
+        corpus.generate(source_dir, options.n_papers, options.ps_mb)
+    work_dir = tempfile.mkdtemp(prefix='overheard-bench-work')
+
+    saved = path.source, path.latex, fetch.verbose, scrape.verbose, fetch.manifest
+    path.source = source_dir
+    path.latex = os.path.join(work_dir, 'latex')
+    fetch.verbose = scrape.verbose = False
+    fetch.manifest = None
+    try:
+        aids = corpus.paper_ids(options.n_papers)
+        benchmarks = {}
+        print "latex"
+        benchmarks['latex'] = bench_latex(aids, options.repeat)
+        if options.ps_mb:
+            print "latex_ps"
+            benchmarks['latex_ps'] = bench_latex([corpus.ps_aid], options.repeat)
+        print "write_output"
+        benchmarks['write_output'] = bench_write_output(aids, work_dir, options.repeat)
+        print "arxiv_id_parse"
+        benchmarks['arxiv_id_parse'] = bench_arxiv_id(options.n_ids, options.repeat)
+        print "dir_enumerate"
+        big_dir = make_big_dir(os.path.join(top, 'enumerate'), options.n_files)
+        benchmarks['dir_enumerate'] = bench_dir_enumerate(big_dir, options.n_files,
+                                                          options.repeat)
+    finally:
+        path.source, path.latex, fetch.verbose, scrape.verbose, fetch.manifest = saved
+        shutil.rmtree(work_dir)
+        if not options.dir:
+            shutil.rmtree(top)
+
+    return dict(commit=git_commit(),
+                time=time.strftime('%Y-%m-%dT%H:%M:%S'),
+                python=platform.python_version(),
+                platform=platform.platform(),
+                parameters=dict(n_papers=options.n_papers, ps_mb=options.ps_mb,
+                                n_ids=options.n_ids, n_files=options.n_files,
+                                repeat=options.repeat),
+                benchmarks=benchmarks)
+
+def main(argv=None):
+    if argv is None: argv = sys.argv
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option('-o', '--output', default='bench.json',
+                      help="Write JSON results here")
+    parser.add_option('-d', '--dir',
+                      help="Keep the generated corpus in this directory and reuse it")
+    parser.add_option('-n', '--papers', dest='n_papers', type='int', default=60)
+    parser.add_option('--ps-mb', type='float', default=50,
+                      help="Size of the pathological postscript paper, 0 for none")
+    parser.add_option('--ids', dest='n_ids', type='int', default=100000)
+    parser.add_option('--files', dest='n_files', type='int', default=20000)
+    parser.add_option('-r', '--repeat', type='int', default=3)
+    options, args = parser.parse_args(argv[1:])
+
+    results = run(options)
+    for name, summary in sorted(results['benchmarks'].items()):
+        print "%-16s %8.3f s" % (name, summary['seconds'])
+    with open(options.output, 'w') as ff:
+        json.dump(results, ff, indent=1, sort_keys=True)
+    print "Results written to", options.output
+
+if __name__ == '__main__':
+    sys.exit(main())
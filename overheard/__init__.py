@@ -1 +1 @@
-import arxiv_id, fetch, path, scrape, update, test, util, overheard
+import arxiv_id, bulk, fetch, idset, journal, manifest, metrics, path, pipeline, records, scrape, shard, store, update, test, util, overheard
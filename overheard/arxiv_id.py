@@ -23,43 +23,129 @@ new_regexp = '^' + partial_new_regexp + '$'
 # For new-style identifiers, the regexp is set up to give the empty
 # string for the archive name
 
+compiled_partial_old_regexp = re.compile(partial_old_regexp)
+compiled_partial_new_regexp = re.compile(partial_new_regexp)
+
+# For parsing, the two are or'ed together after all, with different
+# group names on each branch so the re module doesn't complain.  One
+# search then tells both which kind of id it is and what the fields
+# are.
+combined_regexp = re.compile(
+    '^(?:(?P<old_archive>[-a-z]+)/(?P<old_yymm>[0-9]{4})(?P<old_number>[0-9]{3})'
+    '|(?P<new_yymm>[0-9]{4}).(?P<new_number>[0-9]{4}))'
+    '(?P<version>v[0-9]+)?$')
+
+class ArxivId(object):
+    """A parsed arxiv identifier.
+
+    The fields are strings: archive ('' for new-style ids), yymm,
+    number, and version ('' if not given).  Instances are immutable,
+    use parse() to get one so that each id is only parsed once.
+    """
+    __slots__ = ('aid', 'archive', 'yymm', 'number', 'version', 'is_new')
+
+    def __init__(self, aid):
+        match = combined_regexp.search(aid)
+        if not match: raise ValueError, 'Invalid arxiv id: %s' % aid
+        is_new = match.group('new_yymm') is not None
+        prefix = 'new_' if is_new else 'old_'
+        init = super(ArxivId, self).__setattr__
+        init('aid', aid)
+        init('is_new', is_new)
+        init('archive', match.group('old_archive') or '')
+        init('yymm', match.group(prefix + 'yymm'))
+        init('number', match.group(prefix + 'number'))
+        # the empty string rather than None if there's no version
+        # specified b/c this makes downstream code simpler.
+        init('version', match.group('version') or '')
+
+    def __setattr__(self, name, value):
+        raise AttributeError, "ArxivId is immutable"
+
+    def __delattr__(self, name):
+        raise AttributeError, "ArxivId is immutable"
+
+    def __eq__(self, other):
+        return isinstance(other, ArxivId) and self.aid == other.aid
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.aid)
+
+    def __str__(self):
+        return self.aid
+
+    def __repr__(self):
+        return 'ArxivId(%r)' % self.aid
+
+    @property
+    def is_old(self):
+        return not self.is_new
+
+    @property
+    def unversioned(self):
+        "The id without the version, ie, the paper rather than a revision"
+        if self.is_new:
+            return self.yymm + '.' + self.number
+        return self.archive + '/' + self.yymm + self.number
+
+# Parsed ids, keyed by the string.  The fetch and scrape code ask for
+# the fields of the same few ids over and over.
+cache = {}
+cache_size = 100000
+
+def parse(aid):
+    "Return the ArxivId for string aid, raise ValueError if it's not valid"
+    if isinstance(aid, ArxivId):
+        return aid
+    try:
+        return cache[aid]
+    except KeyError:
+        pass
+    result = ArxivId(aid)
+    if len(cache) >= cache_size:
+        cache.clear()
+    cache[aid] = result
+    return result
+
+def parse_or_none(aid):
+    "Return the ArxivId for string aid, or None if it's not valid"
+    try:
+        return parse(aid)
+    except ValueError:
+        return None
+
 def is_old(aid):
     "Is this an old-style arxiv id?"    
-    return re.search(old_regexp, aid)
+    parsed = parse_or_none(aid)
+    return parsed is not None and parsed.is_old
 
 def is_new(aid):
     "Is this an new-style arxiv id?"
-    return re.search(new_regexp, aid)
+    parsed = parse_or_none(aid)
+    return parsed is not None and parsed.is_new
 
 def archive(aid):
     "Extract the archive name from the arxiv id"
-    match = (re.search(new_regexp, aid) or re.search(old_regexp, aid))
-    if not match: raise ValueError, 'Invalid arxiv id: %s' % aid
-    return match.group(1)
+    return parse(aid).archive
 
 def yymm(aid):
     "Extract the year and month from the arxiv id"
-    match = (re.search(new_regexp, aid) or re.search(old_regexp, aid))
-    if not match: raise ValueError, 'Invalid arxiv id: %s' % aid
-    return match.group(2)
+    return parse(aid).yymm
 
 def number(aid):
     "Extract the serial number from the arxiv id"
-    match = (re.search(new_regexp, aid) or re.search(old_regexp, aid))
-    if not match: raise ValueError, 'Invalid arxiv id: %s' % aid
-    return match.group(3)
+    return parse(aid).number
 
 def version(aid):
     "Extract the paper version from the arxiv id"
-    match = (re.search(new_regexp, aid) or re.search(old_regexp, aid))
-    if not match: raise ValueError, 'Invalid arxiv id: %s' % aid
-    # return the empty string rather than None if there's no version
-    # specified b/c this makes downstream code simpler.
-    return match.group(4) or ''
+    return parse(aid).version
  
 def extract_aid(ss):
     """Extract the first valid arxiv id from string ss"""
-    match = (re.search(partial_new_regexp, ss) or 
-             re.search(partial_old_regexp, ss) or 
+    match = (compiled_partial_new_regexp.search(ss) or 
+             compiled_partial_old_regexp.search(ss) or 
              None)
     return match.group(0) if match else None
@@ -0,0 +1,187 @@
+#########
+# Notes #
+#########
+#
+# Reprocessing a big piece of the archive (say, a few years of the S3
+# mirror that's already sitting in data/): extract the latex and
+# scrape the comments for every paper in some range of months, using
+# all the cores, and write the comments somewhere.  Each paper is
+# extracted and scraped by the same worker process, so nothing waits
+# for a pass over the whole corpus to finish.  Progress and an ETA
+# are printed as it goes (see util.Progress).
+#
+# Months are given as yymm or yymm-yymm.  Ranges can cross the
+# century: 9901-0312 is 1999 through 2003.
+#
+# The archive filter only applies to old-style ids
+# (astro-ph/0701019).  New-style ids (0704.0001 on) don't say which
+# archive a paper is in, so they always pass.
+#
+# Where the comments go depends on the name of the output:
+#   name.db                    a comment store (see store.py)
+#   name.jsonl, name.jsonl.gz  a record file (see records.py)
+#   anything else              flat files name-long.tex and name-short.tex
+# Papers are written in the order they're listed, whatever order the
+# workers finish them in.
+#
+# If fetch.manifest is set (--manifest on the command line), the
+# papers in each month come from it rather than from listing the
+# source tree, and it's refreshed at the end of the run.
+#
+# Usage:
+#   failures = bulk.run(bulk.month_aids([('9901', '0312')], archives=['astro-ph']),
+#                       '1999-2003.jsonl.gz', processes=8)
+# or from the command line:
+#   python overheard.py bulk 9901-0312 -a astro-ph -j 8 -o 1999-2003.jsonl.gz
+#
+
+from __future__ import with_statement
+
+import os, re, multiprocessing
+
+import path, fetch, scrape, store, records, metrics, util
+
+# Papers handed to a worker at a time
+chunksize = 16
+
+# Commit to a store output every this many papers
+commit_interval = 500
+
+def parse_months(spec):
+    "Turn 'yymm' or 'yymm-yymm' into a (first, last) pair"
+    match = re.match('^([0-9]{4})(?:-([0-9]{4}))?$', spec)
+    if not match:
+        raise ValueError, "Months should look like 1401 or 1401-1412: %s" % spec
+    first, last = match.group(1), match.group(2) or match.group(1)
+    if fetch.yymm_key(first) > fetch.yymm_key(last):
+        raise ValueError, "Months out of order: %s" % spec
+    return first, last
+
+def month_aids(months, archives=None, prefix=None):
+    """All arxiv ids with source files in the given months.
+
+    months is a list of (first, last) pairs, archives a list of
+    archive names to keep (None for all).  prefix is the source tree,
+    path.source by default.  Return the ids in chronological order.
+    """
+    if prefix is None: prefix = path.source
+    if not os.path.isdir(prefix):
+        return []
+    return list(fetch.iter_arxiv_ids(prefix, months=months, archives=archives))
+
+class FlatOutput(object):
+    "prefix-long.tex and prefix-short.tex, like write_output()"
+    def __init__(self, prefix):
+        self.l_outf = open(prefix + '-long.tex', 'w')
+        self.s_outf = open(prefix + '-short.tex', 'w')
+
+    def write(self, aid, l_comments, s_comments):
+        scrape.write_comments(aid, self.l_outf, self.s_outf, l_comments, s_comments)
+
+    def close(self):
+        self.l_outf.close()
+        self.s_outf.close()
+
+class RecordOutput(object):
+    "A record file, gzipped if the name ends with .gz"
+    def __init__(self, fn):
+        self.ff = records.open_records(fn, 'wb')
+
+    def write(self, aid, l_comments, s_comments):
+        records.write_record(self.ff, aid, l_comments, s_comments)
+
+    def close(self):
+        self.ff.close()
+
+class StoreOutput(object):
+    "A comment store"
+    def __init__(self, fn):
+        self.conn = store.connect(fn)
+        self.n_written = 0
+
+    def write(self, aid, l_comments, s_comments):
+        store.add_paper(self.conn, aid, l_comments, s_comments)
+        self.n_written += 1
+        if self.n_written % commit_interval == 0:
+            self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+def open_output(name):
+    "Open the output that name refers to (see the notes at the top)"
+    if name.endswith('.db'):
+        return StoreOutput(name)
+    if name.endswith('.jsonl') or name.endswith('.jsonl.gz'):
+        return RecordOutput(name)
+    return FlatOutput(name)
+
+def worker_init():
+    fetch.quiet_worker()
+    scrape.verbose = False
+
+def worker(args):
+    """Extract and scrape one paper in a worker process.
+
+    args is the arxiv id and the force flag for fetch.latex().
+    Return the arxiv id, the size of the source file, whether the
+    latex was extracted, the comments, and an error message or None.
+    """
+    aid, force = args
+    try:
+        nbytes = os.path.getsize(fetch.source_file_path(aid))
+        extracted = fetch.latex(aid, force=force)
+    except Exception, exc:
+        return aid, 0, False, None, 'extract: %s: %s' % (type(exc).__name__, exc)
+    try:
+        comments = scrape.comments(aid)
+    except Exception, exc:
+        return aid, nbytes, extracted, None, 'scrape: %s: %s' % (type(exc).__name__, exc)
+    return aid, nbytes, extracted, comments, None
+
+def run(aids, output, processes=None, force=False, report_interval=10):
+    """Extract and scrape aids with a pool of processes, write the
+    comments to output (a name, see open_output).
+
+    processes defaults to the number of cores.  Latex that's up to
+    date isn't extracted again unless force is True.  Progress is
+    printed every report_interval seconds.
+
+    Return a dict mapping arxiv ids that failed to the error message.
+    """
+    aids = list(aids)
+    failures = {}
+    progress = util.Progress(total=len(aids), interval=report_interval)
+    outf = open_output(output)
+    pool = multiprocessing.Pool(processes, initializer=worker_init)
+    # Metrics recorded in the worker processes are lost, so count
+    # here.
+    try:
+        with metrics.timer('bulk'):
+            for aid, nbytes, extracted, comments, error in \
+                    pool.imap(worker, ((aid, force) for aid in aids), chunksize=chunksize):
+                if error:
+                    failures[aid] = error
+                    print "Failed", aid, error
+                    metrics.failure(aid, error.split(':')[0], error)
+                else:
+                    metrics.count('papers_extracted' if extracted else 'latex_up_to_date')
+                    metrics.count('papers_scraped')
+                    outf.write(aid, *comments)
+                progress.update(nbytes)
+    except BaseException:
+        # Don't wait for the papers that are still queued
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+        outf.close()
+    if fetch.manifest is not None:
+        # The workers don't tell the manifest about the latex they write
+        fetch.manifest.refresh()
+    progress.report(final=True)
+    if failures: print len(failures), "papers failed"
+    return failures
@@ -41,7 +41,7 @@
 #
 # Thus when you ask for the name of the data file associated with an
 # arxiv id, you may want it without an extension (if it was downloaded
-# via wget and you want to put the appropriate extension on), or you
+# from arxiv.org and you want to put the appropriate extension on), or you
 # may want it _with_ the extension (in which case the code must look
 # to see if it's a pdf or gz file, and give you the correct filename).
 # 
@@ -57,6 +57,10 @@
 # sometimes -- files are listed as C++, plain text (when they're
 # latex), or even 'data'.  As long as the output of 'file' has the
 # word 'text' in it, I treat it as latex.  
+#
+# These days 'file' itself isn't called anymore: file_type() below
+# looks at the magic bytes at the start of the file and makes the same
+# decisions that the regexps on the output of 'file' used to make.
 # 
 # The problem with files not being recognized as latex after
 # gunzipping apparently has to do with text encodings.  Here are a few
@@ -94,22 +98,41 @@
 # ./1204/1204.0258.pdf: data
 # 
 # It takes ~5.5 min to just gunzip everything and untar everything via
-# the shell for one month's sumbissions.  takes ~10 min to do it via
-# python code.  I find this acceptable.
+# the shell for one month's sumbissions.  It used to take ~10 min to
+# do it via python code that copied each file to a temp dir and called
+# gunzip, tar, and cat.  Now the source file is decompressed and
+# untarred as a stream and the latex goes straight to the output file,
+# so nothing but latex is ever written to disk and there are no
+# processes to start.  Gzipped latex and tar files inside the tar file
+# are looked into the same way (see extract_tar_latex), and figures,
+# data, and anything else that isn't latex only cost the time to read
+# past them.
 # 
 
 from __future__ import with_statement
 
-import sys, os, subprocess, tempfile, shutil, re, time
+import sys, os, io, subprocess, shutil, re, time, zlib, tarfile
+import threading, Queue, socket, httplib, urlparse, multiprocessing
+
+import path, util, arxiv_id, metrics, shard
 
-import path, util, arxiv_id
+# Listing a yymm directory of the archive with scandir doesn't build
+# the whole list first, and it's built into Python 3.5 and later.
+# Otherwise try the scandir package, otherwise listdir.
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 # Interactive use/testing more or less requires that fetch.user_agent
 # be set to something here in the source file.  However, I don't want
 # other people hammering arxiv.org with a user agent string that looks
 # like it's me.  Therefore the arg parsing code in overheard.py sets
 # fetch.user_agent to None if the value isn't provided on the command
-# line.  That triggers an error message if wget is called.
+# line.  That triggers an error message when downloading.
 
 user_agent = 'overheard'
 
@@ -122,6 +145,11 @@ verbose = True
 
 dir_prefix = arxiv_id.yymm
 
+# If this is set to a manifest.Manifest, questions about which files
+# exist are answered by the manifest rather than by looking at the
+# filesystem, and the manifest is told about new files.
+manifest = None
+
 def extension(fn):
     "Get the extension of a filename"
     return os.path.splitext(fn)[1][1:]
@@ -140,17 +168,21 @@ def ensure_dirs_exist(path_name):
     """    
     dir, fn = os.path.split(path_name)
     if not os.path.isdir(dir):
-        os.makedirs(dir)
+        try:
+            os.makedirs(dir)
+        except OSError:
+            # Another thread or process may have just created it
+            if not os.path.isdir(dir): raise
     
+# Where to get source files.  Tests point this at a local server.
+base_url = "http://arxiv.org/e-print/"
+
 def arxiv_to_url(aid):
     "Get the URL to download the source file for a paper"
-    return "http://arxiv.org/e-print/" + aid
-
-def fetch_command(aid, fn):    
-    "Give the command to fetch latex source file"
-    # Explicitly give the output file name because old-style arxiv
-    # id's result in files like 9901012 that lack the archive name.
+    return base_url + aid
 
+def check_user_agent():
+    "Make sure the user agent string is set before talking to arxiv.org"
     if user_agent is None:        
         print >> sys.stderr, "User agent string not set.  Arxiv.org blocks requests with the user"
         print >> sys.stderr, "agent string wget.  You must set a different one like this:"
@@ -159,29 +191,133 @@ def fetch_command(aid, fn):
         print >> sys.stderr
         sys.exit(1)
 
-    return (["wget",  "-U '%s'" % user_agent, 
-             "--output-document", fn] + 
-            ([] if verbose else ["--output-file", "/dev/null"]) + 
-            [arxiv_to_url(aid)])
-            
-def untar_command(fn):
-    "Give the command extract a tar archive."    
-    return ["tar",  "xf", fn]
+# Downloads are done with httplib rather than by running wget so that
+# each paper doesn't cost a process and a fresh TCP connection.  Each
+# thread keeps its connections open between requests.
+
+http_timeout = 60
+http_retries = 3
+http_redirects = 5
+
+connections = threading.local()
+
+def connection(scheme, netloc, fresh=False):
+    "Get this thread's connection to a server, making one if necessary"
+    pool = connections.__dict__.setdefault('pool', {})
+    key = (scheme, netloc)
+    if fresh and key in pool:
+        pool.pop(key).close()
+    if key not in pool:
+        if scheme == 'https':
+            pool[key] = httplib.HTTPSConnection(netloc, timeout=http_timeout)
+        else:
+            pool[key] = httplib.HTTPConnection(netloc, timeout=http_timeout)
+    return pool[key]
 
-def gunzip_command(fn):
-    "Give the command to decompress a gzip file."    
-    return ["gunzip",  fn]
+def http_get(url, headers):
+    "GET url on a kept-alive connection, following redirects"
+    for ii in range(http_redirects + 1):
+        scheme, netloc, url_path, query, fragment = urlparse.urlsplit(url)
+        selector = url_path + ('?' + query if query else '')
+        try:
+            conn = connection(scheme, netloc)
+            conn.request('GET', selector, headers=headers)
+            response = conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            # The server may have closed a kept-alive connection
+            # since it was last used.  Try once more on a new one.
+            conn = connection(scheme, netloc, fresh=True)
+            conn.request('GET', selector, headers=headers)
+            response = conn.getresponse()
+
+        if response.status in (301, 302, 303, 307, 308):
+            location = response.getheader('location')
+            response.read()
+            url = urlparse.urljoin(url, location)
+        else:
+            return response
+    raise IOError, "Too many redirects for %s" % url
+
+def download(url, fn):
+    """Download url to fn.
+
+    If fn already exists, it's taken to be a partial download and
+    only the rest of the file is requested.  Interrupted transfers are
+    retried the same way, so nothing is ever downloaded twice.  The
+    ETag/Last-Modified of the file is kept in fn + '.validator' so a
+    partial file is only extended if the file on the server hasn't
+    changed in the meantime.
+    """
+    validator_fn = fn + '.validator'
+    for attempt in range(http_retries):
+        try:
+            download_attempt(url, fn, validator_fn)
+            break
+        except (httplib.HTTPException, socket.error), exc:
+            if attempt == http_retries - 1: raise
+            if verbose: print "Retrying", url, "after", repr(exc)
+            connection(*urlparse.urlsplit(url)[:2], fresh=True)
+    if os.path.exists(validator_fn):
+        os.remove(validator_fn)
+
+def download_attempt(url, fn, validator_fn):
+    "Make one attempt to download the rest of url to fn"
+    headers = {'User-Agent': user_agent, 'Accept-Encoding': 'identity'}
+
+    offset = os.path.getsize(fn) if os.path.exists(fn) else 0
+    if offset and os.path.exists(validator_fn):
+        with open(validator_fn) as ff:
+            headers['If-Range'] = ff.read().strip()
+        headers['Range'] = 'bytes=%d-' % offset
+
+    response = http_get(url, headers)
+    if response.status == 416:
+        # The partial file is already the whole thing
+        response.read()
+        return
+    elif response.status == 206:
+        mode = 'ab'
+        content_range = response.getheader('content-range', '')
+        if not content_range.startswith('bytes %d-' % offset):
+            response.read()
+            raise IOError, "Bad Content-Range %s for %s" % (content_range, url)
+    elif response.status == 200:
+        # Either nothing was there to resume, or the file changed
+        mode = 'wb'
+        validator = (response.getheader('etag') or 
+                     response.getheader('last-modified'))
+        if validator:
+            with open(validator_fn, 'w') as ff:
+                ff.write(validator)
+        elif os.path.exists(validator_fn):
+            os.remove(validator_fn)
+    else:
+        response.read()
+        raise IOError, "HTTP error %d for %s" % (response.status, url)
+
+    # httplib doesn't complain if the connection drops early, so
+    # check the length by hand.
+    expected = response.getheader('content-length')
+    received = 0
+    with open(fn, mode) as ff:
+        while True:
+            data = response.read(read_size)
+            if not data: break
+            ff.write(data)
+            received += len(data)
+    metrics.count('bytes_downloaded', received)
+    if expected is not None and received < int(expected):
+        raise httplib.IncompleteRead(b'', int(expected) - received)
 
 def file_name_base(aid):
     "Name of latex/source file for an arxiv id without the extension"
-    if arxiv_id.is_new(aid): 
-        fn_base = aid
+    parsed = arxiv_id.parse(aid)
+    if parsed.is_new: 
+        fn_base = str(parsed)
     else: 
-        # Ugh, four function calls when I could just grab the regexp
-        # match object and pull out what I want.  And all of this is
-        # just to get rid of the slash in the identifier
-        fn_base = (arxiv_id.archive(aid) + arxiv_id.yymm(aid) + 
-                   arxiv_id.number(aid) + arxiv_id.version(aid))
+        # All of this is just to get rid of the slash in the identifier
+        fn_base = (parsed.archive + parsed.yymm + 
+                   parsed.number + parsed.version)
     return fn_base
 
 def latex_file_name(aid):
@@ -192,6 +328,25 @@ def latex_file_path(aid):
     "Full path to the latex file"
     return os.path.join(path.latex, dir_prefix(aid), latex_file_name(aid))
 
+def open_latex(aid):
+    """Open the latex for aid for reading (in binary mode).
+
+    This is the loose file in the latex tree if there is one, and
+    otherwise the paper's entry in the shard for its month (see
+    shard.py).  Raise IOError if there's neither.
+    """
+    fn = latex_file_path(aid)
+    try:
+        return open(fn, 'rb')
+    except IOError:
+        data = shard.read_latex(aid)
+        if data is None: raise
+        return io.BytesIO(data)
+
+def latex_exists(aid):
+    "Is there latex for aid, either loose or in a shard?"
+    return os.path.exists(latex_file_path(aid)) or shard.has_latex(aid)
+
 def source_file_name(aid):
     "Name of source file"
     ext = source_file_extension(aid)
@@ -222,6 +377,9 @@ def source_file_extension(aid):
     Return False if the file doesn't exist.
 
     """
+    if manifest is not None:
+        return manifest.source_extension(aid)
+
     valid_extensions = ['.gz', '.pdf']
 
     paths = [source_file_path_without_extension(aid) + ext 
@@ -238,7 +396,10 @@ def source_file_extension(aid):
 
 def file_type_string(fn):
     "Return the output of the 'file' command"
-
+    # This is no longer used to decide what to do with a file (see
+    # file_type() below), but it's handy when poking at weird files
+    # interactively.
+    metrics.count('subprocess_calls')
     pipe = subprocess.Popen(["file", fn], stdout=subprocess.PIPE)
     stdout, stderr = pipe.communicate()
     # Hmm... I finally have to learn something about string encodings.
@@ -247,71 +408,236 @@ def file_type_string(fn):
     # ok...
     return stdout.decode('utf-8')
 
-def is_tar(fn):
+# Forking 'file' several times per paper adds up to hundreds of
+# thousands of processes for a month of bulk data, so the file type is
+# determined in-process by looking at the first few bytes of the file.
+# The possible results are the strings below.  The decisions are meant
+# to agree with the regexps that used to be applied to the output of
+# 'file':
+#   'tar archive'           -> 'tar'
+#   'gzip compressed data'  -> 'gzip'
+#   'pdf document'          -> 'pdf'
+#   'tex dvi'               -> 'dvi'
+#   'postscript'            -> 'postscript' (not latex, even though
+#                              'file' says 'PostScript document text')
+#   'text|latex'            -> 'text'
+# Everything else is 'data'.
+
+sniff_size = 8192
+
+# Bytes that 'file' accepts in a text file: BEL, BS, tab, newline,
+# VT, FF, CR, ESC, printable ascii and anything with the high bit set
+# (ISO-8859-x, utf-8, and 'Non-ISO extended-ASCII' text).
+text_bytes = bytes(bytearray([7, 8, 9, 10, 11, 12, 13, 27] + 
+                             list(range(32, 127)) + list(range(128, 256))))
+
+utf16_boms = (b'\xff\xfe', b'\xfe\xff')
+
+def is_tar_header(data):
+    "Is data the header block of a tar archive?"
+    if len(data) < 512:
+        return False
+    # POSIX (ustar\000) and GNU (ustar  \0) archives have a magic
+    # string, old V7 archives only have the header checksum.
+    if data[257:262] == b'ustar':
+        return True
+    try:
+        checksum = int(data[148:156].strip(b' \x00') or b'x', 8)
+    except ValueError:
+        return False
+    # The checksum is computed with the checksum field set to spaces
+    header = bytearray(data[:512])
+    header[148:156] = b' ' * 8
+    return checksum == sum(header)
+
+def sniff(data):
+    "Determine the file type from the first few bytes of a file"
+    if data.startswith(b'%PDF-'):
+        return 'pdf'
+    elif data.startswith(b'\x1f\x8b'):
+        return 'gzip'
+    elif is_tar_header(data):
+        return 'tar'
+    elif data.startswith(b'\xf7\x02'):
+        return 'dvi'
+    elif data.startswith(b'%!') or data.startswith(b'\x04%!'):
+        return 'postscript'
+    elif data.startswith(utf16_boms):
+        return 'text'
+    elif data and not data.translate(None, text_bytes):
+        return 'text'
+    return 'data'
+
+# Results of file_type() for files that have already been looked at,
+# keyed by file name.  The size and mtime are kept to notice when the
+# file has changed.
+file_type_cache = {}
+file_type_cache_size = 10000
+
+def file_type(fn):
+    "Return the type of a file as determined by sniff()"
+    metrics.count('file_type_calls')
+    st = os.stat(fn)
+    cached = file_type_cache.get(fn)
+    if cached and cached[:2] == (st.st_size, st.st_mtime):
+        metrics.count('file_type_cache_hits')
+        return cached[2]
+
+    with open(fn, 'rb') as ff:
+        result = sniff(ff.read(sniff_size))
+
+    if len(file_type_cache) >= file_type_cache_size:
+        file_type_cache.clear()
+    file_type_cache[fn] = (st.st_size, st.st_mtime, result)
+    return result
+
+# The predicates below take an optional ftype argument so that
+# callers who have already classified a file can pass the result
+# along rather than looking at the file again.
+
+def is_tar(fn, ftype=None):
     "Is this a tar file?"
-    return re.search('tar archive', file_type_string(fn), re.I)
+    return (ftype or file_type(fn)) == 'tar'
 
-def is_gzip(fn):
+def is_gzip(fn, ftype=None):
     "Is this a gzip file?"
-    return re.search('gzip compressed data', file_type_string(fn), re.I)
+    return (ftype or file_type(fn)) == 'gzip'
 
-def is_pdf(fn):
+def is_pdf(fn, ftype=None):
     "Is this a pdf file?"
-    return re.search('pdf document', file_type_string(fn), re.I)
+    return (ftype or file_type(fn)) == 'pdf'
 
-def is_tex(fn):
+def is_tex(fn, ftype=None):
     "Is this a latex file?"
-    # Accept anything with the word 'text' or LaTeX in it, but does
-    # _not_ have Postscript in it.  Postscript has %'s in it and the
-    # regexp I use for short comments apparently breaks for big files,
-    # ie, astro-ph/9505048.  That postscript file is pathological,
-    # though, it's ~50 MB of only f's.
-    return (re.search('text|latex', file_type_string(fn), re.I) and not 
-            re.search('postscript', file_type_string(fn), re.I))
-
-def is_other(fn):
+    # Accept anything that looks like text, but _not_ Postscript.
+    # Postscript has %'s in it and the regexp I use for short comments
+    # apparently breaks for big files, ie, astro-ph/9505048.  That
+    # postscript file is pathological, though, it's ~50 MB of only
+    # f's.
+    return (ftype or file_type(fn)) == 'text'
+
+def is_other(fn, ftype=None):
     "Is this some file that we recognize but don't do anything with?"
     # File types that are known, but that we can't do anything with
     # This is so if a file type is totally unknown, we can print a
     # message and catch it.
-    return re.search('tex dvi', file_type_string(fn), re.I)
+    return (ftype or file_type(fn)) == 'dvi'
+
+class TokenBucket(object):
+    """Rate limiter that can be shared between threads.
+
+    Tokens accumulate at rate per second up to capacity, and each
+    request to arxiv.org takes one.  Everything else (writing files,
+    figuring out file types, waiting on the network) happens outside
+    the limiter, so it overlaps with the wait for the next token.
+    """
 
-def all_source(aids, delay=60, force=False):
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last = time.time()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        "Wait until a token is available and take it."
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.capacity, 
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+@metrics.timed('download')
+def all_source(aids, delay=60, force=False, threads=4):
     """Fetch the source files for all of the given arxiv ids.
     
-    delay is delay in seconds between fetching papers from arxiv.org
+    delay is the minimum time in seconds between requests to arxiv.org
     force=True disables caching of papers
+    threads is the number of downloads that may be in progress at once
+
+    A paper that can't be downloaded (withdrawn, PDF only, network
+    trouble) is reported and skipped.  Return True if anything was
+    downloaded.
     """
-    any_fetched = False
+    limiter = TokenBucket(1.0/delay) if delay > 0 else None
+    queue = Queue.Queue()
     for aid in aids:
-        wait = source(aid, force=force)
-        if wait:
-            any_fetched = True
-            time.sleep(delay)
-    return any_fetched
+        queue.put(aid)
+
+    fetched = []
+    errors = []
+    def worker():
+        while not errors:
+            try:
+                aid = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                fetched.append(source(aid, force=force, limiter=limiter))
+            except Exception, exc:
+                # One missing paper shouldn't stop the rest.  A
+                # partial download stays in place for next time.
+                print "WARNING: Couldn't download", aid, exc
+                metrics.failure(aid, 'download', str(exc))
+            except BaseException:
+                # Hand the exception to the main thread, which
+                # re-raises it after everyone has stopped.
+                errors.append(sys.exc_info())
+
+    workers = [threading.Thread(target=worker) 
+               for ii in range(max(1, min(threads, queue.qsize())))]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
 
-def source(aid, force=False):    
-    "Get source file from archive.org unless we already have it"
+    if errors:
+        exc_type, exc_value, exc_tb = errors[0]
+        raise exc_type, exc_value, exc_tb
+    return any(fetched)
+
+def source(aid, force=False, limiter=None):    
+    """Get source file from archive.org unless we already have it
+
+    If limiter is given, it's a TokenBucket that's consulted before
+    making the request.  Cached papers don't count against the limit.
+
+    Return True if the file was downloaded.
+    """
 
     if not force and source_file_exists(aid):
         if verbose: print "Using cached source file for", aid
+        metrics.count('source_cache_hits')
         return False
     else:
-        # Interrupted downloads leave partial files laying around.
-        # Download to temp directory, then rename to final filename to
-        # avoid polluting the archive.
-        tf = tempfile.NamedTemporaryFile()
-        subprocess.call(fetch_command(aid, tf.name))
+        if limiter: limiter.acquire()
+
+        check_user_agent()
+        if verbose: print "Downloading", aid
 
+        # Interrupted downloads leave partial files laying around.
+        # Download to a .part file, then rename to the final filename
+        # to avoid polluting the archive.  Since the .part file is in
+        # the archive, the next attempt picks up where this one left
+        # off.
         source_base = source_file_path_without_extension(aid)
+        part_fn = source_base + '.part'
         ensure_dirs_exist(source_base)
-        # copy file to have correct extension.  User copy rather than
-        # move so the system can happily delete the temp file when
-        # it's closed.
-        if is_pdf(tf.name):
-            shutil.copy(tf.name, source_base + '.pdf')
-        elif is_gzip(tf.name):
-            shutil.copy(tf.name, source_base + '.gz')
+        download(arxiv_to_url(aid), part_fn)
+
+        # rename file to have correct extension.
+        ftype = file_type(part_fn)
+        if is_pdf(part_fn, ftype):
+            ext = '.pdf'
+        elif is_gzip(part_fn, ftype):
+            ext = '.gz'
         else:
             # This should/would be an exception, but it occurs
             # when downloading the new astro-ph files for the day.
@@ -321,91 +647,404 @@ def source(aid, force=False):
             # 
             # raise RuntimeError, "Unrecognized file %s" % aid
             print "WARNING: Unrecognized file type for", aid
+            metrics.failure(aid, 'unrecognized download', ftype)
+            os.remove(part_fn)
+            return True
+
+        os.rename(part_fn, source_base + ext)
+        if manifest is not None:
+            manifest.add_source(aid, source_base + ext, ftype)
+        metrics.count('papers_downloaded')
         return True
 
-def all_latex(aids):
-    """Extract latex from all arxiv ids given."""
+@metrics.timed('extract')
+def all_latex(aids, force=False):
+    """Extract latex from all arxiv ids given.
+
+    force=True extracts even if the latex is up to date (see latex_is_current)
+    Return the number of papers extracted.
+    """
+    n_extracted = n_skipped = 0
     for aid in aids:
-        latex(aid)
+        if latex(aid, force=force):
+            n_extracted += 1
+        else:
+            n_skipped += 1
+    if verbose and n_skipped:
+        print "Skipped", n_skipped, "papers with up to date latex"
+    return n_extracted
+
+def latex_is_current(aid):
+    """Is the latex file for aid newer than the source file?
 
-def latex(aid):
-    "Get latex out of source file"
+    The latex file is written after the source file is complete, and
+    downloading the source again makes it newer, so comparing mtimes
+    is enough to tell whether it has to be extracted again.
+    """
+    if manifest is not None and manifest.latex_status(aid) == 'current':
+        return True
+    try:
+        source_mtime = os.path.getmtime(source_file_path(aid))
+    except OSError:
+        return False
+    if os.path.exists(latex_file_path(aid)):
+        return os.path.getmtime(latex_file_path(aid)) >= source_mtime
+    # Packed latex is as new as the shard
+    return (shard.has_latex(aid) and 
+            os.path.getmtime(shard.shard_path(dir_prefix(aid))) >= source_mtime)
+
+def latex(aid, force=False):
+    """Get latex out of source file unless the latex is up to date.
+
+    force=True extracts it anyway.  Return True if the latex was
+    extracted.
+    """
 
     if not source_file_exists(aid):
         # could just try to grab the file from arxiv.org here.  
         raise ValueError, "File not found for %s!" % aid 
 
-    path_name = source_file_path(aid)
-    tmpdir = tempfile.mkdtemp()    
+    if not force and latex_is_current(aid):
+        if verbose: print "Using existing latex for", aid
+        metrics.count('latex_up_to_date')
+        return False
+
+    # If there are no latex files, an empty file should be generated
+    # to avoid later file not found errors.  Write to a temp name and
+    # rename so that an interrupted extraction doesn't leave a
+    # truncated latex file behind.
+    latex_fn = latex_file_path(aid)
+    part_fn = latex_fn + '.part'
+    ensure_dirs_exist(latex_fn)
     try:
-        shutil.copy(path_name, tmpdir)    
-        with util.remember_cwd():
-            # All of this is taking place in a temp dir, so I only want
-            # filenames, not paths.
-            os.chdir(tmpdir)
-
-            base_fn = file_name_base(aid)
-            ext_fn = source_file_name(aid)
-
-            # gunzip if necessary
-            if is_gzip(ext_fn):
-                if verbose: print "Decompressing", aid            
-                subprocess.call(gunzip_command(ext_fn))
-
-            if is_tex(base_fn):
-                # if it's a tex file, rename to correct extension
-                shutil.move(base_fn, base_fn + '.tex')
-            elif is_tar(base_fn):
-                # if it's a tar file, extract
-                if verbose: print "Extracting", aid            
-                subprocess.call(untar_command(base_fn))
-            elif is_pdf(ext_fn):
-                # pdf files still have extension, so look at the filename
-                # with extension.
-                pass
-            elif is_other(base_fn):
-                # Everything except pdf files has been decompressed, so
-                # look at the filename without the extension.
-                pass
+        with open(source_file_path(aid), 'rb') as inf:
+            with open(part_fn, 'wb') as outf:
+                try:
+                    extract_latex(aid, inf, outf)
+                except (zlib.error, tarfile.TarError, EOFError), exc:
+                    # gunzip and tar would have complained and carried
+                    # on with whatever they got out of the file.
+                    print "WARNING: Corrupt source file for", aid, exc
+                    metrics.failure(aid, 'corrupt source', str(exc))
+        os.rename(part_fn, latex_fn)
+        if manifest is not None:
+            manifest.add_latex(aid, latex_fn)
+        metrics.count('papers_extracted')
+    finally:
+        if os.path.exists(part_fn):
+            os.remove(part_fn)
+    return True
+
+def extract_latex(aid, inf, outf):
+    """Write the latex contained in source file object inf to outf.
+
+    This works on streams: nothing is decompressed to disk, and
+    nothing other than latex is written anywhere.
+    """
+    head = inf.read(sniff_size)
+    ftype = sniff(head)
+    if ftype == 'gzip':
+        if verbose: print "Decompressing", aid            
+        stream = GunzipReader(PrefixedReader(head, inf))
+        head = stream.read(sniff_size)
+        ftype = sniff(head)
+        stream = PrefixedReader(head, stream)
+
+        if ftype == 'text':
+            shutil.copyfileobj(stream, outf, read_size)
+        elif ftype == 'tar':
+            if verbose: print "Extracting", aid            
+            extract_tar_latex(stream, outf)
+        elif ftype == 'dvi':
+            pass
+        else:
+            print "WARNING: Unknown file type: ", ftype, aid
+            metrics.failure(aid, 'unknown type', ftype)
+    elif ftype == 'pdf':
+        # pdf files are not compressed, nothing to do
+        pass
+    else:
+        print "WARNING: Unknown file type: ", ftype, aid
+        metrics.failure(aid, 'unknown type', ftype)
+
+# Inside a tar file, latex files bigger than this are skipped (they're
+# data or generated tables, not something anyone wrote comments in),
+# and so are gzip and tar files bigger than this.
+max_member_size = 32*2**20
+
+# How many levels of tar and gzip files inside the source tar file to
+# look into for latex.
+max_depth = 2
+
+def is_top_level(member):
+    "Is this tar archive member a file at the top level of the archive?"
+    name = os.path.normpath(member.name)
+    return member.isfile() and os.sep not in name and '/' not in name
+
+def is_latex_member(member):
+    "Is this tar archive member a latex file to collect?"
+    # Only latex files at the top level of the archive are used
+    return is_top_level(member) and extension(member.name) == 'tex'
+
+# Names of tar archive members that are worth opening to look for
+# latex.  Other gzip files are figures and data (fig.eps.gz).
+nested_extensions = ('.tex.gz', '.tar', '.tar.gz', '.tgz')
+
+def is_nested_member(member):
+    """Is this tar archive member gzipped latex or a tar file that may
+    have latex in it?"""
+    return (is_top_level(member) and member.name.endswith(nested_extensions))
+
+def extract_tar_latex(stream, outf, depth=0):
+    """Concatenate the latex files in the tar archive stream to outf.
+
+    Top level .tex.gz files, and tar files (gzipped or not), are
+    looked into as well, up to max_depth levels down.
+    """
+    # Mode 'r|' reads the archive strictly sequentially, so members
+    # that aren't latex are just read past.
+    tf = tarfile.open(fileobj=stream, mode='r|')
+    try:
+        for member in tf:
+            is_latex = is_latex_member(member)
+            is_nested = depth < max_depth and is_nested_member(member)
+            if not (is_latex or is_nested):
+                continue
+            if member.size > max_member_size:
+                if verbose: print "Skipping", member.name, member.size, "bytes"
+                metrics.count('members_too_big')
+                continue
+            if is_latex:
+                # Can have multiple tex files, just concat them
+                shutil.copyfileobj(tf.extractfile(member), outf, read_size)
             else:
-                # The line break comes at the end of file_type_string()
-                print "WARNING: Unknown file type: ", file_type_string(base_fn), 
-            # All Latex files should now have .tex extensions, collect them.
-            files = os.listdir('.')
-            latex_files = [fn for fn in files if extension(fn) == 'tex']
-
-            # If there are no latex files, an empty file should be
-            # generated to avoid later file not found errors.        
-            latex_fn = latex_file_path(aid)
-            ensure_dirs_exist(latex_fn)
-            with open(latex_fn, 'w') as outf:
-                if latex_files:
-                    # Can have multiple tex files, just concat them
-                    subprocess.call(['cat'] + latex_files, stdout=outf)
+                extract_nested_latex(tf.extractfile(member), outf, depth + 1,
+                                     member.name.endswith('.tex.gz'))
     finally:
-        shutil.rmtree(tmpdir)
-                    
+        tf.close()
+
+def extract_nested_latex(stream, outf, depth, is_latex):
+    """Write the latex in a gzip or tar file found in a tar file to outf.
+
+    is_latex says whether the member's name says it's gzipped latex.
+    If it's a tar file, it's handled like the source tar file.
+    """
+    head = stream.read(sniff_size)
+    ftype = sniff(head)
+    stream = PrefixedReader(head, stream)
+    if ftype == 'gzip':
+        stream = GunzipReader(stream)
+        head = stream.read(sniff_size)
+        ftype = sniff(head)
+        stream = PrefixedReader(head, stream)
+    if ftype == 'tar':
+        metrics.count('nested_archives')
+        extract_tar_latex(stream, outf, depth)
+    elif ftype == 'text' and is_latex:
+        metrics.count('nested_archives')
+        # The decompressed size isn't known until it's decompressed
+        data = stream.read(max_member_size + 1)
+        if len(data) > max_member_size:
+            metrics.count('members_too_big')
+        else:
+            outf.write(data)
+
+# Size of the chunks used when streaming source files
+read_size = 256*1024
+
+class PrefixedReader(object):
+    """File-like object that gives the bytes in prefix, then the rest
+    of fileobj.  This makes it possible to look at the start of a
+    stream to figure out what it is, then hand the whole thing to
+    something else."""
+
+    def __init__(self, prefix, fileobj):
+        self.prefix = prefix
+        self.fileobj = fileobj
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.fileobj.read(size)
+        if size < 0:
+            result = self.prefix + self.fileobj.read()
+            self.prefix = b''
+        elif size <= len(self.prefix):
+            result = self.prefix[:size]
+            self.prefix = self.prefix[size:]
+        else:
+            result = self.prefix + self.fileobj.read(size - len(self.prefix))
+            self.prefix = b''
+        return result
+
+class GunzipReader(object):
+    """File-like object that decompresses a gzip stream as it's read.
+
+    Like gunzip, this handles files with several gzip members, ignores
+    trailing garbage (there's a fair amount of zero padding in the
+    arxiv.org files), and keeps whatever it could decompress from a
+    truncated file.  Memory use is bounded by read_size no matter how
+    well the data compresses (see astro-ph/9505048).
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.decompressor = self.new_decompressor()
+        self.pending = b''
+        self.buffer = b''
+        self.eof = False
+
+    def new_decompressor(self):
+        # The wbits value tells zlib to expect a gzip header
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    def read(self, size=-1):
+        while not self.eof and (size < 0 or len(self.buffer) < size):
+            self.fill()
+        if size < 0 or size >= len(self.buffer):
+            result, self.buffer = self.buffer, b''
+        else:
+            result, self.buffer = self.buffer[:size], self.buffer[size:]
+        metrics.count('bytes_decompressed', len(result))
+        return result
+
+    def fill(self):
+        "Decompress up to read_size more bytes into the buffer"
+        dc = self.decompressor
+        data = dc.unconsumed_tail or self.pending or self.fileobj.read(read_size)
+        self.pending = b''
+        if not data:
+            self.buffer += dc.flush()
+            self.eof = True
+            return
+
+        self.buffer += dc.decompress(data, read_size)
+        if dc.unused_data:
+            # End of a gzip member.  Either another member follows or
+            # it's junk at the end of the file.
+            rest = dc.unused_data
+            if len(rest) < 2:
+                rest += self.fileobj.read(read_size)
+            if rest.startswith(b'\x1f\x8b'):
+                self.decompressor = self.new_decompressor()
+                self.pending = rest
+            else:
+                self.eof = True
+                
 ##################################################
+# Allowing tex, pdf, or gz extension means these can be used on
+# latex dir or source dir
+# Both kinds of file name in one regexp, so each name is matched once
+file_regexp = re.compile('^(?:([0-9]{4}.[0-9]{4}(?:v[0-9]+)?)|'
+                         '([-a-z]+)([0-9]{7}(?:v[0-9]+)?))\.(pdf|gz|tex)$')
+
+def file_name_to_aid(fn):
+    """Take the name of a file in the archive, return the arxiv id and extension.
+
+    This undoes file_name_base() + extension.  Return (None, None)
+    for files that aren't part of the archive.
+    """
+    match = file_regexp.match(fn)
+    if not match:
+        return None, None
+    new_aid, archive, number, ext = match.groups()
+    return new_aid or archive + '/' + number, '.' + ext
+
+def yymm_key(yymm):
+    "Sort key that puts 1990s months before 2000s months"
+    return ('19' if yymm >= '91' else '20') + yymm
+
+def in_months(yymm, months):
+    "Is yymm in any of the (first, last) ranges in months?"
+    key = yymm_key(yymm)
+    return any(yymm_key(first) <= key <= yymm_key(last) for first, last in months)
+
+def iter_names(dir):
+    "Yield the names of the files in dir as they're read from the disk"
+    if scandir is None:
+        for fn in os.listdir(dir):
+            yield fn
+    else:
+        for entry in scandir(dir):
+            yield entry.name
+
+def wanted_yymm(yymm, years=None, months=None):
+    """Is yymm one of the given years and in one of the given month
+    ranges?  None means any."""
+    return ((years is None or yymm[:2] in years) and
+            (months is None or in_months(yymm, months)))
+
+def yymm_dirs(prefix, years=None, months=None):
+    """The yymm directories in prefix, in chronological order.
+
+    years is a list of two char strings (see year_to_arxiv_id),
+    months a list of (first, last) yymm pairs.  If both are given a
+    directory has to match both.
+    """
+    result = []
+    for fn in iter_names(prefix):
+        if len(fn) == 4 and fn.isdigit() and wanted_yymm(fn, years, months):
+            result.append(fn)
+    return sorted(result, key=yymm_key)
+
+def month_ids(prefix, yymm):
+    "The arxiv ids in one yymm directory, sorted"
+    aids = []
+    for fn in iter_names(os.path.join(prefix, yymm)):
+        aid, ext = file_name_to_aid(fn)
+        if aid:
+            aids.append(aid)
+    aids.sort()
+    return aids
+
+def manifest_tree(prefix):
+    """The manifest tree that answers questions about prefix, or None
+    if there's no manifest or it doesn't cover prefix."""
+    if manifest is None:
+        return None
+    if prefix == path.source:
+        return 'source'
+    if prefix == path.latex:
+        return 'latex'
+    return None
+
+def iter_arxiv_ids(prefix=None, years=None, months=None, archives=None):
+    """Yield the arxiv ids of the files in a tree of the archive.
+
+    prefix is path.latex (the default) or path.source.  years and
+    months pick out directories (see yymm_dirs).  archives is a list
+    of archive names: old-style ids from other archives are skipped,
+    and new-style ids, which don't say what archive they're in, are
+    all kept.
+
+    Ids come out a month at a time in chronological order, sorted
+    within each month.  Only one directory is listed at a time, so
+    the first ids come out right away even for the whole archive.
+    If fetch.manifest is set, the ids come from it instead.
+    """
+    if prefix is None: prefix = path.latex
+    tree = manifest_tree(prefix)
+    if tree:
+        yymms = sorted((yymm for yymm in manifest.yymms(tree) 
+                        if wanted_yymm(yymm, years, months)), key=yymm_key)
+        ids = lambda yymm: manifest.aids(tree, yymm=yymm)
+    else:
+        yymms = yymm_dirs(prefix, years, months)
+        ids = lambda yymm: month_ids(prefix, yymm)
+    for yymm in yymms:
+        for aid in ids(yymm):
+            if archives is None or '/' not in aid or aid.split('/', 1)[0] in archives:
+                yield aid
+
 def dir_to_arxiv_ids(dir):
     """Take a dir, list all the files, and convert them into arxiv ids.  
 
     This is a bit of a hack, to facilitate bulk extraction of latex files, 
     don't be too careful about it..."""
-
-    # Allowing tex, pdf, or gz extension means this can be used on
-    # latex dir or source dir
-    new_reverse_regexp = '^([0-9]{4}.[0-9]{4}(v[0-9]+)?)\.(pdf|gz|tex)$'
-    old_reverse_regexp = '^([-a-z]+)([0-9]{7}(v[0-9]+)?)\.(pdf|gz|tex)$'
-
-    files = os.listdir(dir)
     result = []
-    for fn in files:
-        match = re.search(new_reverse_regexp, fn)
-        if match: 
-            result.append(match.group(1))
-        match = re.search(old_reverse_regexp, fn)
-        if match:
-            result.append(match.group(1) + '/' + match.group(2))
+    for fn in os.listdir(dir):
+        aid, ext = file_name_to_aid(fn)
+        if aid:
+            result.append(aid)
     return result
 
 def year_to_arxiv_id(year, prefix=path.latex):
@@ -417,18 +1056,93 @@ def year_to_arxiv_id(year, prefix=path.latex):
     directory you want to use to generate the arxiv ids.  
    
     """
-    dirs = [fn for fn in os.listdir(prefix) 
-            if fn.startswith(year)]
-    ids = [dir_to_arxiv_ids(os.path.join(prefix,dir))
-           for dir in dirs]
-    return util.flatten(ids)
+    return list(iter_arxiv_ids(prefix, years=[year]))
 
 def arxiv_ids_by_year(prefix=path.latex):
     """Gather all arxiv ids into a dict with keys for each year"""
-    # NOTE -- depend on four-number dir prefixes here
-    fns = [fn for fn in os.listdir(prefix) 
-           if re.match('[0-9]{4}', fn)]
-    years = sorted(set(fn[0:2] for fn in fns))
-    kv_pairs = [(year, year_to_arxiv_id(year)) 
-                for year in years]
-    return dict(kv_pairs)
+    years = sorted(set(yymm[:2] for yymm in yymm_dirs(prefix)))
+    return dict((year, year_to_arxiv_id(year, prefix=prefix))
+                for year in years)
+
+@metrics.timed('extract')
+def bulk_latex(aids, processes=None, report_interval=10, force=False):
+    """Extract latex from lots of papers using a pool of processes.
+
+    Unlike all_latex, a paper that fails doesn't stop the run.
+    Progress (papers/s, MB/s of source read) is printed every
+    report_interval seconds.  processes defaults to the number of
+    cores.  Papers with up to date latex are skipped unless force is
+    True.
+
+    Return a dict mapping arxiv ids that failed to the error message.
+    """
+    failures = {}
+    n_skipped = 0
+    progress = util.Progress(interval=report_interval)
+    pool = multiprocessing.Pool(processes, initializer=quiet_worker)
+    # Metrics recorded in the worker processes are lost, so count
+    # here.
+    try:
+        for aid, nbytes, error in pool.imap_unordered(latex_worker, 
+                                                      ((aid, force) for aid in aids),
+                                                      chunksize=16):
+            if error:
+                failures[aid] = error
+                print "Failed", aid, error
+                metrics.failure(aid, 'extract', error)
+            elif nbytes is None:
+                n_skipped += 1
+                metrics.count('latex_up_to_date')
+            else:
+                metrics.count('papers_extracted')
+            progress.update(nbytes or 0)
+    except BaseException:
+        # Don't wait for the papers that are still queued
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    if manifest is not None:
+        # The workers don't tell the manifest about the files they write
+        manifest.refresh()
+    progress.report(final=True)
+    if n_skipped: print "Skipped", n_skipped, "papers with up to date latex"
+    if failures: print len(failures), "papers failed"
+    return failures
+
+def bulk_latex_by_year(years=None, prefix=None, processes=None, force=False):
+    """Extract latex from all papers in the source dir for the given years.
+
+    years is a list of two char strings (see year_to_arxiv_id), by
+    default all of them.
+    """
+    if prefix is None: prefix = path.source
+    return bulk_latex(iter_arxiv_ids(prefix, years=years), 
+                      processes=processes, force=force)
+
+def quiet_worker():
+    "Set up a worker process for bulk work."
+    # Don't print a message for every paper, and don't use the
+    # parent's manifest: sqlite connections can't be shared with
+    # forked processes.  The parent can refresh() it afterwards.
+    global verbose, manifest
+    verbose = False
+    manifest = None
+
+def latex_worker(args):
+    """Extract latex for one paper in a worker process.
+
+    args is the arxiv id and the force flag for latex().  Return the
+    arxiv id, the size of the source file (None if the latex was
+    already up to date), and an error message or None.
+    """
+    aid, force = args
+    try:
+        nbytes = os.path.getsize(source_file_path(aid))
+        if not latex(aid, force=force):
+            return aid, None, None
+        return aid, nbytes, None
+    except Exception, exc:
+        return aid, 0, '%s: %s' % (type(exc).__name__, exc)
@@ -0,0 +1,232 @@
+#########
+# Notes #
+#########
+#
+# A set of arxiv ids as a sorted array of integers.  A list or set of
+# id strings costs around 100 bytes per paper, so an inventory of the
+# whole archive (what's downloaded, what's been scraped, which papers
+# are only PDF) is a hundred MB or so.  Here each id is one 8 byte
+# integer, so a million papers take 8 MB, membership is a binary
+# search, and a range of months is a slice.
+#
+# Each id is encoded in an integer as
+#
+#   months since 1991-01  archive code  number   version
+#   11 bits               6 bits        17 bits  8 bits
+#
+# so sorting the integers sorts the ids by month first (1990s before
+# 2000s).  The archive code is 0 for new-style ids and the position in
+# the archives list (plus one) for old-style ids.  The version is 0
+# for an id given without one, so 1211.1574 and 1211.1574v1 are
+# different members.  That's 42 bits, which fits in a double if the
+# platform's unsigned long is too short, so there's always an array
+# type that can hold them.
+#
+# Saved files are a header followed by the integers as little-endian
+# 64 bit words, and loading one is a single read.
+#
+# Usage:
+#   downloaded = idset.ArxivIdSet(fetch.iter_arxiv_ids(path.source))
+#   '1211.1574' in downloaded
+#   todo = downloaded.yymm_range('1301', '1312') - scraped
+#   downloaded.save('downloaded.ids')
+#
+
+from __future__ import with_statement
+
+import sys, array, bisect, struct
+
+import arxiv_id
+
+# Archives with old-style ids.  Only ever append to this: the
+# position is part of the encoding.
+archives = ['acc-phys', 'adap-org', 'alg-geom', 'ao-sci', 'astro-ph', 'atom-ph',
+            'bayes-an', 'chao-dyn', 'chem-ph', 'cmp-lg', 'comp-gas', 'cond-mat',
+            'cs', 'dg-ga', 'funct-an', 'gr-qc', 'hep-ex', 'hep-lat', 'hep-ph',
+            'hep-th', 'math', 'math-ph', 'mtrl-th', 'nlin', 'nucl-ex', 'nucl-th',
+            'patt-sol', 'physics', 'plasm-ph', 'q-alg', 'q-bio', 'quant-ph',
+            'solv-int', 'supr-con']
+archive_codes = dict((name, ii + 1) for ii, name in enumerate(archives))
+
+version_bits = 8
+number_bits = 17
+archive_bits = 6
+month_bits = 11
+
+number_shift = version_bits
+archive_shift = number_shift + number_bits
+month_shift = archive_shift + archive_bits
+
+if array.array('L').itemsize >= 8:
+    typecode = 'L'
+else:
+    typecode = 'd'
+
+magic = b'OVHIDS01'
+header = struct.Struct('<8sQ')
+
+def months(yymm):
+    "Months from 1991-01 to yymm"
+    year, month = int(yymm[:2]), int(yymm[2:])
+    if not 1 <= month <= 12:
+        raise ValueError, "Invalid month: %s" % yymm
+    year += 1900 if year >= 91 else 2000
+    return (year - 1991)*12 + month - 1
+
+def encode(aid):
+    "Return the integer for arxiv id aid"
+    parsed = arxiv_id.parse(aid)
+    if parsed.is_new:
+        archive = 0
+    else:
+        try:
+            archive = archive_codes[parsed.archive]
+        except KeyError:
+            raise ValueError, "Unknown archive: %s" % aid
+    version = int(parsed.version[1:]) if parsed.version else 0
+    if version >= 1 << version_bits:
+        raise ValueError, "Version too big: %s" % aid
+    return ((months(parsed.yymm) << month_shift) | (archive << archive_shift) |
+            (int(parsed.number) << number_shift) | version)
+
+def decode(code):
+    "Return the arxiv id for integer code"
+    code = int(code)
+    version = code & ((1 << version_bits) - 1)
+    number = (code >> number_shift) & ((1 << number_bits) - 1)
+    archive = (code >> archive_shift) & ((1 << archive_bits) - 1)
+    year, month = divmod(code >> month_shift, 12)
+    yymm = '%02d%02d' % ((1991 + year) % 100, month + 1)
+    if archive:
+        aid = '%s/%s%03d' % (archives[archive - 1], yymm, number)
+    else:
+        aid = '%s.%04d' % (yymm, number)
+    if version:
+        aid += 'v%d' % version
+    return aid
+
+def month_bound(yymm):
+    "The smallest code in month yymm"
+    return months(yymm) << month_shift
+
+class ArxivIdSet(object):
+    """A set of arxiv ids stored as a sorted array of integers.
+
+    Iterating gives the ids in chronological order.  The set
+    operators return new sets.
+    """
+
+    def __init__(self, aids=()):
+        self.codes = array.array(typecode, sorted(set(encode(aid) for aid in aids)))
+
+    @classmethod
+    def from_codes(cls, codes):
+        "Make a set from an array of codes that's already sorted with no duplicates"
+        result = cls()
+        result.codes = codes
+        return result
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __iter__(self):
+        for code in self.codes:
+            yield decode(code)
+
+    def __contains__(self, aid):
+        try:
+            code = encode(aid)
+        except ValueError:
+            return False
+        ii = bisect.bisect_left(self.codes, code)
+        return ii < len(self.codes) and self.codes[ii] == code
+
+    def __eq__(self, other):
+        return isinstance(other, ArxivIdSet) and self.codes == other.codes
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'ArxivIdSet(%r)' % list(self)
+
+    def nbytes(self):
+        "Memory used by the array of codes"
+        return len(self.codes) * self.codes.itemsize
+
+    def add(self, aid):
+        "Add one id.  Moves everything after it, so use update() for lots of ids."
+        code = encode(aid)
+        ii = bisect.bisect_left(self.codes, code)
+        if ii == len(self.codes) or self.codes[ii] != code:
+            self.codes.insert(ii, code)
+
+    def update(self, aids):
+        "Add lots of ids"
+        self.codes = (self | ArxivIdSet(aids)).codes
+
+    def yymm_range(self, first, last=None):
+        "The ids from months first through last (inclusive)"
+        if last is None: last = first
+        start = bisect.bisect_left(self.codes, month_bound(first))
+        stop = bisect.bisect_left(self.codes, month_bound(last) + (1 << month_shift))
+        return ArxivIdSet.from_codes(self.codes[start:stop])
+
+    def merge(self, other, keep_left, keep_both, keep_right):
+        """Walk the two sorted arrays together, keeping the codes only
+        in self, in both, and only in other according to the flags."""
+        aa, bb = self.codes, other.codes
+        na, nb = len(aa), len(bb)
+        result = array.array(typecode)
+        ii = jj = 0
+        while ii < na and jj < nb:
+            if aa[ii] < bb[jj]:
+                if keep_left: result.append(aa[ii])
+                ii += 1
+            elif aa[ii] > bb[jj]:
+                if keep_right: result.append(bb[jj])
+                jj += 1
+            else:
+                if keep_both: result.append(aa[ii])
+                ii += 1
+                jj += 1
+        if keep_left: result.extend(aa[ii:])
+        if keep_right: result.extend(bb[jj:])
+        return ArxivIdSet.from_codes(result)
+
+    def __or__(self, other):
+        return self.merge(other, True, True, True)
+
+    def __and__(self, other):
+        return self.merge(other, False, True, False)
+
+    def __sub__(self, other):
+        return self.merge(other, True, False, False)
+
+    def __xor__(self, other):
+        return self.merge(other, True, False, True)
+
+    def save(self, fn):
+        "Write the set to file fn"
+        with open(fn, 'wb') as ff:
+            ff.write(header.pack(magic, len(self.codes)))
+            if typecode == 'L' and sys.byteorder == 'little':
+                self.codes.tofile(ff)
+            else:
+                ff.write(struct.pack('<%dQ' % len(self.codes), 
+                                     *[int(code) for code in self.codes]))
+
+def load(fn):
+    "Read a set written by ArxivIdSet.save()"
+    with open(fn, 'rb') as ff:
+        file_magic, n = header.unpack(ff.read(header.size))
+        if file_magic != magic:
+            raise IOError, "Not an id set: %s" % fn
+        codes = array.array(typecode)
+        if typecode == 'L' and sys.byteorder == 'little':
+            codes.fromfile(ff, n)
+        else:
+            data = ff.read(8*n)
+            if len(data) != 8*n: raise EOFError, "Id set is cut short: %s" % fn
+            codes.extend(struct.unpack('<%dQ' % n, data))
+    return ArxivIdSet.from_codes(codes)
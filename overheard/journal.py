@@ -0,0 +1,118 @@
+#########
+# Notes #
+#########
+#
+# The journal lets a run that died partway (network trouble, a
+# missing source file, ^C) be restarted without redoing what's
+# already done or duplicating lines in the long/short files.  It's a
+# file with one JSON object per line, appended to as each paper
+# finishes a stage:
+#
+#   {"aid": "1211.1574", "stage": "downloaded"}
+#   {"aid": "1211.1574", "stage": "extracted"}
+#   {"aid": "1211.1574", "stage": "scraped"}
+#   {"aid": "1211.1574", "stage": "emitted", "long": 1234, "short": 567}
+#
+# 'emitted' records hold the sizes of the long and short files just
+# after the paper's comments were written to them.  On restart the
+# output files are cut back to the sizes in the last 'emitted' record
+# (anything after that was written by a paper that didn't make it
+# into the journal) and the papers that were emitted are skipped.  A
+# 'restart' record means the output files were started over, and the
+# 'emitted' records before it no longer count.
+#
+# A paper that fails isn't recorded, so it's tried again next time.
+# If it works then, its comments come after those of the papers that
+# were written the first time around.
+#
+# Usage:
+#   jj = journal.Journal('2014-04-01.journal')
+#   if not jj.done(aid, 'downloaded'): ...
+#   jj.record(aid, 'downloaded')
+#
+
+from __future__ import with_statement
+
+import os, json, threading
+
+import records
+
+stages = ('downloaded', 'extracted', 'scraped', 'emitted')
+
+class Journal(object):
+    """Record of the stages each paper has finished.
+
+    record() can be called from several threads.
+    """
+
+    def __init__(self, fn):
+        self.fn = fn
+        self.lock = threading.Lock()
+        self.stages = {}
+        # Papers emitted since the last restart, in order
+        self.emitted = []
+        self.offsets = (0, 0)
+        if os.path.exists(fn):
+            # A line cut off by a crash is dropped
+            records.truncate_partial(fn)
+            for offset, entry in records.iter_records(fn):
+                self.load(entry)
+        self.ff = open(fn, 'ab')
+
+    def load(self, entry):
+        "Take account of one journal entry"
+        if entry['stage'] == 'restart':
+            self.emitted = []
+            self.offsets = (0, 0)
+            return
+        self.stages.setdefault(entry['aid'], set()).add(entry['stage'])
+        if entry['stage'] == 'emitted':
+            self.emitted.append(entry['aid'])
+            self.offsets = (entry['long'], entry['short'])
+
+    def done(self, aid, stage):
+        "Has aid finished stage?"
+        return stage in self.stages.get(aid, ())
+
+    def record(self, aid, stage, long=None, short=None):
+        """Note that aid finished stage.
+
+        For 'emitted', long and short are the sizes of the output
+        files after the paper's comments were written.
+        """
+        entry = dict(aid=aid, stage=stage)
+        if stage == 'emitted':
+            entry.update(long=long, short=short)
+        with self.lock:
+            self.ff.write(json.dumps(entry) + '\n')
+            self.ff.flush()
+            self.load(entry)
+
+    def restart(self):
+        "Note that the output files are being started over"
+        with self.lock:
+            self.ff.write(json.dumps(dict(aid=None, stage='restart')) + '\n')
+            self.ff.flush()
+            self.load(dict(stage='restart'))
+
+    def resume(self, aids):
+        """Can the output for aids pick up where this journal left off?
+
+        That's the case if all of the papers emitted so far are in aids.
+        """
+        return set(self.emitted) <= set(aids)
+
+    def close(self):
+        self.ff.close()
+
+def open_output(fn, offset):
+    """Open an output file to append to after cutting it back to offset.
+    offset 0 means start over."""
+    # Not binary mode: the comments are unicode, and need to be
+    # encoded the same way as by open(fn, 'w')
+    if not offset or not os.path.exists(fn):
+        return open(fn, 'w')
+    ff = open(fn, 'r+')
+    ff.truncate(offset)
+    ff.seek(offset)
+    return ff
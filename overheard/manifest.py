@@ -0,0 +1,194 @@
+#########
+# Notes #
+#########
+#
+# The manifest is a sqlite index of what's in the data/ and latex/
+# trees: for each paper the source file extension, size, mtime and
+# file type, and for each latex file its size and mtime.  With a
+# million papers in the archive, asking the filesystem whether a file
+# exists (several times per paper) and listing whole directories to
+# get at the arxiv ids adds up.  With the manifest these are index
+# lookups.
+#
+# The manifest is brought up to date with refresh(), which only
+# rescans the yymm directories whose mtime has changed since the last
+# time.  A directory's mtime changes when files are added, removed,
+# or renamed, which is how fetch writes all of its files, but _not_
+# when a file is rewritten in place.  Files written by fetch while
+# fetch.manifest is set are recorded as they're written.
+#
+# Usage:
+#   fetch.manifest = manifest.Manifest()
+#   fetch.manifest.refresh()
+#
+
+from __future__ import with_statement
+
+import os, re, sqlite3, threading
+
+import path, fetch
+
+verbose = True
+
+schema = ['''CREATE TABLE IF NOT EXISTS dirs (
+               tree TEXT, yymm TEXT, mtime REAL,
+               PRIMARY KEY (tree, yymm))''',
+          '''CREATE TABLE IF NOT EXISTS source (
+               aid TEXT, yymm TEXT, ext TEXT, size INTEGER, mtime REAL, ftype TEXT,
+               PRIMARY KEY (aid, ext))''',
+          '''CREATE TABLE IF NOT EXISTS latex (
+               aid TEXT, yymm TEXT, ext TEXT, size INTEGER, mtime REAL, ftype TEXT,
+               PRIMARY KEY (aid, ext))''',
+          'CREATE INDEX IF NOT EXISTS source_yymm ON source (yymm)',
+          'CREATE INDEX IF NOT EXISTS latex_yymm ON latex (yymm)']
+
+trees = ('source', 'latex')
+
+def tree_dir(tree):
+    "The directory that holds a tree of the archive"
+    return path.source if tree == 'source' else path.latex
+
+def yymm_dirs(dir):
+    "List the yymm directories in dir"
+    if not os.path.isdir(dir):
+        return []
+    return [fn for fn in os.listdir(dir) if re.match('^[0-9]{4}$', fn)]
+
+class Manifest(object):
+    """Index of the files in the archive.
+
+    The methods can be called from several threads.
+    """
+
+    def __init__(self, fn=None):
+        self.conn = sqlite3.connect(fn or path.manifest, check_same_thread=False)
+        self.lock = threading.RLock()
+        for statement in schema:
+            self.conn.execute(statement)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def refresh(self, sniff=True):
+        """Rescan the directories that have changed since the last refresh.
+
+        If sniff is True, the file type of new source files is
+        recorded (this means reading the start of each one).  Return
+        the number of directories rescanned.
+        """
+        n_scanned = 0
+        with self.lock:
+            for tree in trees:
+                top = tree_dir(tree)
+                known = dict(self.conn.execute('SELECT yymm, mtime FROM dirs WHERE tree=?',
+                                               (tree,)))
+                present = yymm_dirs(top)
+                for yymm in present:
+                    mtime = os.stat(os.path.join(top, yymm)).st_mtime
+                    if known.get(yymm) != mtime:
+                        if verbose: print "Indexing", os.path.join(top, yymm)
+                        self.scan_dir(tree, yymm, mtime, sniff=sniff)
+                        n_scanned += 1
+                for yymm in set(known) - set(present):
+                    self.conn.execute('DELETE FROM %s WHERE yymm=?' % tree, (yymm,))
+                    self.conn.execute('DELETE FROM dirs WHERE tree=? AND yymm=?',
+                                      (tree, yymm))
+            self.conn.commit()
+        return n_scanned
+
+    def scan_dir(self, tree, yymm, mtime, sniff=True):
+        "Replace what's known about one yymm directory"
+        dir = os.path.join(tree_dir(tree), yymm)
+        # Keep the file types of files that haven't changed
+        old = dict(((aid, ext), (size, old_mtime, ftype)) for aid, ext, size, old_mtime, ftype
+                   in self.conn.execute('SELECT aid, ext, size, mtime, ftype FROM %s '
+                                        'WHERE yymm=?' % tree, (yymm,)))
+        rows = []
+        for fn in os.listdir(dir):
+            aid, ext = fetch.file_name_to_aid(fn)
+            if not aid:
+                continue
+            st = os.stat(os.path.join(dir, fn))
+            ftype = None
+            previous = old.get((aid, ext))
+            if previous and previous[:2] == (st.st_size, st.st_mtime):
+                ftype = previous[2]
+            elif sniff and tree == 'source':
+                ftype = fetch.file_type(os.path.join(dir, fn))
+            rows.append((aid, yymm, ext, st.st_size, st.st_mtime, ftype))
+        self.conn.execute('DELETE FROM %s WHERE yymm=?' % tree, (yymm,))
+        self.conn.executemany('INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?, ?)' % tree,
+                              rows)
+        self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)',
+                          (tree, yymm, mtime))
+
+    def add_file(self, tree, aid, fn, ftype=None):
+        "Record a file that was just written"
+        st = os.stat(fn)
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?, ?, ?)' % tree,
+                              (aid, fetch.dir_prefix(aid), os.path.splitext(fn)[1],
+                               st.st_size, st.st_mtime, ftype))
+            self.conn.commit()
+
+    def add_source(self, aid, fn, ftype=None):
+        self.add_file('source', aid, fn, ftype)
+
+    def add_latex(self, aid, fn):
+        self.add_file('latex', aid, fn)
+
+    def source_extension(self, aid):
+        """Return the extension of the source file for aid, or False.
+
+        Same as fetch.source_file_extension.
+        """
+        with self.lock:
+            exts = [row[0] for row in
+                    self.conn.execute('SELECT ext FROM source WHERE aid=?', (aid,))]
+        if len(exts) > 1:
+            raise RuntimeError, "More than one file exists for %s" % aid
+        return exts[0] if exts else False
+
+    def source_info(self, aid):
+        "Return (ext, size, mtime, ftype) for the source file of aid, or None"
+        with self.lock:
+            return self.conn.execute('SELECT ext, size, mtime, ftype FROM source '
+                                     'WHERE aid=?', (aid,)).fetchone()
+
+    def latex_status(self, aid):
+        """Is the latex for aid 'missing', 'stale' (older than the source),
+        or 'current'?"""
+        with self.lock:
+            source = self.conn.execute('SELECT mtime FROM source WHERE aid=?',
+                                       (aid,)).fetchone()
+            latex = self.conn.execute('SELECT mtime FROM latex WHERE aid=?',
+                                      (aid,)).fetchone()
+        if latex is None:
+            return 'missing'
+        if source is not None and source[0] > latex[0]:
+            return 'stale'
+        return 'current'
+
+    def yymms(self, tree='source'):
+        "Return the yymm directories that have files in one tree"
+        with self.lock:
+            return [str(row[0]) for row in 
+                    self.conn.execute('SELECT DISTINCT yymm FROM %s' % tree)]
+
+    def aids(self, tree='source', year=None, yymm=None):
+        """Return the arxiv ids in one tree of the archive.
+
+        year is a two char string, yymm a four char string; either
+        restricts the ids to that year or month.
+        """
+        sql = 'SELECT aid FROM %s' % tree
+        args = ()
+        if yymm is not None:
+            sql += ' WHERE yymm=?'
+            args = (yymm,)
+        elif year is not None:
+            sql += ' WHERE substr(yymm, 1, 2)=?'
+            args = (year,)
+        with self.lock:
+            return [str(row[0]) for row in self.conn.execute(sql + ' ORDER BY yymm, aid', args)]
@@ -0,0 +1,175 @@
+#########
+# Notes #
+#########
+#
+# Timers and counters to see where a run spends its time: whether a
+# slow day was the network, decompression, or scraping.  fetch,
+# scrape, store, and update record
+#   stage timers   wall time in each stage (rss, download, extract,
+#                  scrape, export) and the number of times it ran
+#   counters       bytes downloaded and decompressed, file type
+#                  calls, subprocess calls, cache hits, etc.
+#   failures       papers that were dropped and why (Kill (type),
+#                  Kill (unicode), unknown file types, corrupt files)
+# The results can be written as a JSON report and as a Prometheus
+# text file for node_exporter's textfile collector.
+#
+# Nothing is recorded unless enabled is True.  When it's False each
+# call costs a function call and a test.
+#
+# Usage:
+#   metrics.enabled = True
+#   overheard.process_todays_papers()
+#   metrics.write_json('metrics.json')
+#   metrics.write_prometheus('/var/lib/node_exporter/overheard.prom')
+#
+
+from __future__ import with_statement
+
+import os, time, json, threading, functools
+
+enabled = False
+
+# Prefix for the names of the Prometheus metrics
+prefix = 'overheard'
+
+lock = threading.Lock()
+
+# stage -> [calls, seconds]
+timers = {}
+# name -> number
+counters = {}
+# (aid, reason, detail)
+failures = []
+
+started = time.time()
+
+def reset():
+    "Forget everything recorded so far"
+    global started
+    with lock:
+        timers.clear()
+        counters.clear()
+        del failures[:]
+        started = time.time()
+
+def count(name, n=1):
+    "Add n to a counter"
+    if not enabled: return
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+
+def add_time(stage, seconds):
+    "Record seconds of wall time spent in stage"
+    if not enabled: return
+    with lock:
+        entry = timers.setdefault(stage, [0, 0.0])
+        entry[0] += 1
+        entry[1] += seconds
+
+def failure(aid, reason, detail=None):
+    "Record that a paper was dropped"
+    if not enabled: return
+    with lock:
+        failures.append((aid, reason, detail))
+
+class timer(object):
+    """Context manager that records the wall time spent in a stage
+
+    with metrics.timer('download'):
+        ...
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.start = None
+
+    def __enter__(self):
+        if enabled: self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.start is not None:
+            add_time(self.stage, time.time() - self.start)
+        return False
+
+def timed(stage):
+    """Decorator that records the wall time of each call to a function
+
+    @metrics.timed('download')
+    def all_source(aids):
+        ...
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kw):
+            with timer(stage):
+                return func(*args, **kw)
+        return wrapper
+    return decorator
+
+def report():
+    "Return everything recorded as a dict"
+    with lock:
+        reasons = {}
+        for aid, reason, detail in failures:
+            reasons[reason] = reasons.get(reason, 0) + 1
+        return dict(started=started,
+                    elapsed=time.time() - started,
+                    stages=dict((stage, dict(calls=calls, seconds=seconds))
+                                for stage, (calls, seconds) in timers.items()),
+                    counters=dict(counters),
+                    failure_counts=reasons,
+                    failures=[dict(aid=aid, reason=reason, detail=detail)
+                              for aid, reason, detail in failures])
+
+def write_atomic(fn, text):
+    # node_exporter may read the file at any moment, so never let it
+    # see a partly written one.
+    part_fn = fn + '.part'
+    with open(part_fn, 'w') as ff:
+        ff.write(text)
+    os.rename(part_fn, fn)
+
+def write_json(fn):
+    "Write the report as JSON"
+    write_atomic(fn, json.dumps(report(), indent=1, sort_keys=True) + '\n')
+
+def label(value):
+    "Quote a Prometheus label value"
+    return '"%s"' % str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def prometheus_text():
+    "Return the report in the Prometheus text exposition format"
+    rep = report()
+    lines = []
+    def metric(name, help, samples, type='gauge'):
+        name = prefix + '_' + name
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, type))
+        for labels, value in samples:
+            lines.append('%s%s %s' % (name, labels, value))
+
+    # Things that only go up during a run are counters, named with
+    # _total as Prometheus expects.
+    metric('last_run_timestamp_seconds', 'When the run started',
+           [('', float(rep['started']))])
+    metric('run_seconds', 'Wall time of the run',
+           [('', float(rep['elapsed']))])
+    metric('stage_seconds_total', 'Wall time spent in each stage',
+           [('{stage=%s}' % label(stage), float(entry['seconds']))
+            for stage, entry in sorted(rep['stages'].items())], 'counter')
+    metric('stage_calls_total', 'Number of times each stage ran',
+           [('{stage=%s}' % label(stage), entry['calls'])
+            for stage, entry in sorted(rep['stages'].items())], 'counter')
+    for name, value in sorted(rep['counters'].items()):
+        metric(name + '_total', name.replace('_', ' ').capitalize(), 
+               [('', value)], 'counter')
+    metric('failures_total', 'Papers dropped, by reason',
+           [('{reason=%s}' % label(reason), n)
+            for reason, n in sorted(rep['failure_counts'].items())], 'counter')
+    return '\n'.join(lines) + '\n'
+
+def write_prometheus(fn):
+    "Write the report as a Prometheus text file"
+    write_atomic(fn, prometheus_text())
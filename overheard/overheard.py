@@ -4,29 +4,33 @@
 # Notes #
 #########
 # 
-# Shell command dependencies:
-# wget, tar, file, cat, gzip
+# Shell command dependencies: none.  (It used to need wget, tar,
+# file, cat, and gzip.)
 #
 
 from __future__ import with_statement
 
 import sys, os, datetime, argparse
 
-import path, update, fetch, scrape
+import path, update, fetch, scrape, store, metrics, pipeline, bulk, manifest
 
-def process_papers(aids, fn_base, delay=5, prefix='.'):
+def process_papers(aids, fn_base, delay=5, prefix='.', threads=4):
     "Download today's papers and extract comments"
     # nmax is for testing to specify that a small number of papers
     # should be fetched.
 
     long_fn = os.path.join(prefix, fn_base + '-long.tex')
     short_fn = os.path.join(prefix, fn_base + '-short.tex')
+    journal_fn = os.path.join(prefix, fn_base + '.journal')
 
-    fetch.all_source(aids, delay=delay)
-    fetch.all_latex(aids)    
-    scrape.write_output(aids, long_fn, short_fn)
+    # Each paper is extracted and scraped as soon as it's downloaded
+    # rather than in three passes over all of them (see pipeline.py).
+    # Running again after a crash picks up where this left off.
+    return pipeline.run(aids, long_fn, short_fn, delay=delay, threads=threads,
+                        journal_fn=journal_fn)
 
-def process_todays_papers(delay=60, prefix='.', nmax=None):
+def process_todays_papers(delay=60, prefix='.', nmax=None, threads=4,
+                          archives=('astro-ph',)):
     "Download today's papers and extract comments"
     # nmax is for testing to specify that a small number of papers
     # should be fetched.
@@ -34,30 +38,109 @@ def process_todays_papers(delay=60, prefix='.', nmax=None):
     date_str = datetime.date.today().isoformat()
     long_fn = os.path.join(prefix, date_str + '-long.tex')
     short_fn = os.path.join(prefix, date_str + '-short.tex')
+    journal_fn = os.path.join(prefix, date_str + '.journal')
 
-    aids = update.parse_rss()
+    aids = update.parse_rss(archives)
     if not nmax is None: aids = aids[:min(len(aids), nmax)]
-    fetch.all_source(aids, delay=delay)
-    fetch.all_latex(aids)    
-    scrape.write_output(aids, long_fn, short_fn)
+    return pipeline.run(aids, long_fn, short_fn, delay=delay, threads=threads,
+                        journal_fn=journal_fn)
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics-json', 
+                        help="Write timings, counters, and failures to this JSON file")
+    parser.add_argument('--metrics-prom', 
+                        help="Write the same as a Prometheus text file (for node_exporter)")
+
+def write_metrics(args):
+    if args.metrics_json: metrics.write_json(args.metrics_json)
+    if args.metrics_prom: metrics.write_prometheus(args.metrics_prom)
+
+def add_manifest_argument(parser):
+    parser.add_argument('-m', '--manifest', action='store_true',
+                        help="Keep an index of the data and latex trees in %s "
+                        "and look files up there (see manifest.py)" %
+                        os.path.basename(path.manifest))
+
+def open_manifest(args):
+    "Bring the manifest up to date and have fetch use it, if asked for"
+    if args.manifest:
+        fetch.manifest = manifest.Manifest()
+        fetch.manifest.refresh()
+
+def close_manifest():
+    if fetch.manifest is not None:
+        fetch.manifest.close()
+        fetch.manifest = None
+
+def bulk_main(argv):
+    "Extract and scrape papers that are already in the source tree"
+    parser = argparse.ArgumentParser(prog=os.path.basename(argv[0]) + ' bulk')
+    parser.add_argument('months', nargs='+', 
+                        help="Months to process, like 1401 or 9901-0312")
+    parser.add_argument('-a', '--archive', action='append', dest='archives',
+                        help="Only old-style ids from this archive (may be repeated)")
+    parser.add_argument('-j', '--jobs', type=int, 
+                        help="Number of worker processes (default: number of cores)")
+    parser.add_argument('-o', '--output', default='bulk',
+                        help="Where the comments go: name.db, name.jsonl(.gz), "
+                        "or name for name-long.tex and name-short.tex")
+    parser.add_argument('-f', '--force', action='store_true',
+                        help="Extract latex even if it's up to date")
+    parser.add_argument('-i', '--interval', type=float, default=10,
+                        help="Seconds between progress reports")
+    add_manifest_argument(parser)
+    add_metrics_arguments(parser)
+
+    args = parser.parse_args(argv[2:])
+    try:
+        months = [bulk.parse_months(spec) for spec in args.months]
+    except ValueError, exc:
+        parser.error(str(exc))
+    metrics.enabled = bool(args.metrics_json or args.metrics_prom)
+
+    try:
+        open_manifest(args)
+        aids = bulk.month_aids(months, archives=args.archives)
+        print len(aids), "papers"
+        bulk.run(aids, args.output, processes=args.jobs, force=args.force,
+                 report_interval=args.interval)
+    finally:
+        close_manifest()
+        write_metrics(args)
 
 def main(argv=None):
     "Download today's papers and extract comments"
     if argv is None: argv = sys.argv
+    if len(argv) > 1 and argv[1] == 'bulk':
+        return bulk_main(argv)
 
     parser = argparse.ArgumentParser()
     parser.add_argument('-q', '--quiet', action='store_true',
                         help='Suppress progress messages', )
     parser.add_argument('-d', '--delay', type=int, default=10, 
                         help="Delay in sec between requests to arxiv.org", )
+    parser.add_argument('-t', '--threads', type=int, default=4, 
+                        help="Number of simultaneous downloads from arxiv.org", )
+    parser.add_argument('-a', '--archive', action='append', dest='archives',
+                        help="Archive to get new papers from (may be repeated, default astro-ph)")
     parser.add_argument('-u', '--user-agent', 
                         help="User agent string to use for requests to arxiv.org")
+    add_manifest_argument(parser)
+    add_metrics_arguments(parser)
 
     args = parser.parse_args(argv[1:])
     fetch.user_agent = args.user_agent
-    fetch.verbose = scrape.verbose = not args.quiet
+    fetch.verbose = scrape.verbose = store.verbose = not args.quiet
+    metrics.enabled = bool(args.metrics_json or args.metrics_prom)
 
-    process_todays_papers(delay=args.delay)
+    try:
+        open_manifest(args)
+        process_todays_papers(delay=args.delay, threads=args.threads,
+                              archives=args.archives or ['astro-ph'])
+    finally:
+        close_manifest()
+        # A run that dies is the one you most want to know about
+        write_metrics(args)
 
 if type(__builtins__) is type({}):
     names = __builtins__.keys()
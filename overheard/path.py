@@ -4,3 +4,7 @@ import os
 exec_dir = os.getcwd()
 source = os.path.join(exec_dir, 'data')
 latex = os.path.join(exec_dir, 'latex')
+store = os.path.join(exec_dir, 'comments.db')
+manifest = os.path.join(exec_dir, 'manifest.db')
+rss_cache = os.path.join(exec_dir, 'rss-cache.pickle')
+shards = os.path.join(exec_dir, 'shards')
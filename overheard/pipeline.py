@@ -0,0 +1,242 @@
+#########
+# Notes #
+#########
+#
+# process_papers used to download every paper, then extract latex
+# from every paper, then scrape every paper.  Nothing was scraped
+# until the last download finished, and the CPU sat idle during the
+# delays between requests to arxiv.org.  Here each paper moves on as
+# soon as it's ready:
+#
+#   download threads --> extract thread --> scrape/write (caller's thread)
+#
+# The queues between the stages are bounded, so a fast stage can't
+# get arbitrarily far ahead of a slow one.  The caller's thread does
+# the scraping and writing because it owns the sqlite connection to
+# the store (connections can't be used from other threads).
+#
+# Papers finish out of order (downloads are simultaneous, and cached
+# papers go straight through), so they wait in a reorder buffer and
+# are written to the flat files in the order they were given.  The
+# output doesn't depend on timing, and is the same as store.export().
+#
+# A paper that fails in some stage is reported and skipped, rather
+# than stopping the whole run.  KeyboardInterrupt and the like stop
+# the run (papers that are already in the store stay there).
+#
+# If a journal file is given, the stages each paper finishes are
+# recorded there, and running again with the same journal and papers
+# skips the work that's done and appends to the output files rather
+# than starting them over (see journal.py).
+#
+# Usage:
+#   failures = pipeline.run(aids, 'long.tex', 'short.tex', delay=10,
+#                           journal_fn='run.journal')
+#
+
+from __future__ import with_statement
+
+import sys, os, threading, Queue
+
+import fetch, store, metrics, journal
+
+# Papers that may be waiting between two stages
+queue_size = 16
+
+# In Python 2, waiting on a queue without a timeout can't be
+# interrupted with ^C, so the main thread waits this long at a time.
+poll_interval = 1.0
+
+# What the journal calls each stage once it's finished
+finished = {'download': 'downloaded', 'extract': 'extracted', 'scrape': 'scraped'}
+
+def run(aids, long_fn, short_fn, delay=60, threads=4, conn=None, journal_fn=None,
+        force=False):
+    """Download, extract, and scrape papers, write their comments to
+    long_fn and short_fn.
+
+    delay is the minimum time in seconds between requests to arxiv.org
+    threads is the number of downloads that may be in progress at once
+    conn is a store connection, by default store.connect()
+    journal_fn is a journal file that makes the run resumable
+    force=True downloads, extracts, and scrapes papers even if they're
+    cached (otherwise latex that's up to date isn't extracted again,
+    and papers are only scraped again if their latex was extracted)
+
+    Return a dict mapping arxiv ids that failed to the error message.
+    """
+    jj = journal.Journal(journal_fn) if journal_fn else None
+    offsets = (0, 0)
+    if jj and jj.emitted:
+        if can_resume(jj, aids, long_fn, short_fn):
+            offsets = jj.offsets
+            print "Resuming after", len(jj.emitted), "papers"
+            # Don't write anything twice
+            emitted = set(jj.emitted)
+            aids = [aid for aid in aids if aid not in emitted]
+        else:
+            jj.restart()
+    aids = list(aids)
+
+    limiter = fetch.TokenBucket(1.0/delay) if delay > 0 else None
+    todo = Queue.Queue()
+    for item in enumerate(aids):
+        todo.put(item)
+    to_extract = Queue.Queue(queue_size)
+    to_scrape = Queue.Queue(queue_size)
+    fatal = []
+    # Set when the run is over, for whatever reason
+    stopping = []
+    # Papers whose latex was extracted this time, so the comments in
+    # the store are out of date
+    extracted = set()
+
+    def attempt(stage, func, aid, done=False):
+        """Run one stage for one paper, return an error message or None.
+        done means the journal says the stage is already done."""
+        if fatal or stopping:
+            return 'cancelled'
+        if done:
+            return None
+        try:
+            with metrics.timer(stage):
+                func(aid)
+        except Exception, exc:
+            metrics.failure(aid, stage, str(exc))
+            return '%s: %s' % (type(exc).__name__, exc)
+        except BaseException:
+            # Hand the exception to the main thread, which re-raises
+            # it after everyone has stopped.
+            fatal.append(sys.exc_info())
+            return 'cancelled'
+        if jj: jj.record(aid, finished[stage])
+        return None
+
+    def download(aid):
+        fetch.source(aid, force=force, limiter=limiter)
+
+    def extract(aid):
+        if fetch.latex(aid, force=force):
+            extracted.add(aid)
+
+    def scrape(aid):
+        store.update_paper(conn, aid, force=force or aid in extracted)
+
+    def downloader():
+        while True:
+            try:
+                index, aid = todo.get_nowait()
+            except Queue.Empty:
+                return
+            done = (jj and not force and jj.done(aid, 'downloaded') and 
+                    fetch.source_file_exists(aid))
+            to_extract.put((index, aid, attempt('download', download, aid, done)))
+
+    def extractor():
+        for ii in range(len(aids)):
+            item = to_extract.get()
+            if item is None:
+                return
+            index, aid, error = item
+            if not error:
+                done = (jj and not force and jj.done(aid, 'extracted') and 
+                        fetch.latex_exists(aid))
+                error = attempt('extract', extract, aid, done)
+            to_scrape.put((index, aid, error))
+
+    downloaders = [threading.Thread(target=downloader, name='pipeline-download')
+                   for ii in range(max(1, min(threads, len(aids))))]
+    workers = downloaders + [threading.Thread(target=extractor, name='pipeline-extract')]
+
+    def stop_workers():
+        """Wait for the other threads to finish.  If the run stopped
+        early they may be waiting to put things on queues that nobody
+        reads any more, or for things that will never come."""
+        stopping.append(True)
+        drain(todo)
+        while any(thread.is_alive() for thread in workers):
+            drain(to_extract)
+            drain(to_scrape)
+            if not any(thread.is_alive() for thread in downloaders):
+                try:
+                    to_extract.put_nowait(None)
+                except Queue.Full:
+                    pass
+            for thread in workers:
+                thread.join(0.1)
+
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+
+    own_conn = conn is None
+    if own_conn: conn = store.connect()
+    failures = {}
+    # index -> aid for papers that are done but can't be written yet
+    pending = {}
+    next_index = 0
+    try:
+        with journal.open_output(long_fn, offsets[0]) as l_outf:
+            with journal.open_output(short_fn, offsets[1]) as s_outf:
+                for ii in range(len(aids)):
+                    index, aid, error = get(to_scrape)
+                    if not error:
+                        done = (jj and not force and aid not in extracted and
+                                jj.done(aid, 'scraped') and store.has_paper(conn, aid))
+                        error = attempt('scrape', scrape, aid, done)
+                    if error:
+                        failures[aid] = error
+                        if error != 'cancelled': print "Failed", aid, error
+                    pending[index] = aid
+                    while next_index in pending:
+                        aid = pending.pop(next_index)
+                        if aid not in failures:
+                            with metrics.timer('export'):
+                                store.export_paper(conn, aid, l_outf, s_outf)
+                            if jj:
+                                # The output has to be on disk before
+                                # the journal says it is.
+                                l_outf.flush()
+                                s_outf.flush()
+                                jj.record(aid, 'emitted', 
+                                          long=l_outf.tell(), short=s_outf.tell())
+                        next_index += 1
+    finally:
+        stop_workers()
+        if own_conn: conn.close()
+        if jj: jj.close()
+
+    if fatal:
+        exc_type, exc_value, exc_tb = fatal[0]
+        raise exc_type, exc_value, exc_tb
+    if failures: print len(failures), "papers failed"
+    return failures
+
+def get(queue):
+    "Get the next item from queue in a way that ^C can interrupt"
+    while True:
+        try:
+            return queue.get(timeout=poll_interval)
+        except Queue.Empty:
+            pass
+
+def drain(queue):
+    "Throw away everything on queue"
+    while True:
+        try:
+            queue.get_nowait()
+        except Queue.Empty:
+            return
+
+def can_resume(jj, aids, long_fn, short_fn):
+    """Can the output files be appended to, rather than started over?
+
+    Only if the papers written last time are among the ones given
+    this time, and the output files are still there.
+    """
+    if not jj.resume(aids):
+        return False
+    for fn, offset in zip((long_fn, short_fn), jj.offsets):
+        if not os.path.exists(fn) or os.path.getsize(fn) < offset:
+            return False
+    return True
@@ -0,0 +1,120 @@
+#########
+# Notes #
+#########
+#
+# Record files hold the comments scraped from lots of papers, one
+# JSON object per line:
+#
+#   {"aid": "1211.1574", "long": [["% line\n", "% line"], ...], "short": ["% comment", ...]}
+#
+# Records are written one paper at a time as they're scraped, so a
+# dump of the whole corpus takes constant memory.  Since records are
+# only ever appended, an interrupted dump can be picked up where it
+# left off (see dump()), and since each record is one line, a big file
+# can be read in pieces by byte offset, eg, by several processes at
+# once (see iter_records() and ranges()).
+#
+# File names ending in .gz are gzipped.  Offsets in gzipped files
+# refer to the uncompressed data, and seeking in them means
+# decompressing everything before the offset.  A gzipped file that
+# was cut off in the middle of a write can't be appended to, so
+# resuming only works for plain files in that case.
+
+from __future__ import with_statement
+
+import os, gzip, json
+
+import scrape
+
+verbose = True
+
+def open_records(fn, mode='rb'):
+    "Open a record file, gzipped or not according to the name"
+    if fn.endswith('.gz'):
+        return gzip.open(fn, mode)
+    return open(fn, mode)
+
+def write_record(ff, aid, l_comments, s_comments):
+    "Append the record for one paper to file object ff"
+    ff.write(json.dumps(dict(aid=aid, long=l_comments, short=s_comments)))
+    ff.write('\n')
+
+def iter_records(fn, start=0, stop=None):
+    """Yield the records in fn one at a time as (offset, record) pairs.
+
+    Only records that begin at offsets in [start, stop) are read, so
+    several readers can split a file between them with ranges().  A
+    line that was cut off by an interrupted write is skipped.
+    """
+    with open_records(fn, 'rb') as ff:
+        offset = start
+        if start > 0:
+            # Find the start of the first record at or after start
+            ff.seek(start - 1)
+            offset = start - 1 + len(ff.readline())
+        while stop is None or offset < stop:
+            line = ff.readline()
+            if not line.endswith('\n'):
+                break
+            yield offset, json.loads(line)
+            offset += len(line)
+
+def ranges(fn, n):
+    """Split fn into n (start, stop) byte ranges for iter_records.
+
+    Gzipped files can't be split without decompressing them, so they
+    come back as a single range.
+    """
+    if fn.endswith('.gz'):
+        return [(0, None)]
+    size = os.path.getsize(fn)
+    bounds = [size*ii//n for ii in range(n)] + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def done_aids(fn):
+    "The set of arxiv ids that already have records in fn"
+    if not os.path.exists(fn):
+        return set()
+    return set(record['aid'] for offset, record in iter_records(fn))
+
+def truncate_partial(fn):
+    "Cut off a partial record left at the end of a plain file by a crash"
+    if fn.endswith('.gz') or not os.path.exists(fn):
+        return
+    with open(fn, 'rb+') as ff:
+        ff.seek(0, os.SEEK_END)
+        end = ff.tell()
+        while end > 0:
+            start = max(0, end - 4096)
+            ff.seek(start)
+            newline = ff.read(end - start).rfind('\n')
+            if newline >= 0:
+                end = start + newline + 1
+                break
+            end = start
+        ff.truncate(end)
+
+def dump(aids, fn):
+    """Scrape the given papers and append their records to fn.
+
+    Papers that already have a record in fn are skipped, so running
+    this again after a crash continues where it left off.  Return the
+    number of records written.
+    """
+    done = done_aids(fn)
+    truncate_partial(fn)
+    n_written = 0
+    with open_records(fn, 'ab') as ff:
+        for aid in aids:
+            if aid in done:
+                continue
+            try:
+                if verbose: print "Scraping comments from ", aid
+                l_comments, s_comments = scrape.comments(aid)
+            except TypeError:
+                print "Kill (type)", aid
+                continue
+            write_record(ff, aid, l_comments, s_comments)
+            done.add(aid)
+            n_written += 1
+    return n_written
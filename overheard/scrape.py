@@ -10,12 +10,19 @@
 # Comments: Backslash-percent (to get percent into the latex output)
 # shows up in the python strings as "\\%" and a regexp for just '%'
 # doesn't match them, which simplifies my life...
+#
+# comments() works on the raw bytes where it can (scan_bytes): the
+# latex file is memory mapped, the search jumps from one '%' to the
+# next, and only the comments are decoded.  Files in utf-16/32, with
+# '\r' line endings, or with non-ascii comments that readtext() would
+# have decoded differently go the slow way, through readtext() and
+# comments_from_text().  Both give the same answer.
 
 from __future__ import with_statement
 
-import os, re, io
+import os, re, io, codecs, mmap
 
-import fetch, util
+import fetch, records, metrics, shard
 
 verbose = True
 
@@ -42,34 +49,171 @@ encodings = ['utf-8',
              'ucs-2',
              'ucs-4']
 
-def readlines(fn):
-    """Read all lines from fn
+# Encodings that can be declared with \usepackage[...]{inputenc}
+inputenc_encodings = {'utf8': 'utf-8',
+                      'utf8x': 'utf-8',
+                      'ascii': 'utf-8',
+                      'latin1': 'latin-1',
+                      'latin2': 'iso8859-2',
+                      'latin9': 'iso8859-15',
+                      'ansinew': 'cp1252',
+                      'cp1250': 'cp1250',
+                      'cp1251': 'cp1251',
+                      'cp1252': 'cp1252',
+                      'cp437': 'cp437',
+                      'cp850': 'cp850',
+                      'koi8-r': 'koi8-r',
+                      'applemac': 'mac-roman'}
+
+inputenc_regexp = re.compile(br'\\usepackage\[([^]]*)\]\{inputenc\}')
+
+# When guessing the encoding, look at this much of the start of the
+# file.  Files are decoded in chunks of chunk_size after that.
+sample_size = 64*1024
+chunk_size = 256*1024
+
+# If the guess turns out to be wrong further into the file, the rest
+# of the file is decoded with this, which accepts anything.  This is
+# what used to happen when a file failed to decode as utf-8.
+fallback_encoding = 'latin-1'
 
-    Loop over guesses at the text encoding.
+boms = [(codecs.BOM_UTF32_LE, 'utf-32'),
+        (codecs.BOM_UTF32_BE, 'utf-32'),
+        (codecs.BOM_UTF8, 'utf-8-sig'),
+        (codecs.BOM_UTF16_LE, 'utf-16'),
+        (codecs.BOM_UTF16_BE, 'utf-16')]
 
-    Can/should be more intelligent about this + read first big of file
-    to see if encoding is specified.
+def guess_encoding(sample):
+    """Guess the text encoding of a file from the first bit of it.
 
+    Byte order marks win, then non-ascii text that's valid utf-8, then
+    an inputenc declaration, then the first of the encodings list that
+    can decode the sample.
     """
-    lines = None
-    error = None
+    for bom, enc in boms:
+        if sample.startswith(bom):
+            return enc
+
+    def decodes(enc):
+        try:
+            # Not final, the sample may end part way through a character
+            codecs.getincrementaldecoder(enc)().decode(sample, False)
+        except (UnicodeDecodeError, LookupError):
+            return False
+        return True
+
+    is_ascii = not sample.translate(None, bytes(bytearray(range(128))))
+    if not is_ascii and decodes('utf-8'):
+        return 'utf-8'
+
+    declared = None
+    for match in inputenc_regexp.finditer(sample):
+        for option in match.group(1).decode('ascii', 'replace').split(','):
+            declared = inputenc_encodings.get(option.strip(), declared)
+    if declared:
+        return declared
+
     for enc in encodings:
+        if decodes(enc):
+            return enc
+    return fallback_encoding
+
+def decoded_chunks(ff):
+    """Decode the binary file object ff a chunk at a time.
+
+    If the guessed encoding fails part way through, everything from
+    that point on is decoded with fallback_encoding.
+    """
+    data = ff.read(sample_size)
+    encoding = guess_encoding(data)
+    decoder = codecs.getincrementaldecoder(encoding)()
+    while True:
+        buffered = decoder.getstate()[0]
         try:
-            with io.open(fn, encoding=enc) as ff:
-                lines = ff.readlines()
+            text = decoder.decode(data, not data)
         except UnicodeDecodeError, exc:
-            error = exc
+            if encoding == fallback_encoding: raise
+            # exc.start counts from the start of the bytes the decoder
+            # was holding on to from the last chunk.
+            data = buffered + data
+            text = data[:exc.start].decode(encoding, 'replace')
+            data = data[exc.start:]
+            encoding = fallback_encoding
+            decoder = codecs.getincrementaldecoder(encoding)()
+            if text: yield text
+            continue
+        if text: yield text
+        if not data: break
+        data = ff.read(chunk_size)
+
+def split_lines(chunks):
+    """Split decoded chunks of text into lines.
+
+    Lines end with '\n', '\r\n', or '\r' and all come out ending
+    with '\n', the same as a file opened in text mode.
+    """
+    parts = []
+    hold = u''
+    for chunk in chunks:
+        chunk = hold + chunk
+        # A '\r' at the end of the chunk may be half of a '\r\n'
+        hold = u''
+        if chunk.endswith(u'\r'):
+            chunk, hold = chunk[:-1], u'\r'
+        lines = chunk.replace(u'\r\n', u'\n').replace(u'\r', u'\n').split(u'\n')
+        if len(lines) == 1:
+            parts.append(lines[0])
             continue
-        # Making it here means there were no errors on read.  Accept
-        # the encoding and continue
-        return lines
-    # This means no encodings were successful, raise exception
-    if lines is None:
-        raise error
+        parts.append(lines[0])
+        yield u''.join(parts) + u'\n'
+        for line in lines[1:-1]:
+            yield line + u'\n'
+        parts = [lines[-1]]
+    tail = u''.join(parts) + hold.replace(u'\r', u'\n')
+    if tail:
+        yield tail
+
+def open_input(fn):
+    """Open fn for reading in binary mode.  fn can also be a file
+    object that's already open (eg, from fetch.open_latex)."""
+    if hasattr(fn, 'read'):
+        return fn
+    return io.open(fn, 'rb')
+
+def iterlines(fn):
+    """Yield the lines of fn one at a time, decoded to unicode.
+
+    The encoding is guessed from the start of the file (see
+    guess_encoding), and the file is only read once, a chunk at a
+    time, so big files are never held in memory.  fn is a file name
+    or an open binary file.
+    """
+    with open_input(fn) as ff:
+        for line in split_lines(decoded_chunks(ff)):
+            yield line
+
+def readlines(fn):
+    """Read all lines from fn into a list
+
+    Use iterlines() unless you really need all the lines at once.
+    """
+    return list(iterlines(fn))
+
+def readtext(fn):
+    """Read all of fn into one unicode string.
+
+    Decoding is the same as iterlines(), and newlines are translated
+    the same way.
+    """
+    with open_input(fn) as ff:
+        text = u''.join(decoded_chunks(ff))
+    if u'\r' in text:
+        text = text.replace(u'\r\n', u'\n').replace(u'\r', u'\n')
+    return text
 
 def long_comments(aid):
     "Scrape full-line and multi-line comments out of latex file"
-    lines = readlines(fetch.latex_file_path(aid))
+    lines = iterlines(fetch.open_latex(aid))
     return long_comments_from_lines(lines)
 
 def long_comments_from_lines(lines):
@@ -106,7 +250,7 @@ def long_comments_from_lines(lines):
 
 def short_comments(aid):
     "Scrape partial-line comments out of latex file"
-    lines = readlines(fetch.latex_file_path(aid))
+    lines = iterlines(fetch.open_latex(aid))
     return short_comments_from_lines(lines)
 
 def short_comments_from_lines(lines):
@@ -120,45 +264,234 @@ def short_comments_from_lines(lines):
                 result.append(match.group(1))
     return result
 
-def write_output(aids, long_fn, short_fn, pickle_fn=None):
-    "Scrape long and short comments, write to output files."
-    # If pickle_fn is given, collect everything into one dict and
-    # write to a pickled python obj.  Protect this code with if's b/c
-    # it can easly create a giant object that fills memory, so we
-    # don't want to create this object unless it's necessary.
+# Matches whitespace followed by a percent sign.  Anchored at the
+# start of a line, this says the line is a long comment.
+long_comment_start_regexp = re.compile(r'\s*%')
+
+def comments(aid):
+    "Scrape long and short comments out of latex file"
+    # Try the byte-level scan first (see scan_bytes), it almost
+    # always works.
+    fn = fetch.latex_file_path(aid)
+    if os.path.exists(fn):
+        return scan_file(fn)
+    return scan_data(fetch.open_latex(aid).read())
+
+def scan_file(fn):
+    """Same as comments_from_text(readtext(fn)), but the file is
+    memory mapped and searched without decoding all of it."""
+    with open(fn, 'rb') as ff:
+        if os.fstat(ff.fileno()).st_size == 0:
+            return [], []
+        data = mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        result = scan_bytes(data)
+    finally:
+        data.close()
+    if result is None:
+        result = comments_from_text(readtext(fn))
+    return result
+
+def scan_data(data):
+    "Same as comments_from_text(readtext(...)) for latex in a string"
+    result = scan_bytes(data)
+    if result is None:
+        result = comments_from_text(readtext(io.BytesIO(data)))
+    return result
+
+def shard_comments(yymm):
+    """Yield (aid, long_comments, short_comments) for every paper in
+    the shard for yymm.
+
+    The shard is read front to back, which is much faster than
+    reading the papers one at a time by arxiv id.
+    """
+    sh = shard.get_shard(yymm)
+    if sh is None:
+        return
+    for aid, data in sh.iter_papers():
+        l_comments, s_comments = scan_data(data)
+        yield aid, l_comments, s_comments
+
+def comments_from_text(text):
+    """Get long and short comments out of the text of a latex file.
+
+    Return (long_comments, short_comments), exactly what
+    long_comments_from_lines and short_comments_from_lines return for
+    the lines of text.  Rather than running regexps on every line,
+    this jumps from one percent sign to the next and only looks at
+    the lines that have them.
+    """
+    long_result = []
+    short_result = []
+    # Current long comment, and where the last line of it ends
+    comment = None
+    comment_end = -1
+
+    n = len(text)
+    find, rfind = text.find, text.rfind
+    match_long = long_comment_start_regexp.match
+    pos = find(u'%')
+    while pos >= 0:
+        start = rfind(u'\n', 0, pos) + 1
+        end = find(u'\n', pos)
+        if end < 0: end = n
+        if match_long(text, start):
+            if comment is not None and start == comment_end + 1:
+                # continuation of comment
+                comment.append(text[pos:end])
+            else:
+                # beginning of comment, after the end of the last one
+                if comment is not None: long_result.append(comment)
+                comment = [text[start:end+1]]
+            comment_end = end
+        else:
+            short_result.append(text[pos:end])
+        pos = find(u'%', end)
+
+    # A comment only ends when a non-comment line follows it, so a
+    # comment at the very end of the file doesn't count.
+    if comment is not None and comment_end + 1 < n:
+        long_result.append(comment)
+    return long_result, short_result
+
+# Encodings in which every byte below 0x80 is that ascii character
+# and is never part of a multibyte character.  In these, '%' and '\n'
+# can be found in the raw bytes.
+ascii_compatible = set(codecs.lookup(enc).name for enc in 
+                       ['utf-8', 'latin-1', 'iso8859-2', 'iso8859-15', 'GB2312',
+                        'cp1250', 'cp1251', 'cp1252', 'cp437', 'cp850', 
+                        'koi8-r', 'mac-roman'])
+
+long_comment_start_bytes = re.compile(br'\s*%')
+non_ascii_bytes = re.compile(br'[\x80-\xff]')
+
+def decodes_cleanly(data, start, stop, encoding):
+    """Does data[start:stop] decode with encoding?  It's checked a
+    chunk at a time and the text is thrown away."""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    try:
+        for pos in range(start, stop, chunk_size):
+            decoder.decode(data[pos:min(pos + chunk_size, stop)], pos + chunk_size >= stop)
+    except UnicodeDecodeError:
+        return False
+    return True
 
-    if pickle_fn:
-        s_result = {}
-        l_result = {}
+def scan_bytes(data):
+    """Get long and short comments out of the raw bytes of a latex file.
+
+    data is a string or anything else that has find(), rfind(), and
+    slicing, like an mmap.  This is comments_from_text() done on the
+    bytes, and only the comments are decoded, so there's no unicode
+    copy of the whole file and no list of lines.  The result is the
+    same as comments_from_text(readtext(...)).
+
+    That only works if the encoding is ascii compatible, there are no
+    '\r' line endings to translate, and the comments decode the same
+    way readtext would decode them.  Otherwise return None.
+    """
+    encoding = guess_encoding(data[:sample_size])
+    base = 0
+    if encoding == 'utf-8-sig':
+        encoding, base = 'utf-8', len(codecs.BOM_UTF8)
+    if (codecs.lookup(encoding).name not in ascii_compatible or 
+        data.find(b'\r') >= 0):
+        metrics.count('scan_fallbacks')
+        return None
+
+    long_result = []
+    short_result = []
+    comment = None
+    comment_end = -1
+    # End of the last comment with non-ascii bytes in it
+    non_ascii_end = base
+
+    n = len(data)
+    find, rfind = data.find, data.rfind
+    match_long = long_comment_start_bytes.match
+    has_non_ascii = non_ascii_bytes.search
+    pos = find(b'%', base)
+    try:
+        while pos >= 0:
+            start = max(base, rfind(b'\n', 0, pos) + 1)
+            end = find(b'\n', pos)
+            if end < 0: end = n
+            if match_long(data, start):
+                if comment is not None and start == comment_end + 1:
+                    span = data[pos:end]
+                    comment.append(span.decode(encoding))
+                else:
+                    if comment is not None: long_result.append(comment)
+                    span = data[start:end+1]
+                    comment = [span.decode(encoding)]
+                comment_end = end
+            else:
+                span = data[pos:end]
+                short_result.append(span.decode(encoding))
+            if has_non_ascii(span): non_ascii_end = end
+            pos = find(b'%', end)
+    except UnicodeDecodeError:
+        metrics.count('scan_fallbacks')
+        return None
+
+    # Ascii comes out the same in every ascii compatible encoding.
+    # Comments with anything else in them would have come out
+    # differently if readtext had hit something that doesn't decode
+    # before them and switched to fallback_encoding.
+    if (non_ascii_end > base and codecs.lookup(encoding).name != 'iso8859-1' and
+        not decodes_cleanly(data, base, non_ascii_end, encoding)):
+        metrics.count('scan_fallbacks')
+        return None
+
+    if comment is not None and comment_end + 1 < n:
+        long_result.append(comment)
+    return long_result, short_result
+
+def write_comments(aid, l_outf, s_outf, l_comments, s_comments):
+    """Write the comments for one paper to the long and short output files.
+
+    Long comments are lists of lines (or strings), short comments are
+    strings.  Return False if the paper couldn't be written.
+    """
+    try:
+        for comment in l_comments:
+            l_outf.writelines(comment)
+            l_outf.write('\n')
+
+        for comment in s_comments:
+            s_outf.write(comment)
+            s_outf.write('\n')
+    except UnicodeEncodeError:
+        print "Kill (unicode)", aid
+        metrics.failure(aid, 'unicode')
+        return False
+    return True
+
+@metrics.timed('scrape')
+def write_output(aids, long_fn, short_fn, records_fn=None):
+    "Scrape long and short comments, write to output files."
+    # If records_fn is given, also append a record for each paper to
+    # that file as it's scraped (see records.py).  This used to
+    # collect everything into one dict and pickle it, which could
+    # easily create a giant object that filled memory.
 
     with open(long_fn, 'w') as l_outf:
         with open(short_fn, 'w') as s_outf:
-            for aid in aids:
-                try:
-                    if verbose: print "Scraping comments from ", aid
-
-                    lines = readlines(fetch.latex_file_path(aid))
-
-                    l_comments = long_comments_from_lines(lines)
-                    s_comments = short_comments_from_lines(lines)
-
-                    for comment in l_comments:
-                        l_outf.writelines(comment)
-                        l_outf.write('\n')
-
-                    for comment in s_comments:
-                        s_outf.write(comment)
-                        s_outf.write('\n')
-
-                    if pickle_fn:
-                        l_result[aid] = l_comments
-                        s_result[aid] = s_comments
-                except TypeError:
-                    print "Kill (type)", aid
-                    continue
-                except UnicodeEncodeError:
-                    print "Kill (unicode)", aid
-                    continue
-
-    if pickle_fn:
-        util.can((l_result,s_result), pickle_fn)
+            r_outf = records.open_records(records_fn, 'ab') if records_fn else None
+            try:
+                for aid in aids:
+                    try:
+                        if verbose: print "Scraping comments from ", aid
+                        l_comments, s_comments = comments(aid)
+                    except TypeError:
+                        print "Kill (type)", aid
+                        metrics.failure(aid, 'type')
+                        continue
+                    metrics.count('papers_scraped')
+
+                    write_comments(aid, l_outf, s_outf, l_comments, s_comments)
+
+                    if r_outf:
+                        records.write_record(r_outf, aid, l_comments, s_comments)
+            finally:
+                if r_outf: r_outf.close()
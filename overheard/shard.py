@@ -0,0 +1,185 @@
+#########
+# Notes #
+#########
+#
+# The latex tree has one uncompressed file per paper: for the whole
+# archive that's about a million files and tens of GB of very
+# compressible text.  A shard packs one yymm directory of the latex
+# tree into a single file in which each paper is compressed
+# separately, with an index so that any one paper can be read without
+# decompressing the others.  Reading a whole shard front to back is
+# sequential I/O over a fraction of the bytes.
+#
+# Layout of shards/yymm.shard:
+#
+#   magic                      8 bytes
+#   zlib data for each paper   in arxiv id order
+#   index                      JSON: {"aid": [offset, length, size], ...}
+#   index offset, magic        8 + 8 bytes
+#
+# length is the compressed length and size the uncompressed size.
+# Shards are read through mmap, so opening one only reads the index.
+#
+# Packing is optional and done by hand (pack() or pack_all()).
+# Everything that reads latex by arxiv id (fetch.open_latex, and so
+# scrape and store) reads a loose latex file if there is one, and
+# otherwise looks in the shard.  Papers extracted after a month was
+# packed go into the latex tree as usual, and packing the month again
+# merges them in.
+#
+# Usage:
+#   shard.pack('1401', remove=True)
+#   for aid, data in shard.Shard(shard.shard_path('1401')).iter_papers(): ...
+#
+
+from __future__ import with_statement
+
+import os, re, json, zlib, mmap, struct, threading
+
+import path, fetch
+
+magic = b'OVHSHRD1'
+trailer = struct.Struct('<Q8s')
+
+# zlib compression level for packing
+level = 6
+
+def shard_path(yymm):
+    "Full path to the shard for a yymm directory"
+    return os.path.join(path.shards, yymm + '.shard')
+
+class Shard(object):
+    "Read-only access to one shard"
+
+    def __init__(self, fn):
+        self.fn = fn
+        with open(fn, 'rb') as ff:
+            size = os.fstat(ff.fileno()).st_size
+            if size < len(magic) + trailer.size:
+                raise IOError, "Not a shard: %s" % fn
+            self.map = mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ)
+        index_offset, end_magic = trailer.unpack(self.map[-trailer.size:])
+        if self.map[:len(magic)] != magic or end_magic != magic:
+            self.map.close()
+            raise IOError, "Not a shard: %s" % fn
+        self.index = dict((str(aid), entry) for aid, entry in 
+                          json.loads(self.map[index_offset:size - trailer.size]).items())
+
+    def close(self):
+        self.map.close()
+
+    def __contains__(self, aid):
+        return aid in self.index
+
+    def aids(self):
+        "The arxiv ids in the shard, in the order they're stored"
+        return sorted(self.index, key=lambda aid: self.index[aid][0])
+
+    def size(self, aid):
+        "Uncompressed size of the latex for aid"
+        return self.index[aid][2]
+
+    def read(self, aid):
+        "Return the latex for aid"
+        offset, length, size = self.index[aid]
+        return zlib.decompress(self.map[offset:offset + length])
+
+    def iter_papers(self):
+        "Yield (aid, latex) for every paper, reading the shard front to back"
+        for aid in self.aids():
+            yield aid, self.read(aid)
+
+# Shards that are open, keyed by file name, with the mtime and size
+# of the file when it was opened.
+open_shards = {}
+open_shards_max = 64
+open_shards_lock = threading.Lock()
+
+def get_shard(yymm):
+    "Return the Shard for yymm, or None if there isn't one"
+    fn = shard_path(yymm)
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    stamp = (st.st_mtime, st.st_size)
+    with open_shards_lock:
+        cached = open_shards.get(fn)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        if cached:
+            # The shard was packed again; anyone still reading the
+            # old one keeps their mmap of it.
+            del open_shards[fn]
+        if len(open_shards) >= open_shards_max:
+            open_shards.clear()
+        result = Shard(fn)
+        open_shards[fn] = (stamp, result)
+        return result
+
+def read_latex(aid):
+    "Return the latex for aid from its shard, or None if it isn't there"
+    sh = get_shard(fetch.dir_prefix(aid))
+    if sh is None or aid not in sh:
+        return None
+    return sh.read(aid)
+
+def has_latex(aid):
+    sh = get_shard(fetch.dir_prefix(aid))
+    return sh is not None and aid in sh
+
+def pack(yymm, remove=False):
+    """Pack the latex files in one yymm directory into its shard.
+
+    Papers already in the shard are kept (a loose latex file replaces
+    the packed one).  If remove is True, the loose files are deleted
+    once they're safely in the shard.  Return the number of papers in
+    the shard.
+    """
+    dir = os.path.join(path.latex, yymm)
+    loose = {}
+    if os.path.isdir(dir):
+        for fn in os.listdir(dir):
+            aid, ext = fetch.file_name_to_aid(fn)
+            if aid and ext == '.tex':
+                loose[aid] = os.path.join(dir, fn)
+    old = get_shard(yymm)
+    aids = sorted(set(loose) | set(old.index if old else ()))
+    if not aids:
+        return 0
+
+    fn = shard_path(yymm)
+    fetch.ensure_dirs_exist(fn)
+    part_fn = fn + '.part'
+    index = {}
+    try:
+        with open(part_fn, 'wb') as ff:
+            ff.write(magic)
+            for aid in aids:
+                if aid in loose:
+                    with open(loose[aid], 'rb') as inf:
+                        data = inf.read()
+                else:
+                    data = old.read(aid)
+                compressed = zlib.compress(data, level)
+                index[aid] = [ff.tell(), len(compressed), len(data)]
+                ff.write(compressed)
+            index_offset = ff.tell()
+            ff.write(json.dumps(index, sort_keys=True))
+            ff.write(trailer.pack(index_offset, magic))
+        os.rename(part_fn, fn)
+    finally:
+        if os.path.exists(part_fn):
+            os.remove(part_fn)
+
+    if remove:
+        for aid_fn in loose.values():
+            os.remove(aid_fn)
+    return len(aids)
+
+def pack_all(remove=False):
+    "Pack every yymm directory of the latex tree, return the number of papers"
+    if not os.path.isdir(path.latex):
+        return 0
+    return sum(pack(yymm, remove=remove) for yymm in sorted(os.listdir(path.latex))
+               if re.match('^[0-9]{4}$', yymm))
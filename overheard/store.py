@@ -0,0 +1,188 @@
+#########
+# Notes #
+#########
+#
+# Comments scraped from papers are kept in a sqlite database so that
+# anything corpus-wide doesn't mean scraping everything again.  Each
+# paper is scraped once; after that the comments come out of the
+# database.  The daily -long.tex and -short.tex files are written from
+# here by export().
+#
+# The comment text goes in a full text search (FTS5) table if the
+# sqlite library has it, otherwise in a plain table that's searched
+# with LIKE.
+#
+# Usage:
+#   conn = store.connect()
+#   store.update(conn, aids)
+#   store.query(conn, yymm='1401', text='referee')
+#
+
+from __future__ import with_statement
+
+import sqlite3, time
+
+import path, arxiv_id, scrape, metrics
+
+verbose = True
+
+kinds = ('long', 'short')
+
+schema = ['''CREATE TABLE IF NOT EXISTS papers (
+               aid TEXT PRIMARY KEY,
+               paper TEXT,
+               version TEXT,
+               archive TEXT,
+               yymm TEXT,
+               scraped REAL)''',
+          'CREATE INDEX IF NOT EXISTS papers_yymm ON papers (yymm)',
+          'CREATE INDEX IF NOT EXISTS papers_archive ON papers (archive)']
+
+fts_schema = '''CREATE VIRTUAL TABLE IF NOT EXISTS comments USING fts5 (
+                  aid UNINDEXED, kind UNINDEXED, seq UNINDEXED, body)'''
+
+plain_schema = ['''CREATE TABLE IF NOT EXISTS comments (
+                     aid TEXT, kind TEXT, seq INTEGER, body TEXT)''',
+                'CREATE INDEX IF NOT EXISTS comments_aid ON comments (aid)']
+
+def connect(fn=None):
+    "Open the comment store, creating it if necessary."
+    conn = sqlite3.connect(fn or path.store)
+    for statement in schema:
+        conn.execute(statement)
+    try:
+        conn.execute(fts_schema)
+    except sqlite3.OperationalError:
+        # No FTS5 in this sqlite
+        for statement in plain_schema:
+            conn.execute(statement)
+    conn.commit()
+    return conn
+
+def has_fts(conn):
+    "Is the comments table a full text search table?"
+    sql = conn.execute("SELECT sql FROM sqlite_master WHERE name='comments'").fetchone()[0]
+    return 'fts5' in sql.lower()
+
+def has_paper(conn, aid):
+    "Have the comments for this paper been stored?"
+    return conn.execute('SELECT 1 FROM papers WHERE aid=?', (aid,)).fetchone() is not None
+
+def add_paper(conn, aid, l_comments, s_comments):
+    """Store the comments for one paper, replacing any already there.
+
+    l_comments and s_comments are as returned by scrape.comments()
+    """
+    parsed = arxiv_id.parse(aid)
+    remove_paper(conn, aid)
+    conn.execute('INSERT INTO papers VALUES (?, ?, ?, ?, ?, ?)',
+                 (aid, parsed.unversioned, parsed.version, parsed.archive, 
+                  parsed.yymm, time.time()))
+    # Long comments are lists of lines, store them the way they're
+    # written out.
+    rows = ([(aid, 'long', ii, u''.join(comment)) 
+             for ii, comment in enumerate(l_comments)] + 
+            [(aid, 'short', ii, comment) 
+             for ii, comment in enumerate(s_comments)])
+    conn.executemany('INSERT INTO comments (aid, kind, seq, body) VALUES (?, ?, ?, ?)',
+                     rows)
+
+def remove_paper(conn, aid):
+    conn.execute('DELETE FROM comments WHERE aid=?', (aid,))
+    conn.execute('DELETE FROM papers WHERE aid=?', (aid,))
+
+def paper_comments(conn, aid, kind):
+    "Return the comments of one kind for a paper, in order"
+    return [row[0] for row in 
+            conn.execute('SELECT body FROM comments WHERE aid=? AND kind=? '
+                         'ORDER BY CAST(seq AS INTEGER)', (aid, kind))]
+
+@metrics.timed('scrape')
+def update(conn, aids, force=False):
+    """Scrape the given papers into the store.
+
+    Papers that are already in the store are skipped unless force is
+    True.  Return the number of papers scraped.
+    """
+    n_scraped = 0
+    for aid in aids:
+        if update_paper(conn, aid, force):
+            n_scraped += 1
+    return n_scraped
+
+def update_paper(conn, aid, force=False):
+    "Scrape one paper into the store, return True if it was scraped"
+    if not force and has_paper(conn, aid):
+        if verbose: print "Using stored comments for", aid
+        metrics.count('store_hits')
+        return False
+    try:
+        if verbose: print "Scraping comments from ", aid
+        l_comments, s_comments = scrape.comments(aid)
+    except TypeError:
+        print "Kill (type)", aid
+        metrics.failure(aid, 'type')
+        return False
+    add_paper(conn, aid, l_comments, s_comments)
+    # Commit as we go so an interrupted run keeps what it's done
+    conn.commit()
+    metrics.count('papers_scraped')
+    return True
+
+def query(conn, yymm=None, archive=None, text=None, kind=None):
+    """Find comments.
+
+    All of the arguments are optional, and those that are given must
+    all match.  yymm is a string like '1401' or a (first, last) pair
+    of them, text is an FTS5 query (or a substring if the store
+    doesn't have FTS5).
+
+    Return a list of (aid, kind, comment) tuples.
+    """
+    sql = ('SELECT comments.aid, comments.kind, comments.body '
+           'FROM comments JOIN papers ON comments.aid = papers.aid')
+    where = []
+    args = []
+    if isinstance(yymm, (tuple, list)):
+        where.append('papers.yymm BETWEEN ? AND ?')
+        args.extend(yymm)
+    elif yymm is not None:
+        where.append('papers.yymm = ?')
+        args.append(yymm)
+    if archive is not None:
+        where.append('papers.archive = ?')
+        args.append(archive)
+    if kind is not None:
+        where.append('comments.kind = ?')
+        args.append(kind)
+    if text is not None:
+        if has_fts(conn):
+            where.append('comments MATCH ?')
+            args.append(text)
+        else:
+            where.append('comments.body LIKE ?')
+            args.append('%' + text + '%')
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY papers.yymm, comments.aid, comments.kind, CAST(comments.seq AS INTEGER)'
+    return conn.execute(sql, args).fetchall()
+
+@metrics.timed('export')
+def export(conn, aids, long_fn, short_fn):
+    """Write the stored comments for the given papers to flat files.
+
+    The files are the same as the ones scrape.write_output() writes.
+    Papers that aren't in the store are skipped.
+    """
+    with open(long_fn, 'w') as l_outf:
+        with open(short_fn, 'w') as s_outf:
+            for aid in aids:
+                export_paper(conn, aid, l_outf, s_outf)
+
+def export_paper(conn, aid, l_outf, s_outf):
+    "Write the stored comments for one paper to open flat files"
+    if not has_paper(conn, aid):
+        return False
+    return scrape.write_comments(aid, l_outf, s_outf,
+                                 paper_comments(conn, aid, 'long'),
+                                 paper_comments(conn, aid, 'short'))
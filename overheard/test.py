@@ -18,7 +18,8 @@
 #
 from __future__ import with_statement
 
-import unittest, re, tempfile, os
+import sys, unittest, re, tempfile, os, random, gzip, tarfile, shutil, io, time, threading, json, codecs
+import BaseHTTPServer, SocketServer
 
 if not hasattr(unittest, 'skipIf'):
     try: 
@@ -28,7 +29,7 @@ if not hasattr(unittest, 'skipIf'):
             """Tests require either the Python 2.7 or later version of the unittest module or
             the unittest2 module."""
 
-import arxiv_id, scrape, util, update, fetch, overheard
+import arxiv_id, scrape, util, update, fetch, overheard, path, store, records, manifest, metrics, pipeline, journal, shard, bulk, idset
 
 network_tests = True
 
@@ -42,6 +43,75 @@ test_aids = ['astro-ph/0701019',    # gzipped tex file
 test_delay = 2
 test_file = "overheard.py"
 
+def shutil_which(cmd):
+    "Is cmd on the path?"
+    return any(os.access(os.path.join(dd, cmd), os.X_OK)
+               for dd in os.environ.get('PATH', '').split(os.pathsep))
+
+latex_sample = (b'\\documentclass{article}\n'
+                b'% A long comment\n'
+                b'% that goes on\n'
+                b'\\begin{document}\n'
+                b'Some text % and a short comment\n'
+                b'\\end{document}\n')
+
+def gzip_bytes(data):
+    "Gzip data in memory"
+    bf = io.BytesIO()
+    gf = gzip.GzipFile(fileobj=bf, mode='wb')
+    gf.write(data)
+    gf.close()
+    return bf.getvalue()
+
+def slow_bulk_worker(args):
+    "Stand-in for bulk.worker that takes a while"
+    time.sleep(0.05)
+    return args[0], 0, True, ([], []), None
+
+def slow_latex_worker(args):
+    "Stand-in for fetch.latex_worker that takes a while"
+    time.sleep(0.05)
+    return args[0], 0, None
+
+class BrokenOutput(object):
+    def write(self, *args):
+        raise IOError, "disk full"
+
+    def close(self):
+        pass
+
+def sample_files(dir):
+    """Write one file of each type that fetch has to recognize to dir,
+    return the file names"""
+    def write(name, data):
+        fn = os.path.join(dir, name)
+        with open(fn, 'wb') as ff: ff.write(data)
+        return fn
+
+    tex_fn = write('paper.tex', latex_sample)
+    result = [tex_fn,
+              write('latin1.tex', latex_sample + b'Caf\xe9 na\xefve\n'),
+              write('paper.pdf', b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n1 0 obj\n'),
+              write('paper.ps', b'%!PS-Adobe-2.0\n%%Creator: dvips\n'),
+              write('paper.dvi', b'\xf7\x02\x01\x83\x92\xc0\x1c;\x00\x00\x00\x00\x03\xe8' + 
+                    b'\x1b TeX output 2014.04.01:1200\x8b' + b'\x00' * 64),
+              write('paper.data', bytes(bytearray(range(256))))]
+
+    tar_fn = os.path.join(dir, 'paper.tar')
+    tf = tarfile.open(tar_fn, 'w')
+    tf.add(tex_fn, 'paper.tex')
+    tf.close()
+    result.append(tar_fn)
+
+    for fn in (tex_fn, tar_fn):
+        gz_fn = fn + '.gz'
+        with open(fn, 'rb') as inf:
+            gf = gzip.open(gz_fn, 'wb')
+            gf.write(inf.read())
+            gf.close()
+        result.append(gz_fn)
+    return result
+
 class OverheardTest(unittest.TestCase):
 
     def setUp(self):
@@ -53,15 +123,22 @@ class OverheardTest(unittest.TestCase):
         # has hung.
         fetch.verbose = True
         scrape.verbose = False
+        # Keep the store and the rss cache out of the source tree
+        self.settings = path.store, path.rss_cache
+        self.tmpdir = tempfile.mkdtemp()
+        path.store = os.path.join(self.tmpdir, 'comments.db')
+        path.rss_cache = os.path.join(self.tmpdir, 'rss-cache.pickle')
 
     def tearDown(self):
         fetch.verbose = self.fetch_verbose_setting
         scrape.verbose = self.scrape_verbose_setting
+        path.store, path.rss_cache = self.settings
+        shutil.rmtree(self.tmpdir)
 
     @unittest.skipIf(not network_tests, "Skipping network tests.")
     def test_process_todays_papers(self):
         overheard.process_todays_papers(delay=test_delay, 
-                                        prefix=tempfile.gettempdir(), nmax=2)
+                                        prefix=self.tmpdir, nmax=2)
 
 
 class FetchTest(unittest.TestCase):
@@ -83,16 +160,6 @@ class FetchTest(unittest.TestCase):
         for aid in test_aids:
             fetch.arxiv_to_url(aid)
 
-    def test_fetch_command(self):
-        for aid in test_aids:
-            fetch.fetch_command(aid, "filename")
-
-    def test_untar_command(self):
-        fetch.untar_command("fake.tar")
-            
-    def test_gunzip_command(self):
-        fetch.gunzip_command("fake.gz")
-
     def test_latex_file_name(self):
         for aid in test_aids:
             fetch.latex_file_name(aid)
@@ -104,6 +171,11 @@ class FetchTest(unittest.TestCase):
     def test_file_name_base(self):
         for aid in test_aids:
             fetch.file_name_base(aid)
+        # Parsed ids give the same string
+        for aid in ['1211.1574v2', 'astro-ph/0701019']:
+            fn_base = fetch.file_name_base(arxiv_id.parse(aid))
+            self.assertTrue(isinstance(fn_base, str))
+            self.assertEqual(fn_base, fetch.file_name_base(aid))
 
     def test_source_file_extension(self):
         for aid in test_aids:
@@ -143,6 +215,49 @@ class FetchTest(unittest.TestCase):
     def test_is_other(self):
         fetch.is_other(test_file)
 
+    def test_sniff(self):
+        self.assertEqual(fetch.sniff(b'%PDF-1.4\n'), 'pdf')
+        self.assertEqual(fetch.sniff(b'\x1f\x8b\x08\x00'), 'gzip')
+        self.assertEqual(fetch.sniff(b'\xf7\x02\x01\x83'), 'dvi')
+        self.assertEqual(fetch.sniff(b'%!PS-Adobe-2.0\n'), 'postscript')
+        self.assertEqual(fetch.sniff(b'\\documentclass{article}\n'), 'text')
+        self.assertEqual(fetch.sniff(b'caf\xe9 % latin-1\n'), 'text')
+        self.assertEqual(fetch.sniff(b'\xff\xfe%\x00'), 'text')
+        self.assertEqual(fetch.sniff(b'\x00\x01\x02\x03'), 'data')
+        self.assertEqual(fetch.sniff(b''), 'data')
+
+    def test_file_type_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tmpdir, 'paper')
+            with open(fn, 'wb') as ff: ff.write(b'%PDF-1.4\n')
+            self.assertEqual(fetch.file_type(fn), 'pdf')
+            self.assertTrue(fn in fetch.file_type_cache)
+            with open(fn, 'wb') as ff: ff.write(b'\\begin{document}\n\n')
+            self.assertEqual(fetch.file_type(fn), 'text')
+        finally:
+            shutil.rmtree(tmpdir)
+
+    @unittest.skipIf(not shutil_which('file'), "Need the 'file' command.")
+    def test_file_type_matches_file_command(self):
+        # Decisions made by file_type() should agree with the regexps
+        # that used to be applied to the output of 'file'
+        regexps = dict(tar='tar archive', gzip='gzip compressed data',
+                       pdf='pdf document', dvi='tex dvi')
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for fn in sample_files(tmpdir):
+                desc = fetch.file_type_string(fn)
+                for ftype, regexp in regexps.items():
+                    self.assertEqual(bool(re.search(regexp, desc, re.I)),
+                                     fetch.file_type(fn) == ftype, 
+                                     (fn, desc))
+                self.assertEqual(bool(re.search('text|latex', desc, re.I) and 
+                                      not re.search('postscript', desc, re.I)),
+                                 bool(fetch.is_tex(fn)), (fn, desc))
+        finally:
+            shutil.rmtree(tmpdir)
+
     @unittest.skipIf(not network_tests, "Skipping network tests.")
     def test_fetch_source_and_latex(self):
         # the exercises fetch.source, fetch.all_source, fetch.latex, and
@@ -151,12 +266,1024 @@ class FetchTest(unittest.TestCase):
         fetch.all_latex(test_aids)
     
 
+class SourceFilesMixin(object):
+    # Put source files in place by hand in a temporary archive, so
+    # tests that use them don't need the network.
+    def setUp(self):
+        self.verbose_setting = fetch.verbose
+        self.path_settings = path.source, path.latex
+        fetch.verbose = False
+        self.tmpdir = tempfile.mkdtemp()
+        path.source = os.path.join(self.tmpdir, 'data')
+        path.latex = os.path.join(self.tmpdir, 'latex')
+
+        samples = dict((os.path.basename(fn), fn) 
+                       for fn in sample_files(self.tmpdir))
+        self.sources = {'astro-ph/0701019': samples['paper.tex.gz'],
+                        'astro-ph/0701528': samples['paper.tar.gz'],
+                        'astro-ph/0701864': samples['paper.pdf'],
+                        '1211.1574': samples['paper.tex.gz'],
+                        '1211.4164': samples['paper.tar.gz'],
+                        '1211.2577': samples['paper.pdf']}
+        for aid, fn in self.sources.items():
+            dest = (fetch.source_file_path_without_extension(aid) + 
+                    os.path.splitext(fn)[1])
+            fetch.ensure_dirs_exist(dest)
+            shutil.copy(fn, dest)
+
+    def tearDown(self):
+        fetch.verbose = self.verbose_setting
+        path.source, path.latex = self.path_settings
+        shutil.rmtree(self.tmpdir)
+
+    def gzip_source(self, aid, data):
+        "Put gzipped data in place as the source file for aid"
+        fn = fetch.source_file_path_without_extension(aid) + '.gz'
+        fetch.ensure_dirs_exist(fn)
+        gf = gzip.open(fn, 'wb')
+        gf.write(data)
+        gf.close()
+        return fn
+
+class LatexTest(SourceFilesMixin, unittest.TestCase):
+    def test_latex(self):
+        fetch.all_latex(test_aids)
+        for aid in test_aids:
+            with open(fetch.latex_file_path(aid), 'rb') as ff:
+                contents = ff.read()
+            if fetch.extension(self.sources[aid]) == 'pdf':
+                self.assertEqual(contents, b'')
+            else:
+                self.assertEqual(contents, latex_sample)
+
+    def read_latex(self, aid):
+        with open(fetch.latex_file_path(aid), 'rb') as ff:
+            return ff.read()
+
+    def test_latex_multiple_members_and_garbage(self):
+        aid = '1301.0001'
+        fn = self.gzip_source(aid, latex_sample)
+        with open(fn, 'rb') as ff: member = ff.read()
+        with open(fn, 'wb') as ff: ff.write(member + member + b'\x00' * 100)
+        fetch.latex(aid)
+        self.assertEqual(self.read_latex(aid), latex_sample + latex_sample)
+
+    def test_latex_truncated(self):
+        aid = '1301.0002'
+        data = latex_sample * 1000
+        fn = self.gzip_source(aid, data)
+        with open(fn, 'rb') as ff: compressed = ff.read()
+        with open(fn, 'wb') as ff: ff.write(compressed[:len(compressed)//2])
+        fetch.latex(aid)
+        contents = self.read_latex(aid)
+        self.assertTrue(0 < len(contents) < len(data))
+        self.assertTrue(data.startswith(contents))
+        self.assertFalse(os.path.exists(fetch.latex_file_path(aid) + '.part'))
+
+    def test_latex_tar_top_level_only(self):
+        aid = '1301.0003'
+        tar_fn = os.path.join(self.tmpdir, 'nested.tar')
+        tf = tarfile.open(tar_fn, 'w')
+        for name in ['./main.tex', 'figs/fig.tex', 'fig1.eps']:
+            info = tarfile.TarInfo(name)
+            info.size = len(latex_sample)
+            tf.addfile(info, io.BytesIO(latex_sample))
+        tf.close()
+        with open(tar_fn, 'rb') as ff: self.gzip_source(aid, ff.read())
+        fetch.latex(aid)
+        self.assertEqual(self.read_latex(aid), latex_sample)
+
+    def tar_bytes(self, members):
+        "A tar file with members, a list of (name, data) pairs"
+        out = io.BytesIO()
+        tf = tarfile.open(fileobj=out, mode='w')
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+        tf.close()
+        return out.getvalue()
+
+    def gzip_bytes(self, data):
+        out = io.BytesIO()
+        gf = gzip.GzipFile(fileobj=out, mode='wb')
+        gf.write(data)
+        gf.close()
+        return out.getvalue()
+
+    def test_latex_tar_nested(self):
+        aid = '1301.0004'
+        deep = self.tar_bytes([('deep.tex', b'% too deep\n')])
+        inner = self.tar_bytes([('inner.tex', b'% inner\n'), 
+                                ('deeper.tar', self.tar_bytes([('deeper.tex', b'% deeper\n'),
+                                                               ('deep.tar', deep)]))])
+        self.gzip_source(aid, self.tar_bytes(
+                [('main.tex', b'% main\n'),
+                 ('sub.tex.gz', self.gzip_bytes(b'% sub\n')),
+                 ('fig.eps.gz', self.gzip_bytes(b'%!PS-Adobe-2.0\n% not latex\n')),
+                 ('inner.tgz', self.gzip_bytes(inner)),
+                 ('figs/other.tar', self.tar_bytes([('other.tex', b'% not top level\n')])),
+                 ('big.tex', b'%' * 50000 + b'\n'),
+                 ('big.tex.gz', self.gzip_bytes(b'%' * 50000 + b'\n'))]))
+        settings = fetch.max_member_size, metrics.enabled
+        fetch.max_member_size = 40000
+        metrics.enabled = True
+        metrics.reset()
+        try:
+            fetch.latex(aid)
+            # sub.tex.gz, big.tex.gz, inner.tgz, and deeper.tar, not fig.eps.gz
+            self.assertEqual(metrics.counters['nested_archives'], 4)
+        finally:
+            fetch.max_member_size, metrics.enabled = settings
+            metrics.reset()
+        self.assertEqual(self.read_latex(aid), b'% main\n% sub\n% inner\n% deeper\n')
+
+    def test_bulk_latex(self):
+        out = io.BytesIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            failures = fetch.bulk_latex(test_aids + ['astro-ph/0702001'], 
+                                        processes=2)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(list(failures.keys()), ['astro-ph/0702001'])
+        for aid in test_aids:
+            self.assertTrue(os.path.isfile(fetch.latex_file_path(aid)))
+        self.assertTrue('papers/s' in out.getvalue())
+
+    def test_bulk_latex_error(self):
+        # An error in the main process doesn't wait for the queued papers
+        class BrokenProgress(util.Progress):
+            def update(self, nbytes):
+                raise RuntimeError, 'broken'
+        latex_worker, Progress = fetch.latex_worker, util.Progress
+        fetch.latex_worker, util.Progress = slow_latex_worker, BrokenProgress
+        start = time.time()
+        try:
+            self.assertRaises(RuntimeError, fetch.bulk_latex, 
+                              ['1211.%04d' % ii for ii in range(320)], processes=2)
+        finally:
+            fetch.latex_worker, util.Progress = latex_worker, Progress
+        self.assertTrue(time.time() - start < 4)
+
+    def test_latex_incremental(self):
+        self.assertEqual(fetch.all_latex(test_aids), len(test_aids))
+        self.assertEqual(fetch.all_latex(test_aids), 0)
+        # A source file that was downloaded again after the latex
+        # was extracted
+        latex_fn = fetch.latex_file_path('1211.1574')
+        mtime = os.path.getmtime(fetch.source_file_path('1211.1574')) - 10
+        os.utime(latex_fn, (mtime, mtime))
+        self.assertFalse(fetch.latex_is_current('1211.1574'))
+        self.assertEqual(fetch.all_latex(test_aids), 1)
+        self.assertTrue(fetch.latex_is_current('1211.1574'))
+        self.assertEqual(fetch.all_latex(test_aids, force=True), len(test_aids))
+
+    def test_bulk_latex_incremental(self):
+        fetch.all_latex(test_aids[:2])
+        mtime = os.path.getmtime(fetch.latex_file_path(test_aids[0]))
+        out = io.BytesIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            failures = fetch.bulk_latex(test_aids, processes=2)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(failures, {})
+        self.assertTrue('Skipped 2 papers' in out.getvalue())
+        self.assertEqual(os.path.getmtime(fetch.latex_file_path(test_aids[0])), mtime)
+
+    def test_bulk_latex_by_year(self):
+        stdout, sys.stdout = sys.stdout, io.BytesIO()
+        try:
+            failures = fetch.bulk_latex_by_year(['12'], processes=2)
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(failures, {})
+        self.assertTrue(os.path.isfile(fetch.latex_file_path('1211.1574')))
+        self.assertFalse(os.path.exists(fetch.latex_file_path('astro-ph/0701019')))
+
+    def test_all_source_cached(self):
+        # Everything is already in place, so nothing should be fetched
+        self.assertFalse(fetch.all_source(test_aids, delay=test_delay))
+
+    def test_latex_missing_source(self):
+        self.assertRaises(ValueError, fetch.latex, 'astro-ph/0702001')
+
+class IterArxivIdsTest(SourceFilesMixin, unittest.TestCase):
+    def setUp(self):
+        SourceFilesMixin.setUp(self)
+        self.gzip_source('hep-th/9912001', latex_sample)
+        self.gzip_source('astro-ph/9912002', latex_sample)
+        open(os.path.join(path.source, '1211', 'README'), 'w').close()
+        self.scandir = fetch.scandir
+
+    def tearDown(self):
+        fetch.scandir = self.scandir
+        SourceFilesMixin.tearDown(self)
+
+    def ids(self, **kw):
+        return list(fetch.iter_arxiv_ids(path.source, **kw))
+
+    def test_order(self):
+        in_order = (['astro-ph/9912002', 'hep-th/9912001'] + 
+                    sorted(test_aids[:3]) + sorted(test_aids[3:]))
+        self.assertEqual(self.ids(), in_order)
+        fetch.scandir = None
+        self.assertEqual(self.ids(), in_order)
+
+    def test_filters(self):
+        self.assertEqual(self.ids(years=['99']), ['astro-ph/9912002', 'hep-th/9912001'])
+        self.assertEqual(self.ids(months=[('9912', '0701')], archives=['hep-th']), 
+                         ['hep-th/9912001'])
+        self.assertEqual(self.ids(years=['07', '12'], months=[('0701', '1210')]),
+                         sorted(test_aids[:3]))
+        self.assertEqual(self.ids(months=[('1211', '1211')], archives=['hep-th']),
+                         sorted(test_aids[3:]))
+        self.assertEqual(fetch.year_to_arxiv_id('12', prefix=path.source), 
+                         sorted(test_aids[3:]))
+        self.assertEqual(sorted(fetch.arxiv_ids_by_year(path.source).keys()), 
+                         ['07', '12', '99'])
+
+    def test_file_names(self):
+        self.assertEqual(fetch.file_name_to_aid('1211.1574v2.gz'), ('1211.1574v2', '.gz'))
+        self.assertEqual(fetch.file_name_to_aid('astro-ph0701019.tex'),
+                         ('astro-ph/0701019', '.tex'))
+        self.assertEqual(fetch.file_name_to_aid('README'), (None, None))
+        # Listing a directory either way gives the same ids
+        dir = os.path.join(path.source, '1211')
+        self.assertEqual(sorted(fetch.dir_to_arxiv_ids(dir)),
+                         self.ids(months=[('1211', '1211')]))
+
+    def test_lazy(self):
+        aids = fetch.iter_arxiv_ids(path.source)
+        self.assertEqual(next(aids), 'astro-ph/9912002')
+        # Later months haven't been listed yet
+        self.gzip_source('1211.0001', latex_sample)
+        self.assertEqual(list(aids), ['hep-th/9912001'] + sorted(test_aids[:3]) + 
+                         sorted(test_aids[3:] + ['1211.0001']))
+
+class IdSetTest(unittest.TestCase):
+    aids = ['astro-ph/9505048', 'hep-th/9912001v2', 'astro-ph/0701019', 
+            '1211.1574', '1211.1574v1', '1211.4164', '1301.0001v12']
+
+    def test_encode(self):
+        for aid in self.aids:
+            self.assertEqual(idset.decode(idset.encode(aid)), aid)
+        self.assertRaises(ValueError, idset.encode, 'not-an-archive/0701019')
+        self.assertRaises(ValueError, idset.encode, '1213.0001')
+        self.assertRaises(ValueError, idset.encode, 'nonsense')
+
+    def test_set(self):
+        ids = idset.ArxivIdSet(reversed(self.aids + self.aids))
+        self.assertEqual(len(ids), len(self.aids))
+        self.assertEqual(list(ids), self.aids)
+        for aid in self.aids:
+            self.assertTrue(aid in ids)
+        for aid in ['1211.1574v2', 'hep-th/9912001', '1211.0001', 'nonsense']:
+            self.assertFalse(aid in ids)
+        self.assertEqual(ids.nbytes(), 8*len(self.aids))
+        ids.add('0001.0001')
+        ids.add('0001.0001')
+        self.assertEqual(list(ids)[2], '0001.0001')
+        ids.update(['1211.0002', '9912.0001'])
+        self.assertEqual(len(ids), len(self.aids) + 3)
+        self.assertTrue('9912.0001' in ids and '1211.0002' in ids)
+
+    def test_yymm_range(self):
+        ids = idset.ArxivIdSet(self.aids)
+        self.assertEqual(list(ids.yymm_range('9912', '0701')), self.aids[1:3])
+        self.assertEqual(list(ids.yymm_range('1211')), self.aids[3:6])
+        self.assertEqual(list(ids.yymm_range('1302', '1412')), [])
+
+    def test_algebra(self):
+        rand = random.Random(42)
+        universe = ['%02d%02d.%04d' % (yy, mm, rand.randint(0, 9999)) 
+                    for yy in (7, 8) for mm in range(1, 13)] + self.aids
+        for ii in range(20):
+            aa = set(rand.sample(universe, rand.randint(0, len(universe))))
+            bb = set(rand.sample(universe, rand.randint(0, len(universe))))
+            ia, ib = idset.ArxivIdSet(aa), idset.ArxivIdSet(bb)
+            self.assertEqual(ia | ib, idset.ArxivIdSet(aa | bb))
+            self.assertEqual(ia & ib, idset.ArxivIdSet(aa & bb))
+            self.assertEqual(ia - ib, idset.ArxivIdSet(aa - bb))
+            self.assertEqual(ia ^ ib, idset.ArxivIdSet(aa ^ bb))
+
+    def test_save(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tmpdir, 'papers.ids')
+            ids = idset.ArxivIdSet(self.aids)
+            ids.save(fn)
+            self.assertEqual(os.path.getsize(fn), idset.header.size + 8*len(self.aids))
+            self.assertEqual(idset.load(fn), ids)
+            with open(fn, 'wb') as ff: ff.write(b'x' * 100)
+            self.assertRaises(IOError, idset.load, fn)
+        finally:
+            shutil.rmtree(tmpdir)
+
+class ShardTest(SourceFilesMixin, unittest.TestCase):
+    def setUp(self):
+        SourceFilesMixin.setUp(self)
+        self.settings = path.shards, scrape.verbose
+        path.shards = os.path.join(self.tmpdir, 'shards')
+        scrape.verbose = False
+        fetch.all_latex(test_aids)
+        self.comments = dict((aid, scrape.comments(aid)) for aid in test_aids)
+
+    def tearDown(self):
+        path.shards, scrape.verbose = self.settings
+        SourceFilesMixin.tearDown(self)
+
+    def test_pack(self):
+        self.assertEqual(shard.pack_all(remove=True), len(test_aids))
+        self.assertTrue(os.path.exists(shard.shard_path('1211')))
+        for aid in test_aids:
+            self.assertFalse(os.path.exists(fetch.latex_file_path(aid)))
+            self.assertTrue(fetch.latex_exists(aid))
+            with fetch.open_latex(aid) as ff:
+                contents = ff.read()
+            self.assertEqual(contents, b'' if aid in ('astro-ph/0701864', '1211.2577') 
+                             else latex_sample)
+            self.assertEqual(scrape.comments(aid), self.comments[aid])
+            self.assertEqual(scrape.readlines(fetch.open_latex(aid)),
+                             latex_sample.decode('ascii').splitlines(True) if contents else [])
+        # Packed latex counts as up to date
+        self.assertEqual(fetch.all_latex(test_aids), 0)
+        self.assertRaises(IOError, fetch.open_latex, '1211.9999')
+
+    def test_pack_merges(self):
+        shard.pack('1211', remove=True)
+        # A paper extracted after the month was packed
+        self.gzip_source('1211.0001', b'% new paper\n% really\n' + latex_sample)
+        fetch.latex('1211.0001')
+        self.assertEqual(shard.pack('1211', remove=True), 4)
+        sh = shard.get_shard('1211')
+        self.assertEqual(sh.aids(), ['1211.0001', '1211.1574', '1211.2577', '1211.4164'])
+        self.assertEqual(sh.read('1211.1574'), latex_sample)
+        self.assertEqual(sh.size('1211.0001'), len(latex_sample) + 21)
+        self.assertEqual([aid for aid, l, s in scrape.shard_comments('1211')], sh.aids())
+        self.assertEqual(dict((aid, (l, s)) for aid, l, s in scrape.shard_comments('1211')
+                              if aid in self.comments), 
+                         dict((aid, self.comments[aid]) for aid in sh.aids() 
+                              if aid in self.comments))
+
+    def test_not_a_shard(self):
+        fn = shard.shard_path('1211')
+        fetch.ensure_dirs_exist(fn)
+        with open(fn, 'wb') as ff:
+            ff.write(b'x' * 100)
+        self.assertRaises(IOError, shard.Shard, fn)
+
+class BulkTest(SourceFilesMixin, unittest.TestCase):
+    def setUp(self):
+        SourceFilesMixin.setUp(self)
+        self.stdout, sys.stdout = sys.stdout, io.BytesIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        SourceFilesMixin.tearDown(self)
+
+    def test_parse_months(self):
+        self.assertEqual(bulk.parse_months('1401'), ('1401', '1401'))
+        self.assertEqual(bulk.parse_months('9901-0312'), ('9901', '0312'))
+        self.assertRaises(ValueError, bulk.parse_months, '0312-9901')
+        self.assertRaises(ValueError, bulk.parse_months, '14-01')
+
+    def test_month_aids(self):
+        old, new = sorted(test_aids[:3]), sorted(test_aids[3:])
+        self.assertEqual(bulk.month_aids([('0701', '1211')]), old + new)
+        self.assertEqual(bulk.month_aids([('9901', '0701')]), old)
+        # New style ids always pass the archive filter
+        self.assertEqual(bulk.month_aids([('0701', '1211')], archives=['hep-th']), new)
+        self.assertEqual(bulk.month_aids([('0701', '1211')], archives=['astro-ph']), 
+                         old + new)
+        self.assertEqual(bulk.month_aids([('1301', '1312')]), [])
+
+    def expected(self):
+        fetch.all_latex(test_aids)
+        return dict((aid, scrape.comments(aid)) for aid in test_aids)
+
+    def test_records(self):
+        fn = os.path.join(self.tmpdir, 'out.jsonl.gz')
+        failures = bulk.run(test_aids + ['astro-ph/0702001'], fn, processes=2)
+        self.assertEqual(list(failures.keys()), ['astro-ph/0702001'])
+        expected = self.expected()
+        result = [record for offset, record in records.iter_records(fn)]
+        self.assertEqual([record['aid'] for record in result], test_aids)
+        for record in result:
+            self.assertEqual((record['long'], record['short']), 
+                             expected[record['aid']])
+
+    def test_store(self):
+        fn = os.path.join(self.tmpdir, 'out.db')
+        self.assertEqual(bulk.run(test_aids, fn, processes=2), {})
+        expected = self.expected()
+        conn = store.connect(fn)
+        try:
+            for aid in test_aids:
+                self.assertEqual(store.paper_comments(conn, aid, 'short'), 
+                                 expected[aid][1])
+        finally:
+            conn.close()
+
+    def test_error(self):
+        # An error in the main process doesn't wait for the queued papers
+        worker, open_output = bulk.worker, bulk.open_output
+        bulk.worker, bulk.open_output = slow_bulk_worker, lambda name: BrokenOutput()
+        start = time.time()
+        try:
+            self.assertRaises(IOError, bulk.run, ['1211.%04d' % ii for ii in range(320)], 
+                              'out', processes=2)
+        finally:
+            bulk.worker, bulk.open_output = worker, open_output
+        self.assertTrue(time.time() - start < 4)
+
+    def test_main(self):
+        prefix = os.path.join(self.tmpdir, 'out')
+        overheard.main(['overheard.py', 'bulk', '0701', '1211-1212', 
+                        '-j', '2', '-o', prefix])
+        self.assertTrue('6/6 papers' in sys.stdout.getvalue())
+        long_fn, short_fn = os.path.join(self.tmpdir, 'long'), os.path.join(self.tmpdir, 'short')
+        scrape.verbose, verbose = False, scrape.verbose
+        try:
+            scrape.write_output(test_aids, long_fn, short_fn)
+        finally:
+            scrape.verbose = verbose
+        for fn, expected_fn in [(prefix + '-long.tex', long_fn), 
+                                (prefix + '-short.tex', short_fn)]:
+            with open(fn) as ff, open(expected_fn) as expected_ff:
+                self.assertEqual(ff.read(), expected_ff.read())
+
+class StandInHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    "Serve server.files the way arxiv.org would, with keep-alive and ranges"
+    protocol_version = 'HTTP/1.1'
+    etag = '"stand-in"'
+
+    def setup(self):
+        self.server.connections += 1
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+
+    def do_GET(self):
+        self.server.requests.append(self.headers)
+        data = self.server.files.get(self.path)
+        if data is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        if self.headers.get('if-none-match') == self.etag:
+            self.send_response(304)
+            self.send_header('ETag', self.etag)
+            self.end_headers()
+            return
+
+        start = 0
+        if (self.headers.get('range') and 
+            self.headers.get('if-range') == self.etag):
+            start = int(self.headers['range'][len('bytes='):].rstrip('-'))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % 
+                             (start, len(data)-1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.send_header('ETag', self.etag)
+        self.end_headers()
+
+        if self.server.truncate:
+            # Drop the connection half way through
+            self.server.truncate -= 1
+            self.wfile.write(data[start:start + (len(data) - start)//2])
+            self.close_connection = 1
+        else:
+            self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class StandInMixin(object):
+    # Run a local stand-in for arxiv.org that serves self.server.files
+
+    def setUp(self):
+        self.settings = (fetch.verbose, fetch.user_agent, fetch.base_url, 
+                         path.source)
+        fetch.verbose = False
+        fetch.user_agent = 'overheard-test'
+        self.tmpdir = tempfile.mkdtemp()
+        path.source = os.path.join(self.tmpdir, 'data')
+
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        self.server.files = {}
+        self.server.requests = []
+        self.server.connections = 0
+        self.server.truncate = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        fetch.base_url = 'http://127.0.0.1:%d/e-print/' % self.server.server_address[1]
+        
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        # Don't leave connections to the dead server in the pool
+        fetch.connections.__dict__.pop('pool', None)
+        (fetch.verbose, fetch.user_agent, fetch.base_url, 
+         path.source) = self.settings
+        shutil.rmtree(self.tmpdir)
+
+class DownloadTest(StandInMixin, unittest.TestCase):
+    # Exercise the downloader against a local stand-in for arxiv.org
+
+    def setUp(self):
+        StandInMixin.setUp(self)
+        self.gz_data = gzip_bytes(latex_sample * 100)
+        self.pdf_data = b'%PDF-1.4\n' + b'x' * 1000
+        self.server.files['/e-print/1211.1574'] = self.gz_data
+        self.server.files['/e-print/1211.2577'] = self.pdf_data
+
+    def read_source(self, aid):
+        with open(fetch.source_file_path(aid), 'rb') as ff:
+            return ff.read()
+
+    def test_source(self):
+        aids = ['1211.1574', '1211.2577']
+        self.assertTrue(fetch.all_source(aids, delay=0, threads=1))
+        self.assertEqual(fetch.source_file_extension('1211.1574'), '.gz')
+        self.assertEqual(fetch.source_file_extension('1211.2577'), '.pdf')
+        self.assertEqual(self.read_source('1211.1574'), self.gz_data)
+        self.assertEqual(self.read_source('1211.2577'), self.pdf_data)
+        self.assertEqual([hh['user-agent'] for hh in self.server.requests],
+                         ['overheard-test', 'overheard-test'])
+        # Both papers came over the same connection
+        self.assertEqual(self.server.connections, 1)
+        # and they're cached now
+        self.assertFalse(fetch.all_source(aids, delay=0, threads=1))
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_source_missing(self):
+        # A 404 for one paper doesn't stop the others
+        out = io.BytesIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            self.assertTrue(fetch.all_source(['1211.9999', '1211.1574'], 
+                                             delay=0, threads=1))
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(self.read_source('1211.1574'), self.gz_data)
+        self.assertFalse(fetch.source_file_exists('1211.9999'))
+        self.assertTrue("Couldn't download 1211.9999" in out.getvalue())
+
+    def test_resume(self):
+        self.server.truncate = 1
+        fetch.source('1211.1574')
+        self.assertEqual(self.read_source('1211.1574'), self.gz_data)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[1]['range'], 
+                         'bytes=%d-' % (len(self.gz_data)//2))
+
+    def test_resume_partial_file(self):
+        # A .part file left over from an interrupted run
+        aid = '1211.1574'
+        part_fn = fetch.source_file_path_without_extension(aid) + '.part'
+        fetch.ensure_dirs_exist(part_fn)
+        with open(part_fn, 'wb') as ff: ff.write(self.gz_data[:100])
+        with open(part_fn + '.validator', 'w') as ff: ff.write(StandInHandler.etag)
+        fetch.source(aid)
+        self.assertEqual(self.read_source(aid), self.gz_data)
+        self.assertEqual(self.server.requests[0]['range'], 'bytes=100-')
+        self.assertFalse(os.path.exists(part_fn))
+        self.assertFalse(os.path.exists(part_fn + '.validator'))
+
+    def test_changed_partial_file(self):
+        # If the file changed on the server, start over
+        aid = '1211.1574'
+        part_fn = fetch.source_file_path_without_extension(aid) + '.part'
+        fetch.ensure_dirs_exist(part_fn)
+        with open(part_fn, 'wb') as ff: ff.write(b'old version')
+        with open(part_fn + '.validator', 'w') as ff: ff.write('"old"')
+        fetch.source(aid)
+        self.assertEqual(self.read_source(aid), self.gz_data)
+
+    def test_user_agent(self):
+        fetch.user_agent = None
+        stderr = sys.stderr
+        sys.stderr = io.BytesIO()
+        try:
+            self.assertRaises(SystemExit, fetch.source, '1211.1574')
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(self.server.requests, [])
+
+class PipelineTest(StandInMixin, unittest.TestCase):
+    def setUp(self):
+        StandInMixin.setUp(self)
+        self.settings += (path.latex, store.verbose, scrape.verbose)
+        store.verbose = scrape.verbose = False
+        path.latex = os.path.join(self.tmpdir, 'latex')
+        self.conn = store.connect(os.path.join(self.tmpdir, 'comments.db'))
+        self.long_fn = os.path.join(self.tmpdir, 'long.tex')
+        self.short_fn = os.path.join(self.tmpdir, 'short.tex')
+
+        self.aids = ['1211.%04d' % ii for ii in range(1, 21)]
+        for ii, aid in enumerate(self.aids):
+            self.server.files['/e-print/' + aid] = gzip_bytes(
+                b'% paper ' + str(ii).encode('ascii') + b'\n' + latex_sample)
+        self.server.files['/e-print/1211.0003'] = b'%PDF-1.4\n'
+
+    def tearDown(self):
+        self.conn.close()
+        path.latex, store.verbose, scrape.verbose = self.settings[-3:]
+        self.settings = self.settings[:-3]
+        StandInMixin.tearDown(self)
+
+    def read(self, fn):
+        with open(fn) as ff:
+            return ff.read()
+
+    def test_run(self):
+        aids = self.aids + ['1211.9999']
+        failures = pipeline.run(aids, self.long_fn, self.short_fn, 
+                                delay=0, threads=4, conn=self.conn)
+        self.assertEqual(failures.keys(), ['1211.9999'])
+        self.assertTrue(os.path.exists(fetch.latex_file_path('1211.0020')))
+
+        # Same as doing it one stage at a time
+        long_fn = os.path.join(self.tmpdir, 'long-serial.tex')
+        short_fn = os.path.join(self.tmpdir, 'short-serial.tex')
+        store.export(self.conn, aids, long_fn, short_fn)
+        self.assertEqual(self.read(self.long_fn), self.read(long_fn))
+        self.assertEqual(self.read(self.short_fn), self.read(short_fn))
+
+    def test_order(self):
+        # The output is in the order given, not the order the papers
+        # happen to finish in, even when some are cached.
+        self.server.files['/e-print/1211.0003'] = gzip_bytes(latex_sample)
+        fetch.source('1211.0015')
+        fetch.source('1211.0020')
+        pipeline.queue_size, saved = 2, pipeline.queue_size
+        try:
+            pipeline.run(self.aids, self.long_fn, self.short_fn, 
+                         delay=0, threads=4, conn=self.conn)
+        finally:
+            pipeline.queue_size = saved
+        papers = re.findall('% paper ([0-9]+)', self.read(self.long_fn))
+        self.assertEqual(papers, [str(ii) for ii in range(20) if ii != 2])
+
+    def test_rescrape(self):
+        aids = self.aids[:2]
+        pipeline.run(aids, self.long_fn, self.short_fn, delay=0, conn=self.conn)
+        self.server.files['/e-print/1211.0001'] = gzip_bytes(b'% changed\n' + latex_sample)
+        pipeline.run(aids, self.long_fn, self.short_fn, delay=0, conn=self.conn,
+                     force=True)
+        self.assertTrue('% changed' in self.read(self.long_fn))
+
+        # Newer source means new latex, which is scraped again
+        with open(fetch.source_file_path('1211.0002'), 'wb') as ff:
+            ff.write(gzip_bytes(b'% newer\n' + latex_sample))
+        os.utime(fetch.source_file_path('1211.0002'), (time.time() + 10,)*2)
+        pipeline.run(aids, self.long_fn, self.short_fn, delay=0, conn=self.conn)
+        self.assertTrue('% newer' in self.read(self.long_fn))
+
+    def test_error_stops_workers(self):
+        # Something going wrong in the main thread stops the others,
+        # even though they're waiting on full queues.
+        export_paper = store.export_paper
+        def broken_export_paper(conn, aid, l_outf, s_outf):
+            if aid == '1211.0002': raise RuntimeError, 'disk full'
+            return export_paper(conn, aid, l_outf, s_outf)
+        store.export_paper = broken_export_paper
+        pipeline.queue_size, saved = 1, pipeline.queue_size
+        try:
+            self.assertRaises(RuntimeError, pipeline.run, self.aids, self.long_fn, 
+                              self.short_fn, delay=0, threads=4, conn=self.conn)
+        finally:
+            store.export_paper = export_paper
+            pipeline.queue_size = saved
+        self.assertEqual([thread for thread in threading.enumerate() 
+                          if thread.name.startswith('pipeline-')], [])
+        # Not everything was downloaded
+        self.assertTrue(len(self.server.requests) < len(self.aids))
+
+    def test_resume(self):
+        journal_fn = os.path.join(self.tmpdir, 'run.journal')
+        missing = self.server.files.pop('/e-print/1211.0010')
+        failures = pipeline.run(self.aids, self.long_fn, self.short_fn, delay=0, 
+                                conn=self.conn, journal_fn=journal_fn)
+        self.assertEqual(failures.keys(), ['1211.0010'])
+        first_long = self.read(self.long_fn)
+        n_requests = len(self.server.requests)
+        # A crash after writing to the output, before the journal
+        with open(self.long_fn, 'a') as ff:
+            ff.write('% half written\n')
+            
+        self.server.files['/e-print/1211.0010'] = missing
+        failures = pipeline.run(self.aids, self.long_fn, self.short_fn, delay=0, 
+                                conn=self.conn, journal_fn=journal_fn)
+        self.assertEqual(failures, {})
+        # Only the paper that failed was downloaded again, and the
+        # output was added to, not started over.
+        self.assertEqual(len(self.server.requests), n_requests + 1)
+        papers = re.findall('% paper ([0-9]+)', self.read(self.long_fn))
+        self.assertEqual(papers, [str(ii) for ii in range(20) if ii not in (2, 9)] + ['9'])
+        self.assertTrue(self.read(self.long_fn).startswith(first_long))
+        self.assertFalse('half written' in self.read(self.long_fn))
+
+        # Nothing left to do
+        pipeline.run(self.aids, self.long_fn, self.short_fn, delay=0, 
+                     conn=self.conn, journal_fn=journal_fn)
+        self.assertEqual(len(self.server.requests), n_requests + 1)
+        self.assertEqual(len(re.findall('% paper', self.read(self.long_fn))), 19)
+
+    def test_resume_different_papers(self):
+        journal_fn = os.path.join(self.tmpdir, 'run.journal')
+        pipeline.run(self.aids[:5], self.long_fn, self.short_fn, delay=0, 
+                     conn=self.conn, journal_fn=journal_fn)
+        # The output is started over when it can't be added to
+        pipeline.run(self.aids[10:15], self.long_fn, self.short_fn, delay=0, 
+                     conn=self.conn, journal_fn=journal_fn)
+        papers = re.findall('% paper ([0-9]+)', self.read(self.long_fn))
+        self.assertEqual(papers, ['10', '11', '12', '13', '14'])
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.fn = os.path.join(self.tmpdir, 'run.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_journal(self):
+        jj = journal.Journal(self.fn)
+        jj.record('1211.1574', 'downloaded')
+        jj.record('1211.1574', 'emitted', long=10, short=5)
+        jj.record('1211.2577', 'downloaded')
+        jj.close()
+        # A line cut off by a crash
+        with open(self.fn, 'a') as ff:
+            ff.write('{"aid": "1211.2577", "sta')
+
+        jj = journal.Journal(self.fn)
+        self.assertTrue(jj.done('1211.1574', 'emitted'))
+        self.assertTrue(jj.done('1211.2577', 'downloaded'))
+        self.assertFalse(jj.done('1211.2577', 'extracted'))
+        self.assertEqual(jj.emitted, ['1211.1574'])
+        self.assertEqual(jj.offsets, (10, 5))
+        self.assertTrue(jj.resume(['1211.2577', '1211.1574']))
+        self.assertFalse(jj.resume(['1211.2577']))
+        jj.restart()
+        jj.close()
+
+        jj = journal.Journal(self.fn)
+        self.assertEqual(jj.emitted, [])
+        self.assertEqual(jj.offsets, (0, 0))
+        self.assertTrue(jj.done('1211.2577', 'downloaded'))
+        jj.close()
+
+    def test_open_output(self):
+        fn = os.path.join(self.tmpdir, 'out.tex')
+        with open(fn, 'w') as ff:
+            ff.write('abcdef')
+        with journal.open_output(fn, 3) as ff:
+            ff.write('X')
+        with open(fn) as ff:
+            self.assertEqual(ff.read(), 'abcX')
+        with journal.open_output(fn, 0) as ff:
+            pass
+        self.assertEqual(os.path.getsize(fn), 0)
+
+class TokenBucketTest(unittest.TestCase):
+    def test_rate(self):
+        limiter = fetch.TokenBucket(50)
+        start = time.time()
+        for ii in range(6):
+            limiter.acquire()
+        # First token is free, the other five come at 50 per second
+        self.assertTrue(time.time() - start >= 0.09)
+
+    def test_threads(self):
+        limiter = fetch.TokenBucket(100)
+        times = []
+        def worker():
+            for ii in range(3):
+                limiter.acquire()
+                times.append(time.time())
+        threads = [threading.Thread(target=worker) for ii in range(4)]
+        for thread in threads: thread.start()
+        for thread in threads: thread.join()
+        times.sort()
+        self.assertEqual(len(times), 12)
+        self.assertTrue(times[-1] - times[0] >= 0.1)
+
+class ManifestTest(SourceFilesMixin, unittest.TestCase):
+    def setUp(self):
+        SourceFilesMixin.setUp(self)
+        self.manifest_verbose = manifest.verbose
+        manifest.verbose = False
+        self.manifest = manifest.Manifest(os.path.join(self.tmpdir, 'manifest.db'))
+
+    def tearDown(self):
+        fetch.manifest = None
+        manifest.verbose = self.manifest_verbose
+        self.manifest.close()
+        SourceFilesMixin.tearDown(self)
+
+    def test_refresh(self):
+        self.assertEqual(self.manifest.refresh(), 2)
+        self.assertEqual(self.manifest.refresh(), 0)
+        for aid in test_aids:
+            self.assertEqual(self.manifest.source_extension(aid),
+                             fetch.source_file_extension(aid))
+        self.assertEqual(self.manifest.source_extension('1211.9999'), False)
+        self.assertEqual(self.manifest.source_info('1211.2577')[3], 'pdf')
+        self.assertEqual(self.manifest.aids('source', year='12'), 
+                         ['1211.1574', '1211.2577', '1211.4164'])
+
+        # A new file means the directory gets looked at again
+        shutil.copy(self.sources['1211.1574'], 
+                    fetch.source_file_path_without_extension('1211.0001') + '.gz')
+        self.assertEqual(self.manifest.refresh(), 1)
+        self.assertEqual(self.manifest.source_extension('1211.0001'), '.gz')
+
+    def test_fetch_uses_manifest(self):
+        self.manifest.refresh()
+        fetch.manifest = self.manifest
+        self.assertEqual(fetch.year_to_arxiv_id('07', prefix=path.source),
+                         sorted(aid for aid in test_aids if aid.startswith('astro-ph')))
+        self.assertEqual(self.manifest.latex_status('1211.1574'), 'missing')
+        fetch.all_latex(test_aids)
+        self.assertEqual(self.manifest.latex_status('1211.1574'), 'current')
+        # Without looking at the filesystem
+        os.remove(fetch.source_file_path_without_extension('1211.1574') + '.gz')
+        self.assertEqual(fetch.source_file_extension('1211.1574'), '.gz')
+
+    def test_bulk_uses_manifest(self):
+        self.manifest.refresh()
+        fetch.manifest = self.manifest
+        # Listed from the manifest, so a file it hasn't seen isn't there
+        shutil.copy(self.sources['1211.1574'],
+                    fetch.source_file_path_without_extension('1211.0001') + '.gz')
+        self.assertEqual(bulk.month_aids([('1211', '1211')]),
+                         ['1211.1574', '1211.2577', '1211.4164'])
+        stdout, sys.stdout = sys.stdout, io.BytesIO()
+        try:
+            bulk.run(['1211.1574'], os.path.join(self.tmpdir, 'out.jsonl'), processes=2)
+        finally:
+            sys.stdout = stdout
+        # The latex the workers wrote is in the manifest afterwards
+        self.assertEqual(self.manifest.latex_status('1211.1574'), 'current')
+        self.assertTrue('1211.0001' in bulk.month_aids([('1211', '1211')]))
+
+rss_sample = b"""<?xml version="1.0" encoding="UTF-8"?>
+<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+         xmlns="http://purl.org/rss/1.0/"
+         xmlns:dc="http://purl.org/dc/elements/1.1/">
+<channel rdf:about="http://arxiv.org/rss/astro-ph">
+<title>astro-ph updates on arXiv.org</title>
+<link>http://arxiv.org/</link>
+<description>Astrophysics (astro-ph) updates on the arXiv.org e-print archive</description>
+<items>
+ <rdf:Seq>
+  <rdf:li rdf:resource="http://arxiv.org/abs/1404.0001" />
+  <rdf:li rdf:resource="http://arxiv.org/abs/1404.0002" />
+  <rdf:li rdf:resource="http://arxiv.org/abs/1403.7000" />
+ </rdf:Seq>
+</items>
+</channel>
+<item rdf:about="http://arxiv.org/abs/1404.0001">
+<title>A paper (arXiv:1404.0001v1 [astro-ph.CO])</title>
+<link>http://arxiv.org/abs/1404.0001</link>
+<description>Abstract</description>
+</item>
+<item rdf:about="http://arxiv.org/abs/1404.0002">
+<title>Another paper (arXiv:1404.0002v1 [astro-ph.GA])</title>
+<link>http://arxiv.org/abs/1404.0002</link>
+<description>Abstract</description>
+</item>
+<item rdf:about="http://arxiv.org/abs/1403.7000">
+<title>A cross list (arXiv:1403.7000v2 [astro-ph.HE] UPDATED)</title>
+<link>http://arxiv.org/abs/1403.7000</link>
+<description>Abstract</description>
+</item>
+</rdf:RDF>
+"""
+
+class RssCacheTest(unittest.TestCase):
+    # The feed comes from a local stand-in for arxiv.org
+
+    def setUp(self):
+        self.settings = update.rss_url, path.rss_cache
+        self.tmpdir = tempfile.mkdtemp()
+        path.rss_cache = os.path.join(self.tmpdir, 'rss-cache.pickle')
+
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        self.server.files = {'/rss/astro-ph': rss_sample}
+        self.server.requests = []
+        self.server.connections = 0
+        self.server.truncate = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        update.rss_url = 'http://127.0.0.1:%d/rss/%%s' % self.server.server_address[1]
+        self.ids = ['1404.0001', '1404.0002', '1403.7000']
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        update.rss_url, path.rss_cache = self.settings
+        shutil.rmtree(self.tmpdir)
+
+    def test_fresh(self):
+        self.assertEqual(update.parse_rss(), self.ids)
+        self.assertEqual(update.parse_rss(), self.ids)
+        # Second time came straight from the cache
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_not_modified(self):
+        self.assertEqual(update.parse_rss(max_age=0), self.ids)
+        self.assertEqual(update.parse_rss(max_age=0), self.ids)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertEqual(self.server.requests[1]['if-none-match'], 
+                         StandInHandler.etag)
+
+    def test_several_archives(self):
+        gr_qc = (rss_sample.replace(b'1404.0002', b'1404.0500')
+                 .replace(b'1404.0001', b'1403.7000v2'))
+        self.server.files['/rss/gr-qc'] = gr_qc
+        self.assertEqual(update.parse_rss(['astro-ph', 'gr-qc']), 
+                         self.ids + ['1404.0500'])
+        self.assertEqual(len(self.server.requests), 2)
+        # Both are cached now
+        self.assertEqual(update.parse_rss(['gr-qc', 'astro-ph']), 
+                         ['1403.7000v2', '1404.0500', '1404.0001', '1404.0002'])
+        self.assertEqual(len(self.server.requests), 2)
+
+    def test_unique_ids(self):
+        self.assertEqual(update.unique_ids(['1404.0001', None, 'astro-ph/0701019v1', 
+                                            '1404.0001v2', 'astro-ph/0701019']),
+                         ['1404.0001', 'astro-ph/0701019v1'])
+
+    def test_feed_formats(self):
+        rss2 = b"""<?xml version="1.0"?><rss version="2.0"><channel><title>x</title>
+            <item><title>a</title><guid>http://arxiv.org/abs/1404.0001v1</guid></item>
+            <item><title>b</title><link>http://arxiv.org/abs/astro-ph/0701019</link></item>
+            </channel></rss>"""
+        atom = b"""<?xml version="1.0"?><feed xmlns="http://www.w3.org/2005/Atom">
+            <id>http://arxiv.org/feed</id>
+            <entry><id>http://arxiv.org/abs/1404.0001v1</id><title>a</title></entry>
+            <entry><link href="http://arxiv.org/abs/astro-ph/0701019"/><title>b</title></entry>
+            </feed>"""
+        for data in rss2, atom:
+            self.assertEqual(list(update.iter_feed_ids(io.BytesIO(data))),
+                             ['1404.0001v1', 'astro-ph/0701019'])
+        self.assertEqual(list(update.iter_feed_ids(io.BytesIO(rss_sample))), self.ids)
+        self.assertEqual(update.feedparser_ids(rss_sample), self.ids)
+
+    def test_feedparser_fallback(self):
+        # Not well-formed: unescaped ampersand
+        broken = rss_sample.replace(b'<title>A paper', b'<title>A & B paper')
+        self.assertRaises(SyntaxError, list, update.iter_feed_ids(io.BytesIO(broken)))
+        self.assertEqual(update.read_feed_ids(io.BytesIO(broken)), self.ids)
+
+    def quietly(self, func, *args, **kw):
+        "Call func, return its result and what it printed"
+        out = io.BytesIO()
+        stdout, sys.stdout = sys.stdout, out
+        try:
+            return func(*args, **kw), out.getvalue()
+        finally:
+            sys.stdout = stdout
+
+    def test_failure_not_cached(self):
+        ids, out = self.quietly(update.parse_rss, 'gr-qc', max_age=0)
+        self.assertEqual(ids, [])
+        self.assertTrue('gr-qc' in out)
+        self.assertEqual(update.load_rss_cache(), {})
+
+    def test_feed_error(self):
+        # An error reading one feed doesn't lose the others, with or
+        # without a stale copy of it in the cache
+        self.assertEqual(update.parse_rss('astro-ph'), self.ids)
+        self.server.files['/rss/gr-qc'] = rss_sample.replace(b'1404.0002', b'1404.0500')
+        feed_ids = update.feed_ids
+        def broken_feed_ids(archive, entry, now):
+            if archive == 'astro-ph': raise ValueError, 'broken'
+            return feed_ids(archive, entry, now)
+        update.feed_ids = broken_feed_ids
+        try:
+            ids, out = self.quietly(update.parse_rss, ['astro-ph', 'gr-qc'], max_age=0)
+        finally:
+            update.feed_ids = feed_ids
+        self.assertEqual(ids, ['1404.0001', '1404.0500', '1403.7000'])
+        self.assertTrue("feed for astro-ph broken" in out)
+        # The old copy of astro-ph is still cached
+        self.assertEqual(update.load_rss_cache()['astro-ph']['ids'], self.ids)
+
 class UpdateTest(unittest.TestCase):
 
-    @unittest.skipIf(not network_tests, "Skipping network tests.")
-    def test_fetch_rss(self): 
-        update.fetch_rss()
-    
     @unittest.skipIf(not network_tests, "Skipping network tests.")
     def test_parse_rss(self): 
         update.parse_rss()
@@ -168,6 +1295,16 @@ class UtilTest(unittest.TestCase):
             os.chdir("..")
         self.assertEqual(os.getcwd(), cwd)
         
+    def test_progress(self):
+        out = io.BytesIO()
+        progress = util.Progress(total=4, interval=0, stream=out)
+        progress.update(2**20)
+        self.assertTrue(out.getvalue().startswith('1/4 papers'))
+        self.assertTrue('ETA' in out.getvalue())
+        progress.report(final=True)
+        self.assertEqual(progress.count, 1)
+        self.assertEqual(progress.nbytes, 2**20)
+
     def test_can_uncan_file_object(self):         
         obj = [1,2,3]
         tf = tempfile.TemporaryFile()
@@ -182,6 +1319,96 @@ class UtilTest(unittest.TestCase):
         tf.seek(0)
         self.assertEqual(util.uncan(tf.name), obj)
     
+class MetricsTest(SourceFilesMixin, unittest.TestCase):
+    def setUp(self):
+        SourceFilesMixin.setUp(self)
+        self.enabled_setting = metrics.enabled
+        metrics.enabled = True
+        metrics.reset()
+
+    def tearDown(self):
+        metrics.enabled = self.enabled_setting
+        metrics.reset()
+        SourceFilesMixin.tearDown(self)
+
+    def test_disabled(self):
+        metrics.enabled = False
+        metrics.count('things')
+        metrics.failure('1211.1574', 'type')
+        with metrics.timer('stage'):
+            pass
+        report = metrics.report()
+        self.assertEqual(report['counters'], {})
+        self.assertEqual(report['stages'], {})
+        self.assertEqual(report['failures'], [])
+
+    def test_report(self):
+        metrics.count('things')
+        metrics.count('things', 2)
+        metrics.failure('1211.1574', 'type')
+        for ii in range(2):
+            with metrics.timer('stage'):
+                pass
+        report = metrics.report()
+        self.assertEqual(report['counters'], {'things': 3})
+        self.assertEqual(report['stages']['stage']['calls'], 2)
+        self.assertEqual(report['failure_counts'], {'type': 1})
+        self.assertEqual(report['failures'], 
+                         [dict(aid='1211.1574', reason='type', detail=None)])
+
+    def test_latex(self):
+        fetch.all_latex(test_aids)
+        report = metrics.report()
+        self.assertEqual(report['stages']['extract']['calls'], 1)
+        self.assertEqual(report['counters']['papers_extracted'], len(test_aids))
+        # The gzipped tex files decompress to latex_sample, the
+        # tar files to something bigger.
+        self.assertTrue(report['counters']['bytes_decompressed'] > 
+                        4 * len(latex_sample))
+
+    def test_timed(self):
+        @metrics.timed('stage')
+        def stage(x):
+            "Docstring"
+            return x + 1
+        self.assertEqual(stage(1), 2)
+        self.assertEqual(stage.__name__, 'stage')
+        self.assertEqual(metrics.report()['stages']['stage']['calls'], 1)
+
+    def test_unknown_type(self):
+        self.gzip_source('1211.9999', b'%!PS-Adobe-2.0\n')
+        fetch.latex('1211.9999')
+        self.assertEqual(metrics.report()['failures'],
+                         [dict(aid='1211.9999', reason='unknown type', 
+                               detail='postscript')])
+
+    def test_write_files(self):
+        metrics.count('bytes_downloaded', 1234)
+        metrics.failure('1211.1574', 'unicode')
+        with metrics.timer('download'):
+            pass
+        json_fn = os.path.join(self.tmpdir, 'metrics.json')
+        prom_fn = os.path.join(self.tmpdir, 'metrics.prom')
+        metrics.write_json(json_fn)
+        metrics.write_prometheus(prom_fn)
+        with open(json_fn) as ff:
+            self.assertEqual(json.load(ff)['counters'], {'bytes_downloaded': 1234})
+        with open(prom_fn) as ff:
+            lines = ff.read().splitlines()
+        self.assertTrue('overheard_bytes_downloaded_total 1234' in lines)
+        self.assertTrue('# TYPE overheard_bytes_downloaded_total counter' in lines)
+        self.assertTrue('overheard_failures_total{reason="unicode"} 1' in lines)
+        self.assertTrue(any(line.startswith('overheard_stage_seconds_total{stage="download"} ')
+                            for line in lines))
+        self.assertTrue('# TYPE overheard_stage_seconds_total counter' in lines)
+        self.assertTrue('# TYPE overheard_run_seconds gauge' in lines)
+        # Every sample is a name, optional labels, and a number
+        for line in lines:
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                float(value)
+                self.assertTrue(re.match(r'^[a-z_]+(\{[a-z]+="[^"]*"\})?$', name))
+
 class ArxivIdTest(unittest.TestCase):
 
     def test_old(self):
@@ -233,6 +1460,24 @@ class ArxivIdTest(unittest.TestCase):
         self.assertEqual(arxiv_id.version('1234.5678v12'), 'v12')
         self.assertEqual(arxiv_id.version('1234.5678'), '')
 
+    def test_parse(self):
+        parsed = arxiv_id.parse('astro-ph/0701019v2')
+        self.assertEqual((parsed.archive, parsed.yymm, parsed.number, parsed.version),
+                         ('astro-ph', '0701', '019', 'v2'))
+        self.assertTrue(parsed.is_old)
+        self.assertEqual(parsed.unversioned, 'astro-ph/0701019')
+        self.assertEqual(arxiv_id.parse('1211.1574').unversioned, '1211.1574')
+        self.assertEqual(str(parsed), 'astro-ph/0701019v2')
+        # parsed once, then cached
+        self.assertTrue(arxiv_id.parse('astro-ph/0701019v2') is parsed)
+        self.assertTrue(arxiv_id.parse(parsed) is parsed)
+        self.assertRaises(ValueError, arxiv_id.parse, 'astro-ph/070101')
+
+    def test_immutable(self):
+        parsed = arxiv_id.parse('1211.1574')
+        self.assertRaises(AttributeError, setattr, parsed, 'yymm', '1212')
+        self.assertRaises(AttributeError, setattr, parsed, 'foo', 'bar')
+
     def test_is_new(self):
         # good ids
         self.assertTrue(arxiv_id.is_new('1234.5678'))
@@ -311,6 +1556,257 @@ class ScrapeTest(unittest.TestCase):
     # for aid in test_aids:
     #     scrape.all_comments(aid)
 
+class ReadlinesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.settings = scrape.sample_size, scrape.chunk_size
+
+    def tearDown(self):
+        scrape.sample_size, scrape.chunk_size = self.settings
+        shutil.rmtree(self.tmpdir)
+
+    def write(self, data):
+        fn = os.path.join(self.tmpdir, 'paper.tex')
+        with open(fn, 'wb') as ff: ff.write(data)
+        return fn
+
+    def assertLines(self, data, encoding):
+        fn = self.write(data)
+        with io.open(fn, encoding=encoding) as ff:
+            expected = ff.readlines()
+        self.assertEqual(list(scrape.iterlines(fn)), expected)
+        self.assertEqual(scrape.readlines(fn), expected)
+
+    def test_utf8(self):
+        self.assertLines(u'caf\xe9 % comment\n% na\xefve\n'.encode('utf-8') * 100, 
+                         'utf-8')
+
+    def test_latin1(self):
+        self.assertLines(u'caf\xe9 % comment\n% na\xefve\n'.encode('latin-1') * 100, 
+                         'latin-1')
+
+    def test_utf16(self):
+        self.assertLines(u'caf\xe9 % comment\n% na\xefve\n'.encode('utf-16') , 
+                         'utf-16')
+
+    def test_inputenc(self):
+        # cp1252 quotes are control characters in latin-1
+        data = (b'\\usepackage[T1]{fontenc}\n\\usepackage[ansinew]{inputenc}\n' + 
+                u'\u201cquoted\u201d % comment\n'.encode('cp1252'))
+        self.assertEqual(scrape.guess_encoding(data), 'cp1252')
+        self.assertLines(data, 'cp1252')
+
+    def test_late_latin1(self):
+        # A file that looks like utf-8 for the whole sample.  Only the
+        # part after the first bad byte is decoded as latin-1.
+        scrape.sample_size = scrape.chunk_size = 64
+        data = b'% plain ascii\n' * 100 + u'caf\xe9\n'.encode('latin-1') * 10
+        self.assertLines(data, 'latin-1')
+
+    def test_line_endings(self):
+        scrape.sample_size = scrape.chunk_size = 7
+        data = b'one\r\ntwo\rthree\n\n\r\nfour % no newline'
+        self.assertLines(data, 'utf-8')
+        self.assertLines(data + b'\r', 'utf-8')
+
+    def test_long_line(self):
+        scrape.sample_size = scrape.chunk_size = 1000
+        self.assertLines(b'f' * 100000 + b'\n% end\n', 'utf-8')
+
+class CommentsTest(unittest.TestCase):
+    def assertSameComments(self, text):
+        lines = list(scrape.split_lines([text]))
+        self.assertEqual(scrape.comments_from_text(text),
+                         (scrape.long_comments_from_lines(lines),
+                          scrape.short_comments_from_lines(lines)), repr(text))
+
+    def test_examples(self):
+        for text in [u'', u'%', u'%\n', u'%\n\n', u'a\n%\n%b\nc\n', 
+                     u'  % one\n\t%% two\n  % three\nx % short\n%last',
+                     u'\\% not a comment % but this is\n% and\n\\%\n',
+                     u'%a\n\n%b\n%c\nd\n']:
+            self.assertSameComments(text)
+        self.assertSameComments(latex_sample.decode('ascii'))
+
+    def test_random(self):
+        rand = random.Random(42)
+        alphabet = [u'%', u' ', u'\t', u'a', u'\\', u'\n', u'\n', u'\xe9']
+        for ii in range(500):
+            self.assertSameComments(u''.join(rand.choice(alphabet) 
+                                             for jj in range(rand.randint(0, 40))))
+
+    def assertSameScan(self, data, scanned=True):
+        expected = scrape.comments_from_text(scrape.readtext(io.BytesIO(data)))
+        result = scrape.scan_bytes(data)
+        if scanned:
+            self.assertEqual(result, expected, repr(data))
+        else:
+            self.assertEqual(result, None)
+        self.assertEqual(scrape.scan_data(data), expected)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            fn = os.path.join(tmpdir, 'paper.tex')
+            with open(fn, 'wb') as ff: ff.write(data)
+            self.assertEqual(scrape.scan_file(fn), expected)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_scan(self):
+        for data in [b'', b'%', b'%\n\n', b'a\n%\n%b\nc\n', latex_sample,
+                     b'  % one\n\t%% two\n  % three\nx % short\n%last',
+                     codecs.BOM_UTF8 + b'% bom\n%\nx\n',
+                     u'caf\xe9 % comment\n% na\xefve\nx\n'.encode('utf-8'),
+                     u'caf\xe9 % comment\n% na\xefve\nx\n'.encode('latin-1')]:
+            self.assertSameScan(data)
+        rand = random.Random(42)
+        alphabet = [b'%', b' ', b'\t', b'a', b'\\', b'\n', b'\n', b'\xc3\xa9']
+        for ii in range(500):
+            self.assertSameScan(b''.join(rand.choice(alphabet) 
+                                         for jj in range(rand.randint(0, 40))))
+
+    def test_scan_fallback(self):
+        # These have to be decoded first
+        self.assertSameScan(latex_sample.replace(b'\n', b'\r\n'), scanned=False)
+        self.assertSameScan(u'% caf\xe9\nx\n'.encode('utf-16'), scanned=False)
+        # Looks like utf-8 in the sample, but isn't
+        settings = scrape.sample_size
+        scrape.sample_size = 64
+        try:
+            self.assertSameScan(u'% caf\xe9\n'.encode('utf-8') * 20 + 
+                                u'% caf\xe9\nx\n'.encode('latin-1'), scanned=False)
+            # Something that isn't utf-8 outside the comments changes
+            # how later non-ascii comments are decoded...
+            self.assertSameScan(u'% caf\xe9\n'.encode('utf-8') * 20 + 
+                                u'caf\xe9\n'.encode('latin-1') + 
+                                u'% caf\xe9\nx\n'.encode('utf-8'), scanned=False)
+            # ...but not ascii ones
+            self.assertSameScan(u'% caf\xe9\n'.encode('utf-8') * 20 + 
+                                u'caf\xe9\n'.encode('latin-1') + b'% cafe\nx\n')
+        finally:
+            scrape.sample_size = settings
+
+    def test_comments(self):
+        tmpdir = tempfile.mkdtemp()
+        settings = path.latex
+        path.latex = tmpdir
+        try:
+            fn = fetch.latex_file_path('1211.1574')
+            fetch.ensure_dirs_exist(fn)
+            with open(fn, 'wb') as ff: ff.write(latex_sample.replace(b'\n', b'\r\n'))
+            self.assertEqual(scrape.comments('1211.1574'),
+                             ([[u'% A long comment\n', u'% that goes on']], 
+                              [u'% and a short comment']))
+        finally:
+            path.latex = settings
+            shutil.rmtree(tmpdir)
+
+def write_latex(aid, data):
+    "Put data in place as the latex file for aid"
+    fn = fetch.latex_file_path(aid)
+    fetch.ensure_dirs_exist(fn)
+    with open(fn, 'wb') as ff: ff.write(data)
+
+store_sample = (b'\\section{Intro}\n'
+                b'% the referee made us write this\n'
+                b'%% and this\n'
+                b'Dark matter % is fake\n')
+
+class StoreTest(unittest.TestCase):
+    def setUp(self):
+        self.settings = path.latex, store.verbose, scrape.verbose
+        store.verbose = scrape.verbose = False
+        self.tmpdir = tempfile.mkdtemp()
+        path.latex = os.path.join(self.tmpdir, 'latex')
+        self.aids = ['astro-ph/0701019', '1211.1574', '1301.0001v2']
+        write_latex('astro-ph/0701019', latex_sample)
+        write_latex('1211.1574', store_sample)
+        write_latex('1301.0001v2', store_sample + latex_sample)
+        self.conn = store.connect(os.path.join(self.tmpdir, 'comments.db'))
+
+    def tearDown(self):
+        self.conn.close()
+        path.latex, store.verbose, scrape.verbose = self.settings
+        shutil.rmtree(self.tmpdir)
+
+    def test_update(self):
+        self.assertEqual(store.update(self.conn, self.aids), 3)
+        self.assertEqual(store.update(self.conn, self.aids), 0)
+        self.assertEqual(store.update(self.conn, self.aids[:1], force=True), 1)
+        self.assertTrue(store.has_paper(self.conn, '1211.1574'))
+        self.assertFalse(store.has_paper(self.conn, '1211.1575'))
+
+    def test_query(self):
+        store.update(self.conn, self.aids)
+        self.assertEqual(store.query(self.conn, yymm='1211', kind='short'),
+                         [(u'1211.1574', u'short', u'% is fake')])
+        self.assertEqual(len(store.query(self.conn, archive='astro-ph')), 2)
+        self.assertEqual(len(store.query(self.conn, yymm=('1211', '1301'))), 6)
+        self.assertEqual(set(row[0] for row in store.query(self.conn, text='referee')),
+                         set(['1211.1574', '1301.0001v2']))
+
+    def test_export(self):
+        store.update(self.conn, self.aids)
+        names = [os.path.join(self.tmpdir, name) 
+                 for name in ['l1', 's1', 'l2', 's2']]
+        scrape.write_output(self.aids, names[0], names[1])
+        store.export(self.conn, self.aids, names[2], names[3])
+        contents = []
+        for fn in names:
+            with open(fn, 'rb') as ff: contents.append(ff.read())
+        self.assertEqual(contents[0], contents[2])
+        self.assertEqual(contents[1], contents[3])
+        self.assertTrue(b'referee' in contents[0])
+
+class RecordsTest(unittest.TestCase):
+    def setUp(self):
+        self.settings = path.latex, records.verbose, scrape.verbose
+        records.verbose = scrape.verbose = False
+        self.tmpdir = tempfile.mkdtemp()
+        path.latex = os.path.join(self.tmpdir, 'latex')
+        self.aids = ['astro-ph/0701019', '1211.1574', '1301.0001v2']
+        write_latex('astro-ph/0701019', latex_sample)
+        write_latex('1211.1574', store_sample)
+        write_latex('1301.0001v2', store_sample + latex_sample)
+
+    def tearDown(self):
+        path.latex, records.verbose, scrape.verbose = self.settings
+        shutil.rmtree(self.tmpdir)
+
+    def check_records(self, fn):
+        result = [record for offset, record in records.iter_records(fn)]
+        self.assertEqual([record['aid'] for record in result], self.aids)
+        for record in result:
+            self.assertEqual((record['long'], record['short']),
+                             scrape.comments(record['aid']))
+
+    def test_write_output(self):
+        for name in ['records.jsonl', 'records.jsonl.gz']:
+            fn = os.path.join(self.tmpdir, name)
+            scrape.write_output(self.aids, os.path.join(self.tmpdir, 'long'),
+                                os.path.join(self.tmpdir, 'short'), records_fn=fn)
+            self.check_records(fn)
+
+    def test_dump_resume(self):
+        fn = os.path.join(self.tmpdir, 'records.jsonl')
+        self.assertEqual(records.dump(self.aids[:2], fn), 2)
+        # Simulate a crash part way through writing a record
+        with open(fn, 'ab') as ff: ff.write(b'{"aid": "1301.0001v2", "lo')
+        self.assertEqual(records.done_aids(fn), set(self.aids[:2]))
+        self.assertEqual(records.dump(self.aids, fn), 1)
+        self.check_records(fn)
+
+    def test_ranges(self):
+        fn = os.path.join(self.tmpdir, 'records.jsonl')
+        records.dump(self.aids * 10, fn)
+        records.dump(['1211.1574'], fn + '.gz')
+        for n in [1, 2, 3, 7]:
+            aids = []
+            for start, stop in records.ranges(fn, n):
+                aids.extend(record['aid'] for offset, record in 
+                            records.iter_records(fn, start, stop))
+            self.assertEqual(aids, self.aids)
+        self.assertEqual(records.ranges(fn + '.gz', 4), [(0, None)])
+
 class CommentRegexpTest(unittest.TestCase):
     def test_long_comment_regexp(self):
         self.assertTrue(re.search(scrape.long_comment_regexp, '% and comment'))
@@ -1,17 +1,207 @@
-import os, re
+#########
+# Notes #
+#########
+#
+# The RSS feeds are cached on disk (path.rss_cache) along with their
+# ETag and Last-Modified headers.  A cached copy younger than
+# rss_max_age seconds is used without asking arxiv.org at all, and
+# after that the feed is only downloaded again if it has changed
+# (arxiv.org answers 304 Not Modified otherwise).  The cache holds the parsed
+# list of ids, so an unchanged feed isn't parsed again either.
+#
+# All that's needed from a feed is the list of arxiv ids, so rather
+# than building the whole feed object with feedparser, the XML is
+# parsed incrementally as it comes in and the ids are pulled out of
+# the items/entries (see iter_feed_ids).  Feedparser is only imported
+# if a feed isn't well-formed XML, since it's much more forgiving.
 
-import feedparser
+import os, re, time, threading, httplib
 
-import util, fetch, arxiv_id
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
 
-def fetch_rss():
-    """Get RSS feed from arxiv.org"""
-    return feedparser.parse('http://arxiv.org/rss/astro-ph')
+import util, fetch, arxiv_id, path, metrics
 
-def parse_rss():
-    """Get RSS feed and pull new arxiv ids from it."""
-    feed = fetch_rss()
-    result = [ arxiv_id.extract_aid(el['id']) 
-               for el in feed['entries']]
-    return result
+rss_url = 'http://arxiv.org/rss/%s'
+
+# Seconds to use a cached copy of a feed without checking for a new one
+rss_max_age = 15*60
+
+rdf_about = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}about'
+
+def local_name(tag):
+    "Tag name without the namespace"
+    return tag.rsplit('}', 1)[-1]
+
+def entry_id(elem):
+    """Get the identifier of a feed entry, the same thing feedparser
+    calls 'id': rdf:about for RSS 1.0, guid for RSS 2.0, id for Atom,
+    falling back to the link."""
+    if elem.get(rdf_about):
+        return elem.get(rdf_about)
+    links = []
+    for child in elem:
+        name = local_name(child.tag)
+        if name in ('guid', 'id') and child.text:
+            return child.text.strip()
+        elif name == 'link':
+            links.append(child.get('href') or child.text or '')
+    return links[0].strip() if links else ''
+
+def iter_feed_ids(stream):
+    """Yield the arxiv ids in an RSS or Atom feed as it's read from stream.
+
+    Raises SyntaxError if the feed isn't well-formed XML.
+    """
+    for event, elem in ElementTree.iterparse(stream):
+        if local_name(elem.tag) in ('item', 'entry'):
+            yield arxiv_id.extract_aid(entry_id(elem))
+            elem.clear()
+
+class RecordingReader(object):
+    "File-like object that keeps a copy of what's read from fileobj"
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.chunks = []
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.chunks.append(data)
+        return data
+
+    def data(self):
+        return b''.join(self.chunks)
+
+def read_feed_ids(stream):
+    """Return the arxiv ids in the feed read from stream.
+
+    If the feed isn't well-formed XML, it's handed to feedparser.
+    """
+    recorder = RecordingReader(stream)
+    try:
+        return list(iter_feed_ids(recorder))
+    except SyntaxError:
+        return feedparser_ids(recorder.data() + stream.read())
+
+def feedparser_ids(data):
+    "Pull the arxiv ids out of a feed with feedparser"
+    import feedparser
+    return [arxiv_id.extract_aid(el['id']) 
+            for el in feedparser.parse(data)['entries']]
+
+def load_rss_cache(fn=None):
+    "Load the feed cache, a dict keyed by archive"
+    fn = fn or path.rss_cache
+    if not os.path.exists(fn):
+        return {}
+    try:
+        return util.uncan(fn)
+    except Exception:
+        # A damaged cache just means fetching the feeds again
+        return {}
 
+def save_rss_cache(cache, fn=None):
+    "Save the feed cache, replacing the file atomically"
+    fn = fn or path.rss_cache
+    util.can(cache, fn + '.tmp')
+    os.rename(fn + '.tmp', fn)
+
+@metrics.timed('rss')
+def parse_rss(archives=('astro-ph',), max_age=None, cache_fn=None):
+    """Get RSS feeds and pull new arxiv ids from them.
+
+    archives is a list of archive names (or a single one) like
+    'astro-ph', 'astro-ph.CO', 'gr-qc'.  The feeds are fetched at the
+    same time, and a paper that shows up in several of them
+    (cross-lists) is only listed once, at its first appearance.
+
+    max_age is the freshness window in seconds, by default
+    rss_max_age.  Use 0 to always check with arxiv.org.
+    """
+    if isinstance(archives, basestring): archives = [archives]
+    if max_age is None: max_age = rss_max_age
+    cache = load_rss_cache(cache_fn)
+    now = time.time()
+
+    results = {}
+    def worker(archive):
+        try:
+            results[archive] = feed_ids(archive, cache.get(archive), now)
+        except Exception, exc:
+            # Same as network trouble: nothing from this feed, and
+            # nothing cached
+            print "WARNING: Couldn't read the feed for", archive, exc
+            metrics.count('rss_failures')
+            results[archive] = None, []
+
+    threads = [threading.Thread(target=worker, args=(archive,)) 
+               for archive in archives 
+               if not (archive in cache and now - cache[archive]['fetched'] < max_age)]
+    metrics.count('rss_cache_hits', len(archives) - len(threads))
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for archive, (entry, ids) in results.items():
+        if entry:
+            cache[archive] = entry
+    if any(entry for entry, ids in results.values()):
+        save_rss_cache(cache, cache_fn)
+
+    all_ids = []
+    for archive in archives:
+        if archive in results:
+            all_ids.extend(results[archive][1])
+        else:
+            all_ids.extend(cache[archive]['ids'])
+    return unique_ids(all_ids)
+
+def feed_ids(archive, entry, now):
+    """Fetch one feed, return the new cache entry (or None) and the ids.
+
+    entry is the cache entry for the feed, if there is one.
+    """
+    headers = {'Accept-Encoding': 'identity'}
+    if fetch.user_agent: headers['User-Agent'] = fetch.user_agent
+    if entry and entry['etag']: headers['If-None-Match'] = entry['etag']
+    if entry and entry['modified']: headers['If-Modified-Since'] = entry['modified']
+
+    try:
+        response = fetch.http_get(rss_url % archive, headers)
+        if entry and response.status == 304:
+            response.read()
+            metrics.count('rss_not_modified')
+            entry = dict(entry, fetched=now)
+        elif response.status == 200:
+            entry = dict(etag=response.getheader('etag'), 
+                         modified=response.getheader('last-modified'),
+                         fetched=now, ids=read_feed_ids(response))
+        else:
+            response.read()
+            print "WARNING: HTTP error", response.status, "for the feed for", archive
+            metrics.count('rss_failures')
+            return None, []
+    except (IOError, httplib.HTTPException), exc:
+        # Network trouble, don't cache anything.
+        print "WARNING: Couldn't fetch the feed for", archive, exc
+        metrics.count('rss_failures')
+        return None, []
+    return entry, entry['ids']
+
+def unique_ids(aids):
+    """Remove duplicates from a list of arxiv ids, keeping the order.
+
+    Different versions of the same paper count as duplicates.
+    """
+    seen = set()
+    result = []
+    for aid in aids:
+        parsed = arxiv_id.parse_or_none(aid) if aid else None
+        if parsed is None or parsed.unversioned in seen:
+            continue
+        seen.add(parsed.unversioned)
+        result.append(aid)
+    return result
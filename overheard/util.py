@@ -1,4 +1,4 @@
-import os, cPickle, contextlib
+import os, sys, time, cPickle, contextlib
 
 ### Code snippet from http://stackoverflow.com/questions/169070/
 @contextlib.contextmanager
@@ -24,8 +24,60 @@ def flatten(L):
     result = []
     rec(L)
     return result
+
+class Progress(object):
+    """Keep track of how fast things are getting done.
+
+    Call update() once for each item finished, giving the number of
+    bytes it involved.  A line like
+
+      1200 papers  35.2 papers/s  12.1 MB/s
+
+    is printed every interval seconds (with an ETA if the total number
+    of items is known).
+    """
+
+    def __init__(self, total=None, interval=10, stream=None):
+        self.total = total
+        self.interval = interval
+        self.stream = stream
+        self.count = 0
+        self.nbytes = 0
+        self.start = self.last_report = time.time()
+
+    def update(self, nbytes=0, count=1):
+        self.count += count
+        self.nbytes += nbytes
+        if time.time() - self.last_report >= self.interval:
+            self.report()
+
+    def rates(self):
+        "Items per second and megabytes per second so far"
+        elapsed = max(time.time() - self.start, 1e-6)
+        return self.count / elapsed, self.nbytes / elapsed / 2.0**20
+
+    def eta(self):
+        "Estimated seconds until done, or None if it can't be known"
+        per_sec, mb_per_sec = self.rates()
+        if self.total is None or per_sec == 0:
+            return None
+        return (self.total - self.count) / per_sec
+
+    def report(self, final=False):
+        self.last_report = time.time()
+        per_sec, mb_per_sec = self.rates()
+        msg = "%d papers  %.1f papers/s  %.1f MB/s" % (self.count, per_sec, mb_per_sec)
+        if self.total is not None:
+            msg = "%d/%d" % (self.count, self.total) + msg[len(str(self.count)):]
+            eta = self.eta()
+            if eta is not None and not final:
+                msg += "  ETA %d:%02d:%02d" % (eta//3600, eta//60 % 60, eta % 60)
+        if final:
+            msg += "  in %.1f s" % (time.time() - self.start)
+        print >> (self.stream or sys.stdout), msg
+
 #
-# These were used for caching the rss feed, but they're not currently used anywhere.
+# These are used for caching the rss feeds (see update.py).
 # 
 def can(obj, file, protocol=2):
     """More convenient syntax for pickle, intended for interactive use